@@ -0,0 +1,862 @@
+"""
+Dependency-graph analysis runner for ITL detchar datasets.
+"""
+
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import threading
+import time
+from importlib import metadata
+
+import azcam
+import azcam.exceptions
+import azcam.utils
+
+
+class AnalysisStage(object):
+    """
+    One analysis step, the methods of a tool run in a dataset folder.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        tool: str = None,
+        folder: str = None,
+        methods: list = ("analyze",),
+        depends: list = (),
+        prepare: list = (),
+        exports: list = (),
+    ):
+        """
+        Args:
+            name: unique stage name.
+            tool: tool name in azcam.db.tools, default is name.
+            folder: data folder relative to the report folder, default is name.
+                May refer to tool attributes set by earlier stages, like
+                "{ptc.analysis_folder}", resolved when the stage runs.
+            methods: tool methods called in order.
+            depends: names of stages which must finish first.
+            prepare: list of (tool, method) calls made before methods, in the same
+                process as the stage (for example ("gain", "fe55_gain")).
+            exports: tool attributes set by this stage which later stages use,
+                restored with the stage products (for example "analysis_folder").
+        """
+
+        self.name = name
+        self.tool = name if tool is None else tool
+        self.folder = self.name if folder is None else folder
+        self.methods = list(methods)
+        self.depends = list(depends)
+        self.prepare = list(prepare)
+        self.exports = list(exports)
+
+
+# tools in azcam.db.tools and the working folder are shared by all contexts,
+# azcam_console tools read their data from the working folder
+_tool_lock = threading.RLock()
+_tool_owner = None
+
+
+class AnalysisContext(object):
+    """
+    Folders and shared products for the analysis of one report folder.
+    Tools are run through a context with explicit folders so that several
+    report folders may be analyzed from one process. The tools are shared and
+    read data from the working folder, so tool invocations are serialized and
+    change to the context folder while they run. Each context reloads its own
+    products (tool data files such as gain and defects) into the shared tools
+    before running a stage. Stages of one context may run in parallel in
+    worker processes, see AnalysisPipeline.
+    """
+
+    def __init__(self, data_folder: str, output_folder: str = None):
+        """
+        Args:
+            data_folder: report folder containing the stage data folders.
+            output_folder: folder for reports and logs, default is data_folder.
+        """
+
+        self.data_folder = os.path.abspath(data_folder)
+        self.output_folder = (
+            self.data_folder
+            if output_folder is None
+            else os.path.abspath(output_folder)
+        )
+
+        self.products = {}  # stage name: (tool, datafile)
+        self.exports = {}  # stage name: (tool, dict of attribute: value)
+
+    def folder(self, name: str = "") -> str:
+        """
+        Return absolute path of a data folder.
+        """
+
+        return os.path.normpath(os.path.join(self.data_folder, name))
+
+    def output(self, name: str = "") -> str:
+        """
+        Return absolute path of an output file or folder.
+        """
+
+        return os.path.normpath(os.path.join(self.output_folder, name))
+
+    def get_datafile(self, tool_name: str) -> str:
+        """
+        Return the most recent data file written by a tool, or None.
+        """
+
+        datafile = None
+        for tool, filename in self.products.values():
+            if tool == tool_name and filename is not None:
+                datafile = filename
+
+        return datafile
+
+    @property
+    def gain_file(self) -> str:
+        """
+        Gain tool data file, or None.
+        """
+
+        return self.get_datafile("gain")
+
+    @property
+    def mask_file(self) -> str:
+        """
+        Defects mask file, or None.
+        """
+
+        filename = self.folder(os.path.join("defects", "DefectsMask.fits"))
+
+        return filename if os.path.exists(filename) else None
+
+    def copy(self, stage_names: list = None) -> "AnalysisContext":
+        """
+        Return a copy of this context with products of only the named stages.
+        """
+
+        context = AnalysisContext(self.data_folder, self.output_folder)
+        for name in self.products:
+            if stage_names is None or name in stage_names:
+                context.products[name] = self.products[name]
+        for name in self.exports:
+            if stage_names is None or name in stage_names:
+                context.exports[name] = self.exports[name]
+
+        return context
+
+    def load_products(self):
+        """
+        Load all products of this context into the shared tools.
+        """
+
+        for tool_name, datafile in self.products.values():
+            if datafile is not None:
+                azcam.db.tools[tool_name].read_datafile(datafile)
+
+        self.load_exports()
+
+        return
+
+    def load_exports(self):
+        """
+        Set tool attributes exported by stages of this context.
+        """
+
+        for tool_name, values in self.exports.values():
+            for attribute, value in values.items():
+                setattr(azcam.db.tools[tool_name], attribute, value)
+
+        return
+
+    def stage_folder(self, stage: AnalysisStage) -> str:
+        """
+        Return absolute path of the data folder of a stage, with references to
+        tool attributes resolved from the stages it depends on.
+        """
+
+        with _tool_lock:
+            self.activate()
+            self.load_exports()
+            folder = stage.folder.format(**azcam.db.tools)
+
+        return self.folder(folder)
+
+    def activate(self, reload: bool = False):
+        """
+        Make the shared tools hold the products of this context.
+        Products are only reloaded if another context used the tools since.
+        """
+
+        global _tool_owner
+
+        with _tool_lock:
+            if reload or _tool_owner is not self:
+                self.load_products()
+                _tool_owner = self
+
+        return
+
+    @contextlib.contextmanager
+    def working(self, name: str = "", create: bool = False):
+        """
+        Context manager which holds the tools for this context and changes
+        to a data folder, restoring the previous folder on exit.
+        Raises AzcamError if the folder does not exist, unless create is True.
+        """
+
+        with _tool_lock:
+            self.activate()
+
+            folder = self.folder(name)
+            if not os.path.isdir(folder):
+                if not create:
+                    raise azcam.exceptions.AzcamError(f"folder {folder} not found")
+                os.makedirs(folder)
+
+            currentfolder = azcam.utils.curdir()
+            azcam.utils.curdir(folder)
+            try:
+                yield folder
+            finally:
+                azcam.utils.curdir(currentfolder)
+
+    @contextlib.contextmanager
+    def reporting(self):
+        """
+        Context manager which holds the tools for this context and changes
+        to the output folder for reports, restoring the previous folder on exit.
+        """
+
+        with self.working(self.output_folder, create=True) as folder:
+            yield folder
+
+    def run(self, stage: AnalysisStage):
+        """
+        Run one analysis stage and record its product.
+
+        Returns:
+            (tool, datafile) where datafile is None if the tool wrote none.
+        """
+
+        with self.working(self.stage_folder(stage)) as folder:
+            for tool_name, method in stage.prepare:
+                getattr(azcam.db.tools[tool_name], method)()
+
+            tool = azcam.db.tools[stage.tool]
+            for method in stage.methods:
+                getattr(tool, method)()
+
+            datafile = getattr(tool, "data_file", "")
+            if datafile:
+                datafile = os.path.join(folder, datafile)
+            if not datafile or not os.path.exists(datafile):
+                datafile = None
+
+            if stage.exports:
+                values = {a: getattr(tool, a) for a in stage.exports}
+                self.exports[stage.name] = (stage.tool, values)
+
+        self.products[stage.name] = (stage.tool, datafile)
+
+        return stage.tool, datafile
+
+
+def code_version() -> str:
+    """
+    Return version string of the analysis code packages.
+    Includes a hash of the sizes and times of the package source files so that
+    editable installs are versioned by their current source.
+    """
+
+    versions = []
+    sha = hashlib.sha256()
+    for package in ("azcam_itl", "azcam_console"):
+        try:
+            versions.append(f"{package} {metadata.version(package)}")
+        except metadata.PackageNotFoundError:
+            versions.append(f"{package} unknown")
+
+        try:
+            spec = importlib.util.find_spec(package)
+        except (ImportError, ValueError):
+            spec = None
+        if spec is None or spec.submodule_search_locations is None:
+            continue
+
+        for folder in spec.submodule_search_locations:
+            for root, dirs, files in os.walk(folder):
+                dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+                for filename in sorted(files):
+                    if not filename.endswith(".py"):
+                        continue
+                    filename = os.path.join(root, filename)
+                    st = os.stat(filename)
+                    name = f"{package}/{os.path.relpath(filename, folder)}"
+                    sha.update(f"{name} {st.st_size} {st.st_mtime_ns}\n".encode())
+
+    versions.append(f"source {sha.hexdigest()[:16]}")
+
+    return ", ".join(versions)
+
+
+def _is_parameter(value) -> bool:
+    """
+    True if value is a simple type which may be a tool parameter, or a list or
+    dict of them (like qe.exposure_times or qe.qe_specs).
+    """
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_parameter(v) for v in value)
+    if isinstance(value, dict):
+        return all(
+            _is_parameter(k) and _is_parameter(v) for k, v in value.items()
+        )
+
+    return False
+
+
+def _canonical(value):
+    """
+    Return a parameter value with dicts as lists of [repr(key), value] sorted by
+    key, so that values with any key types hash the same in every run.
+    """
+
+    if isinstance(value, dict):
+        return [
+            [repr(k), _canonical(v)]
+            for k, v in sorted(value.items(), key=lambda item: repr(item[0]))
+        ]
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+
+    return value
+
+
+def tool_parameters(tool_names: list) -> dict:
+    """
+    Return simple-typed public attributes of tools as dict of "tool.attribute": value.
+    Dict values are returned in canonical form, see _canonical().
+    """
+
+    parameters = {}
+    for tool_name in tool_names:
+        tool = azcam.db.tools[tool_name]
+        for attribute, value in vars(tool).items():
+            if not attribute.startswith("_") and _is_parameter(value):
+                parameters[f"{tool_name}.{attribute}"] = _canonical(value)
+
+    return parameters
+
+
+class StageCache(object):
+    """
+    Persistent cache of analysis stage results for one report folder.
+    A stage key is a hash of the stage input files, tool parameters and the keys
+    of the stages it depends on. A stage with an unchanged key and unchanged
+    output files is skipped and its recorded products are reused.
+    The cache is discarded when the code version changes.
+    """
+
+    def __init__(self, context: AnalysisContext, filename: str = ".analysis_cache.json"):
+        """
+        Args:
+            context: AnalysisContext of the report folder.
+            filename: cache file name in the output folder.
+        """
+
+        self.context = context
+        self.filename = context.output(filename)
+        self.version = code_version()
+
+        self.entries = {}  # stage name: dict of key, results, outputs, datafile
+        self.hashes = {}  # relative file name: [size, mtime_ns, sha256]
+
+        self.load()
+
+    def load(self):
+        """
+        Read cache file if it exists and matches the code version.
+        """
+
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") == self.version:
+            self.entries = data.get("stages", {})
+            self.hashes = data.get("files", {})
+
+        return
+
+    def save(self):
+        """
+        Write cache file.
+        """
+
+        data = {"version": self.version, "stages": self.entries, "files": self.hashes}
+        tempfile = self.filename + ".tmp"
+        with open(tempfile, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tempfile, self.filename)
+
+        return
+
+    def clear(self):
+        """
+        Forget all stages so that the next run recomputes everything.
+        """
+
+        self.entries = {}
+
+        return
+
+    def list_files(self, folder: str) -> dict:
+        """
+        Return files in a data folder as dict of relative name: [size, mtime_ns].
+        """
+
+        files = {}
+        if not os.path.isdir(folder):
+            return files
+
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith(".analysis_cache"):
+                    stat = entry.stat()
+                    name = os.path.relpath(entry.path, self.context.data_folder)
+                    files[name] = [stat.st_size, stat.st_mtime_ns]
+
+        return files
+
+    def file_hash(self, name: str, stat: list) -> str:
+        """
+        Return sha256 of a file, rehashing only if its size or time changed.
+        """
+
+        cached = self.hashes.get(name)
+        if cached is not None and cached[:2] == stat:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(self.context.folder(name), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        self.hashes[name] = stat + [sha.hexdigest()]
+
+        return self.hashes[name][2]
+
+    def key(self, stage: AnalysisStage, parameters: dict, depend_keys: dict) -> str:
+        """
+        Return cache key of a stage.
+        Files written by any cached stage are not inputs.
+        """
+
+        outputs = set()
+        for entry in self.entries.values():
+            outputs.update(entry["outputs"])
+
+        files = self.list_files(self.context.stage_folder(stage))
+        inputs = {
+            name: self.file_hash(name, stat)
+            for name, stat in sorted(files.items())
+            if name not in outputs
+        }
+
+        data = {
+            "stage": [stage.tool, stage.folder, stage.methods, stage.prepare],
+            "inputs": inputs,
+            "parameters": parameters,
+            "depends": depend_keys,
+        }
+        data = json.dumps(data, sort_keys=True, default=str).encode()
+
+        return hashlib.sha256(data).hexdigest()
+
+    def lookup(self, name: str, key: str):
+        """
+        Return cached (tool, datafile) of a stage or None if it must be run.
+        Cached exports are restored into the context.
+        """
+
+        entry = self.entries.get(name)
+        if entry is None or entry["key"] != key:
+            return None
+
+        for output, stat in entry["outputs"].items():
+            filename = self.context.folder(output)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return None
+            if [st.st_size, st.st_mtime_ns] != stat:
+                return None
+
+        if entry.get("exports"):
+            self.context.exports[name] = (entry["tool"], entry["exports"])
+
+        return entry["tool"], self.context.folder(entry["datafile"])
+
+    def record(
+        self,
+        stage: AnalysisStage,
+        key: str,
+        results: list,
+        outputs: dict,
+        datafile: str,
+        exports: dict = None,
+    ):
+        """
+        Record a stage which was run.
+        Stages without a data file are not cached as their tool state cannot be reloaded.
+        """
+
+        if datafile is None:
+            self.entries.pop(stage.name, None)
+            return
+
+        datafile = os.path.relpath(datafile, self.context.data_folder)
+        if datafile not in outputs:
+            st = os.stat(self.context.folder(datafile))
+            outputs[datafile] = [st.st_size, st.st_mtime_ns]
+
+        self.entries[stage.name] = {
+            "key": key,
+            "tool": stage.tool,
+            "datafile": datafile,
+            "results": sorted(results),
+            "outputs": outputs,
+            "exports": {} if exports is None else exports,
+        }
+
+        return
+
+
+def run_stage(stage: AnalysisStage, context: AnalysisContext):
+    """
+    Run one analysis stage in a pool worker process.
+    Returns the stage product and exports.
+    """
+
+    product = context.run(stage)
+
+    return product, context.exports.get(stage.name)
+
+
+class AnalysisPipeline(object):
+    """
+    Runs detchar analysis stages according to their dependencies.
+    With number_workers > 1 independent stages run concurrently in a process pool,
+    each process with its own working folder. Tool results are passed between
+    processes through the tool data files recorded in the AnalysisContext.
+    With use_cache stages with unchanged inputs and parameters are skipped,
+    see StageCache.
+    """
+
+    def __init__(
+        self,
+        stages: list,
+        context: AnalysisContext = None,
+        number_workers: int = 1,
+        use_cache: bool = False,
+    ):
+        """
+        Args:
+            stages: list of AnalysisStage in a valid serial order.
+            context: AnalysisContext or report folder name, default is current folder.
+            number_workers: number of pool processes, 1 runs stages serially.
+            use_cache: skip stages whose cached results are still valid.
+        """
+
+        if context is None:
+            context = azcam.utils.curdir()
+        if isinstance(context, str):
+            context = AnalysisContext(context)
+
+        self.stages = stages
+        self.context = context
+        self.number_workers = number_workers
+
+        self.cache = StageCache(self.context) if use_cache else None
+
+        self.times = {}  # stage name: elapsed seconds
+        self.failed = {}  # stage name: error message
+        self.skipped = []  # names of stages with cached results
+
+        self._keys = {}  # stage name: cache key
+        self._files = {}  # stage name: folder files before running
+        self._parameters = {}  # tool parameters before running
+
+        self._check()
+
+    @property
+    def products(self) -> dict:
+        """
+        Stage products, dict of stage name: (tool, datafile).
+        """
+
+        return self.context.products
+
+    def _check(self):
+        """
+        Check stage names and dependencies, stages must be in a valid serial order.
+        """
+
+        names = []
+        for stage in self.stages:
+            if stage.name in names:
+                raise azcam.exceptions.AzcamError(f"duplicate stage {stage.name}")
+            for dep in stage.depends:
+                if dep not in names:
+                    raise azcam.exceptions.AzcamError(
+                        f"stage {stage.name} depends on unknown or later stage {dep}"
+                    )
+            names.append(stage.name)
+
+        return
+
+    def ancestors(self, stage: AnalysisStage) -> list:
+        """
+        Return names of all stages a stage depends on, in stage order.
+        """
+
+        stages = {s.name: s for s in self.stages}
+        found = set()
+        todo = list(stage.depends)
+        while todo:
+            name = todo.pop()
+            if name not in found:
+                found.add(name)
+                todo.extend(stages[name].depends)
+
+        return [s.name for s in self.stages if s.name in found]
+
+    def run(self) -> dict:
+        """
+        Run all stages.
+        Returns dict of stage name: (tool, datafile).
+        """
+
+        parallel = self.number_workers > 1
+        if parallel and "fork" not in multiprocessing.get_all_start_methods():
+            azcam.log("Parallel analysis requires fork, running stages serially")
+            parallel = False
+
+        if self.cache is not None:
+            self._parameters = tool_parameters(self._tool_names())
+
+        t0 = time.time()
+        try:
+            if parallel:
+                self._run_parallel()
+            else:
+                self._run_serial()
+        finally:
+            if self.cache is not None:
+                self._record()
+
+        for name in self.times:
+            azcam.log(f"Analysis stage {name}: {self.times[name]:.1f} secs")
+        if self.skipped:
+            azcam.log(f"Analysis stages with cached results: {', '.join(self.skipped)}")
+        azcam.log(f"Analysis finished in {time.time() - t0:.1f} secs")
+
+        if self.failed:
+            raise azcam.exceptions.AzcamError(
+                f"analysis stages failed: {', '.join(self.failed)}"
+            )
+
+        return self.products
+
+    def _tool_names(self, stage: AnalysisStage = None) -> list:
+        """
+        Return names of tools used by a stage or by all stages.
+        """
+
+        stages = self.stages if stage is None else [stage]
+        names = []
+        for s in stages:
+            for name in [s.tool] + [p[0] for p in s.prepare]:
+                if name not in names:
+                    names.append(name)
+
+        return names
+
+    def _stage_key(self, stage: AnalysisStage) -> str:
+        """
+        Return cache key of a stage from the tool parameters at the start of the run.
+        Attributes which a previous run changed are results, not parameters.
+        """
+
+        entry = self.cache.entries.get(stage.name, {})
+        results = set(entry.get("results", []))
+        tools = self._tool_names(stage)
+
+        parameters = {
+            name: value
+            for name, value in self._parameters.items()
+            if name.split(".")[0] in tools and name not in results
+        }
+        depend_keys = {d: self._keys[d] for d in stage.depends}
+
+        return self.cache.key(stage, parameters, depend_keys)
+
+    def _skip(self, stage: AnalysisStage) -> bool:
+        """
+        Check the cache for a stage. Returns True if the stage need not run.
+        """
+
+        if self.cache is None:
+            return False
+
+        # a stage must run again if any stage it depends on was run
+        product = None
+        if all(d in self.skipped for d in stage.depends):
+            self._keys[stage.name] = self._stage_key(stage)
+            product = self.cache.lookup(stage.name, self._keys[stage.name])
+
+        if product is None:
+            self._files[stage.name] = self.cache.list_files(
+                self.context.stage_folder(stage)
+            )
+            return False
+
+        azcam.log(f"Analysis stage {stage.name} unchanged, using cached results")
+        self.products[stage.name] = product
+        self.skipped.append(stage.name)
+
+        return True
+
+    def _record(self):
+        """
+        Record stages which were run in the cache and write the cache file.
+        """
+
+        parameters = tool_parameters(self._tool_names())
+        changed = {
+            name
+            for name in set(self._parameters) | set(parameters)
+            if self._parameters.get(name) != parameters.get(name)
+        }
+
+        ran = [
+            s
+            for s in self.stages
+            if s.name in self._files and s.name in self.times and s.name not in self.failed
+        ]
+
+        # outputs first so that keys do not include them as inputs
+        for stage in ran:
+            before = self._files[stage.name]
+            after = self.cache.list_files(self.context.stage_folder(stage))
+            outputs = {n: st for n, st in after.items() if before.get(n) != st}
+            old = self.cache.entries.get(stage.name, {}).get("results", [])
+            tools = self._tool_names(stage)
+            results = set(old) | {n for n in changed if n.split(".")[0] in tools}
+            exports = self.context.exports.get(stage.name, (None, {}))[1]
+            self.cache.record(
+                stage, "", results, outputs, self.products[stage.name][1], exports
+            )
+
+        # attributes loaded from data files of cached stages are also results
+        for stage in self.stages:
+            if stage.name in self.skipped:
+                entry = self.cache.entries[stage.name]
+                tools = self._tool_names(stage)
+                results = set(entry["results"])
+                results.update(n for n in changed if n.split(".")[0] in tools)
+                entry["results"] = sorted(results)
+
+        for stage in self.stages:
+            if stage.name in self.cache.entries and (
+                stage in ran or stage.name in self.skipped
+            ):
+                self._keys[stage.name] = self._stage_key(stage)
+                self.cache.entries[stage.name]["key"] = self._keys[stage.name]
+            elif stage in ran:
+                self._keys[stage.name] = ""
+
+        self.cache.save()
+
+        return
+
+    def _run_serial(self):
+        """
+        Run stages in order in this process.
+        """
+
+        for stage in self.stages:
+            if self._skip(stage):
+                continue
+            t0 = time.time()
+            self.context.run(stage)
+            self.times[stage.name] = time.time() - t0
+            print("")
+
+        # tools hold the products of the last stage run, reload cached ones for reports
+        if self.skipped:
+            self.context.activate(reload=True)
+
+        return
+
+    def _run_parallel(self):
+        """
+        Run stages in a process pool as their dependencies finish.
+        """
+
+        pending = list(self.stages)
+        running = {}
+        starts = {}
+
+        with concurrent.futures.ProcessPoolExecutor(
+            self.number_workers, mp_context=multiprocessing.get_context("fork")
+        ) as pool:
+            while pending or running:
+                for stage in list(pending):
+                    if any(d in self.failed for d in self.ancestors(stage)):
+                        pending.remove(stage)
+                        self.failed[stage.name] = "dependency failed"
+                        continue
+                    if not all(d in self.products for d in stage.depends):
+                        continue
+                    pending.remove(stage)
+                    if self._skip(stage):
+                        continue
+                    context = self.context.copy(self.ancestors(stage))
+                    azcam.log(f"Starting analysis stage {stage.name}")
+                    starts[stage.name] = time.time()
+                    future = pool.submit(run_stage, stage, context)
+                    running[future] = stage
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    stage = running.pop(future)
+                    self.times[stage.name] = time.time() - starts[stage.name]
+                    try:
+                        product, exports = future.result()
+                        self.products[stage.name] = product
+                        if exports is not None:
+                            self.context.exports[stage.name] = exports
+                    except Exception as e:
+                        azcam.log(f"Analysis stage {stage.name} failed: {e}")
+                        self.failed[stage.name] = str(e)
+
+        # load results into this process for reports
+        self.context.activate(reload=True)
+
+        return
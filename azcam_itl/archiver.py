@@ -0,0 +1,288 @@
+"""
+Streaming archive builder for datasets.
+Files are read once and written straight into the archive under a new top level
+name, with the sha256 manifest of the contents made in the same pass.
+"""
+
+import collections
+import concurrent.futures
+import fnmatch
+import hashlib
+import os
+import struct
+import tarfile
+import zipfile
+import zlib
+
+import azcam
+import azcam.exceptions
+
+
+class _HashingReader(object):
+    """
+    File reader which updates a sha256 hash with the data read.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha.update(data)
+        return data
+
+
+def _deflate(block: bytes, level: int, zdict: bytes, last: bool) -> bytes:
+    """
+    Return raw deflate data of a block, primed with the end of the previous block.
+    Blocks end on a byte boundary so they can be concatenated.
+    """
+
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    flush = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+
+    return compressor.compress(block) + compressor.flush(flush)
+
+
+class _ParallelGzipWriter(object):
+    """
+    File writer which deflates blocks in threads and writes them in order as
+    a single gzip member, like pigz. The output is a standard gzip file which
+    can also be read as a stream, like tarfile.open(mode="r|gz").
+    """
+
+    def __init__(self, fileobj, number_threads: int, level: int, block_size: int):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(number_threads)
+        self.pending = collections.deque()
+        self.max_pending = 2 * number_threads
+        self.buffer = bytearray()
+        self.zdict = b""  # last 32 kB of previous block
+        self.crc = 0
+        self.size = 0
+
+        # gzip header, no file name and mtime 0 for reproducible output
+        self.fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", 0) + b"\x00\xff")
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[: self.block_size]), False)
+            del self.buffer[: self.block_size]
+
+        return len(data)
+
+    def _submit(self, block: bytes, last: bool):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+
+        future = self.pool.submit(_deflate, block, self.level, self.zdict, last)
+        self.pending.append(future)
+        self.zdict = block[-32768:]
+
+        # limit memory use to a few blocks per thread
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        self._submit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+
+        self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
+
+
+class Archiver(object):
+    """
+    Makes tar, tar.gz or zip archives of a folder tree or a file.
+    tar.gz files are compressed in parallel blocks.
+    """
+
+    def __init__(self):
+        # number of compression threads
+        self.number_threads = os.cpu_count() or 1
+
+        # compression level 1-9
+        self.level = 6
+
+        # bytes per compressed block for tar.gz
+        self.block_size = 4 * 1024 * 1024
+
+        # bytes per file read
+        self.read_size = 1024 * 1024
+
+        # write a manifest file of sha256 checksums of the archived files
+        self.write_manifest = True
+
+        # file and folder name patterns never archived, default is dot-files
+        # like .analysis_cache.json and .fitsindex.sqlite
+        self.exclude_patterns = [".*"]
+
+        # manifest of the last archive as list of (checksum, archive name)
+        self.manifest = []
+
+    def make_archive(
+        self,
+        foldername: str,
+        filename: str = None,
+        arcname: str = None,
+        filetype: str = "tar",
+        exclude: list = (),
+    ) -> str:
+        """
+        Make an archive of a folder or file.
+
+        Args:
+            foldername: folder or file to archive.
+            filename: archive filename, default is foldername with filetype extension.
+            arcname: top level name in archive, default is folder name, "" for none.
+              A file is always archived under a name, its base name if "".
+            filetype: "tar", "tar.gz", or "zip".
+            exclude: filenames not archived. The archive and manifest are always
+              excluded, as are files and folders matching exclude_patterns.
+        Returns:
+            archive filename.
+        """
+
+        foldername = os.path.normpath(foldername)
+        if filename is None:
+            filename = f"{foldername}.{filetype}"
+        if arcname is None:
+            arcname = os.path.basename(os.path.abspath(foldername))
+        arcname = os.path.splitdrive(arcname)[1].replace(os.sep, "/").strip("/")
+
+        manifestfile = self.manifest_filename(filename)
+        skip = {os.path.abspath(f) for f in list(exclude) + [filename, manifestfile]}
+        self.manifest = []
+
+        if filetype == "tar":
+            with open(filename, "wb") as f:
+                self._write_tar(f, foldername, arcname, skip)
+
+        elif filetype == "tar.gz":
+            with open(filename, "wb") as f:
+                writer = _ParallelGzipWriter(
+                    f, self.number_threads, self.level, self.block_size
+                )
+                self._write_tar(writer, foldername, arcname, skip)
+                writer.close()
+
+        elif filetype == "zip":
+            self._write_zip(filename, foldername, arcname, skip)
+
+        else:
+            raise azcam.exceptions.AzcamError("unsupported archive file type")
+
+        if self.write_manifest:
+            with open(manifestfile, "w") as f:
+                for checksum, name in self.manifest:
+                    f.write(f"{checksum}  {name}\n")
+
+        return filename
+
+    @staticmethod
+    def manifest_filename(filename: str) -> str:
+        """
+        Return manifest filename of an archive.
+        """
+
+        return filename + ".manifest"
+
+    def _walk(self, foldername: str, arcname: str, skip: set):
+        """
+        Yield (path, name in archive) for a folder tree in sorted order,
+        or for a single file.
+        """
+
+        if not os.path.isdir(foldername):
+            yield foldername, arcname or os.path.basename(foldername)
+            return
+
+        if arcname:
+            yield foldername, arcname
+
+        todo = [(foldername, arcname)]
+        while todo:
+            folder, name = todo.pop()
+            with os.scandir(folder) as entries:
+                entries = sorted(entries, key=lambda e: e.name)
+            subfolders = []
+            for entry in entries:
+                if os.path.abspath(entry.path) in skip:
+                    continue
+                if any(fnmatch.fnmatch(entry.name, p) for p in self.exclude_patterns):
+                    continue
+                entryname = f"{name}/{entry.name}" if name else entry.name
+                yield entry.path, entryname
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append((entry.path, entryname))
+            todo.extend(reversed(subfolders))
+
+    def _write_tar(self, fileobj, foldername: str, arcname: str, skip: set):
+        """
+        Stream a folder tree into an uncompressed tar stream.
+        """
+
+        with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+            for path, name in self._walk(foldername, arcname, skip):
+                info = tar.gettarinfo(path, name)
+                if info is None:
+                    continue  # sockets and other special files
+                if info.isreg():
+                    with open(path, "rb") as f:
+                        reader = _HashingReader(f)
+                        tar.addfile(info, reader)
+                    self.manifest.append((reader.sha.hexdigest(), name))
+                else:
+                    tar.addfile(info)
+
+        return
+
+    def _write_zip(self, filename: str, foldername: str, arcname: str, skip: set):
+        """
+        Stream a folder tree into a zip file.
+        """
+
+        with zipfile.ZipFile(
+            filename, "w", zipfile.ZIP_DEFLATED, compresslevel=self.level
+        ) as zf:
+            for path, name in self._walk(foldername, arcname, skip):
+                if os.path.isdir(path):
+                    zf.write(path, name)
+                    continue
+                sha = hashlib.sha256()
+                info = zipfile.ZipInfo.from_file(path, name)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, "rb") as f, zf.open(info, "w", force_zip64=True) as dest:
+                    for chunk in iter(lambda: f.read(self.read_size), b""):
+                        sha.update(chunk)
+                        dest.write(chunk)
+                self.manifest.append((sha.hexdigest(), name))
+
+        return
+
+
+def make_archive(
+    foldername: str,
+    filename: str = None,
+    arcname: str = None,
+    filetype: str = "tar",
+) -> str:
+    """
+    Make an archive of a folder or file, see Archiver.make_archive.
+    Returns archive filename.
+    """
+
+    azcam.log(f"Archiving {foldername}")
+
+    return Archiver().make_archive(foldername, filename, arcname, filetype)
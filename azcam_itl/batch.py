@@ -0,0 +1,260 @@
+"""
+Non-interactive batch analysis of a shipment of detchar report folders.
+
+Usage example from azcamconsole:
+  from azcam_itl.batch import batch_analyze
+  batch_analyze(detchar, "/data/DESI/shipment_2024", number_workers=8)
+"""
+
+import concurrent.futures
+import configparser
+import contextlib
+import fnmatch
+import glob
+import multiprocessing
+import os
+import time
+import traceback
+
+from astropy.io import fits as pyfits
+
+import azcam
+import azcam.utils
+
+# identification values used by ask() instead of prompting
+identification = {}
+
+# if True then ask() returns defaults instead of prompting
+non_interactive = False
+
+# batch instance used by pool worker processes
+_active_batch = None
+
+
+def ask(key: str, prompt: str, default: str = ""):
+    """
+    Return an identification value for key, prompting only in interactive mode.
+
+    Args:
+        key: identification key like "lot" or "camera_id".
+        prompt: prompt message for interactive use.
+        default: default value.
+    """
+
+    if key in identification:
+        return identification[key]
+
+    if non_interactive:
+        return default
+
+    return azcam.utils.prompt(prompt, default)
+
+
+class BatchAnalysis(object):
+    """
+    Finds report folders under a root folder and analyzes them with a detchar
+    object, in parallel processes when available.
+    Identification is read from FITS headers and from an optional sidecar file
+    (an .ini file with an [identification] section) in the report folder or its
+    parent folder. Sidecar values take precedence.
+    """
+
+    def __init__(self, detchar):
+        self.detchar = detchar
+
+        self.number_workers = os.cpu_count()
+        self.folder_pattern = "report*"
+
+        self.sidecar_file = "identification.ini"
+        self.header_file = os.path.join("bias", "bias.*.fits")
+        # identification key: FITS keyword
+        self.header_keywords = {
+            "camera_id": "CAMID",
+            "lot": "LOT",
+            "wafer": "WAFER",
+            "die": "DIE",
+        }
+
+        self.log_file = "analysis_batch.log"
+        self.summary_file = "batch_summary.txt"
+
+        self.results = []
+
+    def find_folders(self, root: str) -> list:
+        """
+        Return sorted list of report folders under root.
+        Report folders are not searched for further report folders.
+        """
+
+        folders = []
+        todo = [os.path.abspath(root)]
+        while todo:
+            folder = todo.pop()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        continue
+                    if fnmatch.fnmatch(entry.name, self.folder_pattern):
+                        folders.append(entry.path)
+                    else:
+                        todo.append(entry.path)
+
+        return sorted(folders)
+
+    def read_identification(self, folder: str) -> dict:
+        """
+        Return identification dict for a report folder.
+        """
+
+        ids = {}
+
+        files = sorted(glob.glob(os.path.join(folder, self.header_file)))
+        if len(files) > 0:
+            try:
+                header = pyfits.getheader(files[0])
+                for key, keyword in self.header_keywords.items():
+                    if keyword in header:
+                        ids[key] = str(header[keyword]).strip()
+            except Exception as e:
+                azcam.log(f"Could not read header of {files[0]}: {e}")
+
+        for sidecar_folder in [os.path.dirname(folder), folder]:
+            sidecar = os.path.join(sidecar_folder, self.sidecar_file)
+            if os.path.exists(sidecar):
+                parser = configparser.ConfigParser()
+                parser.read(sidecar)
+                if parser.has_section("identification"):
+                    ids.update(parser["identification"])
+
+        return ids
+
+    def analyze_folder(self, folder: str) -> dict:
+        """
+        Analyze one report folder with output to a log file in that folder.
+        Returns result dict with folder, id, status, and seconds.
+        """
+
+        global identification, non_interactive
+
+        t0 = time.time()
+        ids = self.read_identification(folder)
+        sensor_id = ids.get("camera_id", ids.get("itl_sn", ""))
+
+        identification = ids
+        non_interactive = True
+
+        currentfolder = azcam.utils.curdir()
+        workers = getattr(self.detchar, "analysis_workers", 1)
+        with open(os.path.join(folder, self.log_file), "w") as log:
+            with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+                try:
+                    azcam.utils.curdir(folder)
+                    self.detchar.is_setup = 0
+                    self.detchar.analysis_workers = 1
+                    self.detchar.analyze()
+                    status = "OK"
+                except Exception as e:
+                    traceback.print_exc()
+                    status = f"ERROR {e}"
+                finally:
+                    azcam.utils.curdir(currentfolder)
+                    self.detchar.analysis_workers = workers
+                    identification = {}
+                    non_interactive = False
+
+        return {
+            "folder": folder,
+            "id": sensor_id,
+            "status": status,
+            "seconds": time.time() - t0,
+        }
+
+    def run(self, root: str = ".") -> list:
+        """
+        Analyze all report folders under root and write a summary table.
+        Returns list of result dicts.
+        """
+
+        global _active_batch
+
+        root = os.path.abspath(root)
+        folders = self.find_folders(root)
+        azcam.log(f"Found {len(folders)} report folders under {root}")
+
+        self.results = []
+        number_workers = min(self.number_workers, len(folders))
+        if number_workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            _active_batch = self
+            try:
+                with concurrent.futures.ProcessPoolExecutor(
+                    number_workers, mp_context=multiprocessing.get_context("fork")
+                ) as pool:
+                    futures = {pool.submit(_analyze_folder, f): f for f in folders}
+                    for future in concurrent.futures.as_completed(futures):
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            result = {
+                                "folder": futures[future],
+                                "id": "",
+                                "status": f"ERROR {e}",
+                                "seconds": 0.0,
+                            }
+                        azcam.log(f"{result['status']}: {result['folder']}")
+                        self.results.append(result)
+            finally:
+                _active_batch = None
+        else:
+            for folder in folders:
+                result = self.analyze_folder(folder)
+                azcam.log(f"{result['status']}: {result['folder']}")
+                self.results.append(result)
+
+        self.results.sort(key=lambda r: r["folder"])
+        self.write_summary(root)
+
+        return self.results
+
+    def write_summary(self, root: str):
+        """
+        Print and write the summary table of the last run.
+        """
+
+        lines = ["|Folder|ID|Status|Time [secs]|", "|:---|:---|:---|---:|"]
+        for r in self.results:
+            folder = os.path.relpath(r["folder"], root)
+            lines.append(f"|{folder}|{r['id']}|{r['status']}|{r['seconds']:.0f}|")
+
+        with open(os.path.join(root, self.summary_file), "w") as f:
+            for line in lines:
+                print(line)
+                f.write(line + "\n")
+
+        return
+
+
+def _analyze_folder(folder: str) -> dict:
+    """
+    Pool worker function, uses the batch inherited from the parent process.
+    """
+
+    return _active_batch.analyze_folder(folder)
+
+
+def batch_analyze(detchar, root: str = ".", number_workers: int = None) -> list:
+    """
+    Analyze all report folders under root without prompting.
+
+    Args:
+        detchar: detchar object for the system.
+        root: root folder of the shipment.
+        number_workers: number of folders analyzed in parallel, default is cpu count.
+    Returns:
+        list of result dicts.
+    """
+
+    batch = BatchAnalysis(detchar)
+    if number_workers is not None:
+        batch.number_workers = number_workers
+
+    return batch.run(root)
@@ -9,7 +9,9 @@ import azcam.utils
 import azcam.exceptions
 import azcam_console.console
 from azcam_console.testers.detchar import DetChar
+from azcam_itl import batch
 from azcam_itl import itlutils
+from azcam_itl.analysis import AnalysisContext, AnalysisPipeline, AnalysisStage
 
 
 class PrimeFocus4kDetChar(DetChar):
@@ -20,6 +22,10 @@ class PrimeFocus4kDetChar(DetChar):
     def __init__(self):
         super().__init__()
 
+        self.analysis_workers = 1  # > 1 runs independent analysis stages in parallel
+        self.analysis_cache = False  # skip analysis stages with unchanged inputs
+        self.context = None  # AnalysisContext of current analysis
+
         self.start_delay = 0
         self.start_temperature = -999.99
 
@@ -67,7 +73,7 @@ class PrimeFocus4kDetChar(DetChar):
                 id = 0
         except ValueError:
             id = 0
-        self.camera_id = azcam.utils.prompt("Enter sensor ID", f"DIEID-{id}")
+        self.camera_id = batch.ask("camera_id", "Enter sensor ID", f"DIEID-{id}")
 
         # ****************************************************************
         # Identification
@@ -77,10 +83,10 @@ class PrimeFocus4kDetChar(DetChar):
             self.camera_id = ""
             self.package_id = ""
         else:
-            self.wafer = azcam.utils.prompt("Enter wafer")
-            self.lot = azcam.utils.prompt("Enter lot")
+            self.wafer = batch.ask("wafer", "Enter wafer")
+            self.lot = batch.ask("lot", "Enter lot")
             self.device_type = "STA4850"
-            self.package_id = azcam.utils.prompt("Enter package ID")
+            self.package_id = batch.ask("package_id", "Enter package ID")
         self.report_name = f"CharacterizationReport_{self.camera_id}"
 
         # sponsor/report info
@@ -322,113 +328,50 @@ class PrimeFocus4kDetChar(DetChar):
 
         return
 
-    def analyze(self):
+    def analysis_stages(self):
         """
-        Analyze data.
+        Return the analysis stages and their dependencies.
         """
 
-        rootfolder = azcam.utils.curdir()
+        stages = [
+            AnalysisStage("bias"),
+            AnalysisStage("gain"),
+            AnalysisStage("superflat", depends=["bias", "gain"]),
+            AnalysisStage("ptc", depends=["bias"]),
+            AnalysisStage("linearity", folder="ptc", depends=["ptc"]),
+            AnalysisStage("fe55", depends=["bias"]),
+            AnalysisStage("dark", depends=["bias", "gain"]),
+            AnalysisStage("qe", depends=["bias", "gain"]),
+            AnalysisStage("prnu", folder="qe", depends=["bias", "gain"]),
+            AnalysisStage("defects", depends=["dark", "superflat"]),
+        ]
+
+        return stages
+
+    def analyze(self, folder: str = None):
+        """
+        Analyze data in report folder folder, default is the current folder.
+        Independent stages run in parallel if analysis_workers > 1.
+        """
+
+        rootfolder = azcam.utils.curdir() if folder is None else folder
 
         if not self.is_setup:
             self.setup()
 
-        # define  tools
-        (
-            gain,
-            bias,
-            detcal,
-            superflat,
-            ptc,
-            qe,
-            dark,
-            defects,
-            dark,
-            fe55,
-            prnu,
-        ) = azcam_console.utils.get_tools(
-            [
-                "gain",
-                "bias",
-                "detcal",
-                "superflat",
-                "ptc",
-                "qe",
-                "dark",
-                "defects",
-                "dark",
-                "fe55",
-                "prnu",
-            ]
+        self.context = AnalysisContext(rootfolder)
+        pipeline = AnalysisPipeline(
+            self.analysis_stages(),
+            self.context,
+            self.analysis_workers,
+            use_cache=self.analysis_cache,
         )
+        pipeline.run()
 
-        # bias
-        azcam.utils.curdir("bias")
-        bias.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # gain
-        azcam.utils.curdir("gain")
-        gain.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # superflats
-        azcam.utils.curdir("superflat")
-        superflat.analyze()
-        azcam.utils.curdir(rootfolder)
-
-        # PTC
-        azcam.utils.curdir("ptc")
-        ptc.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # linearity from PTC data
-        azcam.utils.curdir("ptc")
-        azcam.db.tools["linearity"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # Fe-55
-        azcam.utils.curdir("fe55")
-        fe55.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # darks
-        azcam.utils.curdir("dark")
-        dark.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # qe
-        azcam.utils.curdir("qe")
-        qe.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # prnu
-        azcam.utils.curdir("qe")
-        prnu.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # total defects
-        if 1:
-            fldr = os.path.abspath("./defects")
-            if os.path.exists(fldr):
-                pass
-            else:
-                os.mkdir(fldr)
-            azcam.utils.curdir("defects")
-            defects.analyze()
-            azcam.utils.curdir(rootfolder)
-            print("")
-
-        # report
-        self.make_summary_report()
-        self.make_report()
+        # make report in the report folder
+        with self.context.reporting():
+            self.make_summary_report()
+            self.make_report()
 
         return
 
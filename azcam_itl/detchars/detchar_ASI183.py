@@ -1,10 +1,8 @@
 import datetime
-import fnmatch
 import ftplib
 import glob
 import os
 import re
-import shutil
 import subprocess
 import time
 
@@ -13,14 +11,24 @@ import azcam.exceptions
 import azcam_console.console
 import azcam.utils
 from azcam_console.testers.detchar import DetChar
+from azcam_itl import batch
+from azcam_itl import fitsindex
 from azcam_itl import itlutils
+from azcam_itl.snapshots import SnapshotWorker
+from azcam_itl.analysis import AnalysisContext, AnalysisPipeline, AnalysisStage
 
 
 class ASI183DetChar(DetChar):
     def __init__(self):
         super().__init__()
 
+        self.analysis_workers = 1  # > 1 runs independent analysis stages in parallel
+        self.analysis_cache = False  # skip analysis stages with unchanged inputs
+        self.context = None  # AnalysisContext of current analysis
+
         self.imsnap_scale = 1.0
+        self.imsnap_fast = True  # subsample statistics for large frames
+        self.snapshots = SnapshotWorker()  # writes snapshots in background
         self.start_temperature = None # -15.0
 
         self.start_delay = 0
@@ -58,14 +66,14 @@ class ASI183DetChar(DetChar):
         Setup
         """
 
-        self.camera_id = azcam.utils.prompt("Enter camera ID", camera_id)
+        self.camera_id = batch.ask("camera_id", "Enter camera ID", camera_id)
 
         # sponsor/report info
         self.customer = "UASAL"
         self.system = "ASI183MM-P"
         self.summary_report_name = f"SummaryReport_{self.camera_id}"
         self.report_name = f"CharacterizationReport__ASI183_{self.camera_id}.pdf"
-        self.operator = azcam.utils.prompt("Enter operator", "lab user")
+        self.operator = batch.ask("operator", "Enter operator", "lab user")
 
         self.summary_lines = []
         self.summary_lines.append("# ITL Camera Characterization Report")
@@ -175,7 +183,7 @@ class ASI183DetChar(DetChar):
 
             # bias images
             bias.acquire()
-            itlutils.imsnap(self.imsnap_scale, "last")
+            self.snapshots.submit(self.imsnap_scale, "last", fast=self.imsnap_fast)
 
             # gain, acquire and analyze gain
             gain.find()
@@ -199,6 +207,7 @@ class ASI183DetChar(DetChar):
             dark.acquire()
 
         finally:
+            self.snapshots.flush()
             azcam.utils.restore_imagepars(impars)
             azcam.utils.curdir(currentfolder)
 
@@ -206,123 +215,55 @@ class ASI183DetChar(DetChar):
 
         return
 
-    def analyze(self):
+    def analysis_stages(self, context):
         """
-        Analyze data.
+        Return the analysis stages and their dependencies for an AnalysisContext.
         """
 
-        print("Begin analysis of ASI183 dataset")
-        rootfolder = azcam.utils.curdir()
-
-        (
-            exposure,
-            gain,
-            gainmap,
-            bias,
-            detcal,
-            superflat,
-            ptc,
-            qe,
-            dark,
-            defects,
-        ) = azcam_console.utils.get_tools(
-            [
-                "exposure",
-                "gain",
-                "gainmap",
-                "bias",
-                "detcal",
-                "superflat",
-                "ptc",
-                "qe",
-                "dark",
-                "defects",
-            ]
-        )
-
-        if not self.is_setup:
-            self.setup()
-
-        # analyze bias
-        azcam.utils.curdir("bias")
-        bias.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze gain
-        azcam.utils.curdir("gain")
-        gain.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze gain map
-        if 0:
-            azcam.utils.curdir("gainmap")
-            gainmap.analyze()
-            azcam.utils.curdir(rootfolder)
-            print("")
-
-        # analyze darks
-        azcam.utils.curdir("dark")
-        dark.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze superflats
-        azcam.utils.curdir("superflat1")
-        try:
-            superflat.analyze()
-        except Exception:
-            azcam.utils.curdir(rootfolder)
-            azcam.utils.curdir("superflat")
-            superflat.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        if os.path.exists(context.folder("superflat1")):
+            superflat_folder = "superflat1"
+        else:
+            superflat_folder = "superflat"
+
+        stages = [
+            AnalysisStage("bias"),
+            AnalysisStage("gain"),
+            AnalysisStage("dark", depends=["bias", "gain"]),
+            AnalysisStage("superflat", folder=superflat_folder, depends=["bias", "gain"]),
+            AnalysisStage("ptc", depends=["bias"]),
+            AnalysisStage("linearity", folder="ptc", depends=["ptc"]),
+            AnalysisStage("qe", depends=["bias", "gain"]),
+            AnalysisStage("prnu", depends=["bias", "gain"]),
+            AnalysisStage("defects", depends=["dark", "superflat"]),
+        ]
 
-        # analyze PTC
-        azcam.utils.curdir("ptc")
-        ptc.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        return stages
 
-        # analyze linearity from PTC data
-        azcam.utils.curdir("ptc")
-        try:
-            azcam.db.tools["linearity"].analyze()
-        except Exception:
-            azcam.utils.curdir(rootfolder)
-            azcam.utils.curdir("ptc")
-            azcam.db.tools["linearity"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+    def analyze(self, folder: str = None):
+        """
+        Analyze data in report folder folder, default is the current folder.
+        Independent stages run in parallel if analysis_workers > 1.
+        """
 
-        # analyze qe
-        azcam.utils.curdir("qe")
-        azcam.db.tools["qe"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        print("Begin analysis of ASI183 dataset")
+        rootfolder = azcam.utils.curdir() if folder is None else folder
 
-        # analyze prnu
-        azcam.utils.curdir("prnu")
-        azcam.db.tools["prnu"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        if not self.is_setup:
+            self.setup()
 
-        # total defects
-        if 1:
-            fldr = os.path.abspath("./defects")
-            if os.path.exists(fldr):
-                pass
-            else:
-                os.mkdir(fldr)
-            azcam.utils.curdir("defects")
-            defects.analyze()
-            azcam.utils.curdir(rootfolder)
-            print("")
+        self.context = AnalysisContext(rootfolder)
+        pipeline = AnalysisPipeline(
+            self.analysis_stages(self.context),
+            self.context,
+            self.analysis_workers,
+            use_cache=self.analysis_cache,
+        )
+        pipeline.run()
 
-        # make report
-        self.make_summary_report()
-        self.make_report()
+        # make report in the report folder
+        with self.context.reporting():
+            self.make_summary_report()
+            self.make_report()
 
         return
 
@@ -347,10 +288,9 @@ class ASI183DetChar(DetChar):
         folder = azcam.utils.curdir()
         dest_folder = azcam.utils.curdir()
         azcam.utils.curdir(folder)
-        matches = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, "qe.0004.fits"):
-                matches.append(os.path.join(root, filename))
+        index = fitsindex.get_index(folder, update=True)
+        matches = index.find("qe.0004.fits")
+        copies = []
 
         for t in matches:
             match = re.search("sn", t)
@@ -362,10 +302,12 @@ class ASI183DetChar(DetChar):
                 key = azcam.utils.check_keyboard(1)
                 if key == "y" or key == "\r":
                     print()
-                    shutil.copy(t, os.path.join(dest_folder, "%s_flat.fits" % (sn)))
+                    copies.append((t, os.path.join(dest_folder, "%s_flat.fits" % (sn))))
                 else:
                     print("File not copied")
 
+        itlutils.copy_file_list(copies)
+
         return
 
     def copy_reports(self):
@@ -378,20 +320,21 @@ class ASI183DetChar(DetChar):
         folder = azcam.utils.curdir()
         dest_folder = azcam.utils.curdir()
         azcam.utils.curdir(folder)
-        matches = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, "ASI183_Report_*.pdf"):
-                matches.append(os.path.join(root, filename))
+        index = fitsindex.get_index(folder, update=True)
+        matches = index.find("ASI183_Report_*.pdf")
+        copies = []
 
         for t in matches:
             print("Found: ", t)
             print("Press y or enter to copy this file...")
             key = azcam.utils.check_keyboard(1)
             if key == "y" or key == "\r":
-                shutil.copy(t, dest_folder)
+                copies.append((t, dest_folder))
             else:
                 print("File not copied")
 
+        itlutils.copy_file_list(copies)
+
         return
 
 # ****************************************************************
@@ -1,10 +1,8 @@
 import datetime
-import fnmatch
 import ftplib
 import glob
 import os
 import re
-import shutil
 import subprocess
 import time
 
@@ -12,14 +10,26 @@ import azcam
 import azcam_console.console
 import azcam.utils
 from azcam_console.testers.detchar import DetChar
+from azcam_itl import batch
+from azcam_itl import fitsindex
 from azcam_itl import itlutils
+from azcam_itl.snapshots import SnapshotWorker
+from azcam_itl.analysis import AnalysisContext, AnalysisPipeline, AnalysisStage
+from azcam_itl.instruments import wavelength_schedule
 
 
 class ASI294DetChar(DetChar):
     def __init__(self):
         super().__init__()
 
+        self.analysis_workers = 1  # > 1 runs independent analysis stages in parallel
+        self.analysis_cache = False  # skip analysis stages with unchanged inputs
+        self.context = None  # AnalysisContext of current analysis
+        self.qe_flux_log = False  # log power meter flux of QE exposures
+
         self.imsnap_scale = 1.0
+        self.imsnap_fast = True  # subsample statistics for large frames
+        self.snapshots = SnapshotWorker()  # writes snapshots in background
         self.start_temperature = None #-15.0
 
         self.start_delay = 0
@@ -59,14 +69,14 @@ class ASI294DetChar(DetChar):
 
         # camera_id="1812911309020900"
 
-        self.camera_id = azcam.utils.prompt("Enter camera ID", camera_id)
+        self.camera_id = batch.ask("camera_id", "Enter camera ID", camera_id)
 
         # sponsor/report info
         self.customer = "UASAL"
         self.system = "ASI294MM-P"
         self.summary_report_name = f"SummaryReport_{self.camera_id}"
         self.report_name = f"CharacterizationReport__ASI294_{self.camera_id}.pdf"
-        self.operator = azcam.utils.prompt("Enter operator", "lab user")
+        self.operator = batch.ask("operator", "Enter operator", "lab user")
 
         self.summary_lines = []
         self.summary_lines.append("# ITL Camera Characterization Report")
@@ -176,7 +186,7 @@ class ASI294DetChar(DetChar):
 
             # bias images
             bias.acquire()
-            itlutils.imsnap(self.imsnap_scale, "last")
+            self.snapshots.submit(self.imsnap_scale, "last", fast=self.imsnap_fast)
 
             # gain, acquire and analyze gain
             gain.find()
@@ -184,8 +194,17 @@ class ASI294DetChar(DetChar):
             # gainmap
             gainmap.acquire()
 
-            # Prnu images
-            azcam.db.tools["prnu"].acquire()
+            # Prnu images in order of fewest monochromator moves from the gainmap
+            # wavelength, monochromator moves during readout
+            prnu = azcam.db.tools["prnu"]
+            with wavelength_schedule.scheduled(
+                prnu,
+                "exposure_levels",
+                gainmap.wavelength,
+                os.path.join(reportfolder, "prnu"),
+            ) as wavelengths:
+                with wavelength_schedule.sweep(wavelengths):
+                    prnu.acquire()
 
             # superflat sequence
             superflat.acquire()
@@ -194,12 +213,23 @@ class ASI294DetChar(DetChar):
             ptc.acquire()
 
             # QE
-            qe.acquire()
+            flux_log = None
+            if self.qe_flux_log:
+                flux_log = os.path.join(reportfolder, "qe_flux.bin")
+            with wavelength_schedule.scheduled(
+                qe,
+                "exposure_levels",
+                ptc.wavelength,
+                os.path.join(reportfolder, "qe"),
+            ) as wavelengths:
+                with wavelength_schedule.sweep(wavelengths, flux_log):
+                    qe.acquire()
 
             # Dark signal
             dark.acquire()
 
         finally:
+            self.snapshots.flush()
             azcam.utils.restore_imagepars(impars)
             azcam.utils.curdir(currentfolder)
 
@@ -207,122 +237,54 @@ class ASI294DetChar(DetChar):
 
         return
 
-    def analyze(self):
+    def analysis_stages(self, context):
         """
-        Analyze data.
+        Return the analysis stages and their dependencies for an AnalysisContext.
         """
 
-        rootfolder = azcam.utils.curdir()
-
-        if not self.is_setup:
-            self.setup()
-
-        (
-            exposure,
-            gain,
-            gainmap,
-            bias,
-            detcal,
-            superflat,
-            ptc,
-            qe,
-            dark,
-            defects,
-        ) = azcam_console.utils.get_tools(
-            [
-                "exposure",
-                "gain",
-                "gainmap",
-                "bias",
-                "detcal",
-                "superflat",
-                "ptc",
-                "qe",
-                "dark",
-                "defects",
-            ]
-        )
-
-        # analyze bias
-        azcam.utils.curdir("bias")
-        bias.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze gain
-        azcam.utils.curdir("gain")
-        gain.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze gain map
-        if 0:
-            azcam.utils.curdir("gainmap")
-            gainmap.analyze()
-            azcam.utils.curdir(rootfolder)
-            print("")
-
-        # analyze darks
-        azcam.utils.curdir("dark")
-        dark.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze superflats
-        azcam.utils.curdir("superflat1")
-        try:
-            superflat.analyze()
-        except Exception:
-            azcam.utils.curdir(rootfolder)
-            azcam.utils.curdir("superflat")
-            superflat.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        if os.path.exists(context.folder("superflat1")):
+            superflat_folder = "superflat1"
+        else:
+            superflat_folder = "superflat"
+
+        stages = [
+            AnalysisStage("bias"),
+            AnalysisStage("gain"),
+            AnalysisStage("dark", depends=["bias", "gain"]),
+            AnalysisStage("superflat", folder=superflat_folder, depends=["bias", "gain"]),
+            AnalysisStage("ptc", depends=["bias"]),
+            AnalysisStage("linearity", folder="ptc", depends=["ptc"]),
+            AnalysisStage("qe", depends=["bias", "gain"]),
+            AnalysisStage("prnu", depends=["bias", "gain"]),
+            AnalysisStage("defects", depends=["dark", "superflat"]),
+        ]
 
-        # analyze PTC
-        azcam.utils.curdir("ptc")
-        ptc.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        return stages
 
-        # analyze linearity from PTC data
-        azcam.utils.curdir("ptc")
-        try:
-            azcam.db.tools["linearity"].analyze()
-        except Exception:
-            azcam.utils.curdir(rootfolder)
-            azcam.utils.curdir("ptc")
-            azcam.db.tools["linearity"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+    def analyze(self, folder: str = None):
+        """
+        Analyze data in report folder folder, default is the current folder.
+        Independent stages run in parallel if analysis_workers > 1.
+        """
 
-        # analyze qe
-        azcam.utils.curdir("qe")
-        azcam.db.tools["qe"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        rootfolder = azcam.utils.curdir() if folder is None else folder
 
-        # analyze prnu
-        azcam.utils.curdir("prnu")
-        azcam.db.tools["prnu"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        if not self.is_setup:
+            self.setup()
 
-        # total defects
-        if 1:
-            fldr = os.path.abspath("./defects")
-            if os.path.exists(fldr):
-                pass
-            else:
-                os.mkdir(fldr)
-            azcam.utils.curdir("defects")
-            defects.analyze()
-            azcam.utils.curdir(rootfolder)
-            print("")
+        self.context = AnalysisContext(rootfolder)
+        pipeline = AnalysisPipeline(
+            self.analysis_stages(self.context),
+            self.context,
+            self.analysis_workers,
+            use_cache=self.analysis_cache,
+        )
+        pipeline.run()
 
-        # make report
-        self.make_summary_report()
-        self.make_report()
+        # make report in the report folder
+        with self.context.reporting():
+            self.make_summary_report()
+            self.make_report()
 
         return
 
@@ -347,10 +309,9 @@ class ASI294DetChar(DetChar):
         folder = azcam.utils.curdir()
         dest_folder = azcam.utils.curdir()
         azcam.utils.curdir(folder)
-        matches = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, "qe.0004.fits"):
-                matches.append(os.path.join(root, filename))
+        index = fitsindex.get_index(folder, update=True)
+        matches = index.find("qe.0004.fits")
+        copies = []
 
         for t in matches:
             match = re.search("sn", t)
@@ -362,10 +323,12 @@ class ASI294DetChar(DetChar):
                 key = azcam.utils.check_keyboard(1)
                 if key == "y" or key == "\r":
                     print()
-                    shutil.copy(t, os.path.join(dest_folder, "%s_flat.fits" % (sn)))
+                    copies.append((t, os.path.join(dest_folder, "%s_flat.fits" % (sn))))
                 else:
                     print("File not copied")
 
+        itlutils.copy_file_list(copies)
+
         return
 
     def copy_reports(self):
@@ -378,20 +341,21 @@ class ASI294DetChar(DetChar):
         folder = azcam.utils.curdir()
         dest_folder = azcam.utils.curdir()
         azcam.utils.curdir(folder)
-        matches = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, "ASI294_Report_*.pdf"):
-                matches.append(os.path.join(root, filename))
+        index = fitsindex.get_index(folder, update=True)
+        matches = index.find("ASI294_Report_*.pdf")
+        copies = []
 
         for t in matches:
             print("Found: ", t)
             print("Press y or enter to copy this file...")
             key = azcam.utils.check_keyboard(1)
             if key == "y" or key == "\r":
-                shutil.copy(t, dest_folder)
+                copies.append((t, dest_folder))
             else:
                 print("File not copied")
 
+        itlutils.copy_file_list(copies)
+
         return
     
 # ****************************************************************
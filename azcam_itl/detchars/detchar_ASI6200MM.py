@@ -1,5 +1,4 @@
 import datetime
-import fnmatch
 import ftplib
 import glob
 import os
@@ -14,14 +13,24 @@ import azcam
 import azcam.utils
 import azcam_console.console
 from azcam_console.testers.detchar import DetChar
+from azcam_itl import batch
+from azcam_itl import fitsindex
 from azcam_itl import itlutils
+from azcam_itl.snapshots import SnapshotWorker
+from azcam_itl.analysis import AnalysisContext, AnalysisPipeline, AnalysisStage
 
 
 class ASI6200MMDetChar(DetChar):
     def __init__(self):
         super().__init__()
 
+        self.analysis_workers = 1  # > 1 runs independent analysis stages in parallel
+        self.analysis_cache = False  # skip analysis stages with unchanged inputs
+        self.context = None  # AnalysisContext of current analysis
+
         self.imsnap_scale = 1.0
+        self.imsnap_fast = True  # subsample statistics for large frames
+        self.snapshots = SnapshotWorker()  # writes snapshots in background
         self.start_temperature = -10.0
 
         self.operator = "Lesser"
@@ -66,8 +75,8 @@ class ASI6200MMDetChar(DetChar):
 
     def setup(self, camera_id=None):
 
-        self.camera_id = azcam.utils.prompt("Enter camera ID", itl_sn)
-        self.operator = azcam.utils.prompt("Enter your initals", "mpl")
+        self.camera_id = batch.ask("camera_id", "Enter camera ID", itl_sn)
+        self.operator = batch.ask("operator", "Enter your initals", "mpl")
 
         # sponsor/report info
         self.customer = "UArizona"
@@ -186,7 +195,7 @@ class ASI6200MMDetChar(DetChar):
 
             # bias images
             bias.acquire()
-            itlutils.imsnap(self.imsnap_scale, "last")
+            self.snapshots.submit(self.imsnap_scale, "last", fast=self.imsnap_fast)
 
             # gain images
             # gain.find()
@@ -212,6 +221,7 @@ class ASI6200MMDetChar(DetChar):
                 print("Close shutter and run dark.acquire()")
 
         finally:
+            self.snapshots.flush()
             azcam.utils.restore_imagepars(impars)
             azcam.utils.curdir(currentfolder)
 
@@ -219,105 +229,49 @@ class ASI6200MMDetChar(DetChar):
 
         return
 
-    def analyze(self, report_id="unknown"):
+    def analysis_stages(self):
         """
-        Analyze data.
+        Return the analysis stages and their dependencies.
         """
 
-        rootfolder = azcam.utils.curdir()
-
-        (
-            exposure,
-            gain,
-            bias,
-            detcal,
-            superflat,
-            ptc,
-            qe,
-            dark,
-            defects,
-            linearity,
-        ) = azcam_console.utils.get_tools(
-            [
-                "exposure",
-                "gain",
-                "bias",
-                "detcal",
-                "superflat",
-                "ptc",
-                "qe",
-                "dark",
-                "defects",
-                "linearity",
-            ]
-        )
-
-        if not self.is_setup:
-            self.setup(report_id)
-
-        # analyze bias
-        azcam.utils.curdir("bias")
-        bias.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze gain
-        azcam.utils.curdir("gain")
-        gain.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze superflats
-        azcam.utils.curdir("superflat")
-        superflat.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze PTC
-        azcam.utils.curdir("ptc")
-        ptc.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        stages = [
+            AnalysisStage("bias"),
+            AnalysisStage("gain"),
+            AnalysisStage("superflat", depends=["bias", "gain"]),
+            AnalysisStage("ptc", depends=["bias"]),
+            AnalysisStage("linearity", folder="ptc", depends=["ptc"]),
+            AnalysisStage("dark", depends=["bias", "gain"]),
+            AnalysisStage("qe", depends=["bias", "gain"]),
+            AnalysisStage("prnu", depends=["bias", "gain"]),
+            AnalysisStage("defects", depends=["dark", "superflat"]),
+        ]
 
-        # analyze linearity from PTC data
-        azcam.utils.curdir("ptc")
-        linearity.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        return stages
 
-        # analyze darks
-        azcam.utils.curdir("dark")
-        dark.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+    def analyze(self, report_id="unknown", folder: str = None):
+        """
+        Analyze data in report folder folder, default is the current folder.
+        Independent stages run in parallel if analysis_workers > 1.
+        """
 
-        # analyze qe
-        azcam.utils.curdir("qe")
-        azcam.db.tools["qe"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        rootfolder = azcam.utils.curdir() if folder is None else folder
 
-        # analyze prnu
-        azcam.utils.curdir("prnu")
-        azcam.db.tools["prnu"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        if not self.is_setup:
+            self.setup(report_id)
 
-        # total defects
-        if 1:
-            fldr = os.path.abspath("./defects")
-            if os.path.exists(fldr):
-                pass
-            else:
-                os.mkdir(fldr)
-            azcam.utils.curdir("defects")
-            defects.analyze()
-            azcam.utils.curdir(rootfolder)
-            print("")
+        self.context = AnalysisContext(rootfolder)
+        pipeline = AnalysisPipeline(
+            self.analysis_stages(),
+            self.context,
+            self.analysis_workers,
+            use_cache=self.analysis_cache,
+        )
+        pipeline.run()
 
-        # make report
-        self.make_summary_report()
-        self.make_report()
+        # make report in the report folder
+        with self.context.reporting():
+            self.make_summary_report()
+            self.make_report()
 
         return
 
@@ -343,10 +297,9 @@ class ASI6200MMDetChar(DetChar):
         folder = azcam.utils.curdir()
         dest_folder = azcam.utils.curdir()
         azcam.utils.curdir(folder)
-        matches = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, "qe.0004.fits"):
-                matches.append(os.path.join(root, filename))
+        index = fitsindex.get_index(folder, update=True)
+        matches = index.find("qe.0004.fits")
+        copies = []
 
         for t in matches:
             match = re.search("sn", t)
@@ -358,10 +311,12 @@ class ASI6200MMDetChar(DetChar):
                 key = azcam.utils.check_keyboard(1)
                 if key == "y" or key == "\r":
                     print()
-                    shutil.copy(t, os.path.join(dest_folder, "%s_flat.fits" % (sn)))
+                    copies.append((t, os.path.join(dest_folder, "%s_flat.fits" % (sn))))
                 else:
                     print("File not copied")
 
+        itlutils.copy_file_list(copies)
+
         return
 
     def copy_reports(self):
@@ -374,20 +329,21 @@ class ASI6200MMDetChar(DetChar):
         folder = azcam.utils.curdir()
         dest_folder = azcam.utils.curdir()
         azcam.utils.curdir(folder)
-        matches = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, "ASI6200MM_Report_*.pdf"):
-                matches.append(os.path.join(root, filename))
+        index = fitsindex.get_index(folder, update=True)
+        matches = index.find("ASI6200MM_Report_*.pdf")
+        copies = []
 
         for t in matches:
             print("Found: ", t)
             print("Press y or enter to copy this file...")
             key = azcam.utils.check_keyboard(1)
             if key == "y" or key == "\r":
-                shutil.copy(t, dest_folder)
+                copies.append((t, dest_folder))
             else:
                 print("File not copied")
 
+        itlutils.copy_file_list(copies)
+
         return
 
     def upload_prep(self, shipdate: str):
@@ -1,7 +1,6 @@
 import datetime
 import os
 import time
-import shutil
 
 import azcam
 import azcam.utils
@@ -9,7 +8,10 @@ import azcam.exceptions
 import azcam_console.console
 import azcam_console.plot
 from azcam_console.testers.detchar import DetChar
+from azcam_itl import archiver
+from azcam_itl import batch
 from azcam_itl import itlutils
+from azcam_itl.analysis import AnalysisContext, AnalysisPipeline, AnalysisStage
 
 
 class DesiDetCharClass(DetChar):
@@ -20,6 +22,10 @@ class DesiDetCharClass(DetChar):
     def __init__(self):
         super().__init__()
 
+        self.analysis_workers = 1  # > 1 runs independent analysis stages in parallel
+        self.analysis_cache = False  # skip analysis stages with unchanged inputs
+        self.context = None  # AnalysisContext of current analysis
+
         self.device_type = ""
         self.lot = "UNKNOWN"
         self.wafer = "UNKNOWN"
@@ -70,7 +76,7 @@ class DesiDetCharClass(DetChar):
                 id = 0
         except ValueError:
             id = 0
-        self.camera_id = azcam.utils.prompt("Enter sensor ID", f"DIEID-{id}")
+        self.camera_id = batch.ask("camera_id", "Enter sensor ID", f"DIEID-{id}")
 
         # ****************************************************************
         # Identification
@@ -81,13 +87,13 @@ class DesiDetCharClass(DetChar):
             self.package_id = "UNKNOWN"
         else:
             self.device_type = "STA4150"
-            self.lot = azcam.utils.prompt("Enter lot", "232139")
-            self.wafer = azcam.utils.prompt("Enter wafer")
-            self.package_id = azcam.utils.prompt("Enter package ID")
-        self.coating = azcam.utils.prompt("Enter AR coating (RED or BLUE)", "UNKNOWN").upper()
+            self.lot = batch.ask("lot", "Enter lot", "232139")
+            self.wafer = batch.ask("wafer", "Enter wafer")
+            self.package_id = batch.ask("package_id", "Enter package ID")
+        self.coating = batch.ask("coating", "Enter AR coating (RED or BLUE)", "UNKNOWN").upper()
         self.report_name = f"CharacterizationReport_{self.camera_id}"
 
-        self.operator = azcam.utils.prompt("Enter operator", "lab user")
+        self.operator = batch.ask("operator", "Enter operator", "lab user")
 
         # fixed info
         self.die = 1
@@ -256,92 +262,58 @@ class DesiDetCharClass(DetChar):
 
         return
 
-    def analyze(self):
+    def analysis_stages(self):
         """
-        Analyze data.
+        Return the analysis stages and their dependencies.
+        Stages after Fe-55 use the Fe-55 gain if use_fe55_gain is set.
         """
 
-        rootfolder = azcam.utils.curdir()
+        if self.use_fe55_gain:
+            gain_stages = ["gain", "fe55"]
+            prepare = [("gain", "fe55_gain")]
+        else:
+            gain_stages = ["gain"]
+            prepare = []
+
+        stages = [
+            AnalysisStage("bias"),
+            AnalysisStage("gain"),
+            AnalysisStage("fe55", depends=["bias"]),
+            AnalysisStage("dark", depends=["bias"] + gain_stages, prepare=prepare),
+            AnalysisStage(
+                "superflat", depends=["bias"] + gain_stages, prepare=prepare
+            ),
+            AnalysisStage("ptc", depends=["bias"] + gain_stages, prepare=prepare),
+            AnalysisStage(
+                "linearity", folder="ptc", depends=["ptc"], prepare=prepare
+            ),
+            AnalysisStage("qe", depends=["bias"] + gain_stages, prepare=prepare),
+            AnalysisStage(
+                "prnu",
+                folder="qe",
+                depends=["bias"] + gain_stages,
+                prepare=prepare,
+            ),
+            AnalysisStage(
+                "defects", depends=["dark", "superflat"], prepare=prepare
+            ),
+        ]
+
+        return stages
+
+    def analyze(self, folder: str = None):
+        """
+        Analyze data in report folder folder, default is the current folder.
+        Independent stages run in parallel if analysis_workers > 1.
+        """
+
+        rootfolder = azcam.utils.curdir() if folder is None else folder
 
         if not self.is_setup:
             self.setup()
 
-        # define  tools
-        (
-            gain,
-            bias,
-            detcal,
-            superflat,
-            ptc,
-            qe,
-            dark,
-            defects,
-            dark,
-            fe55,
-            prnu,
-        ) = azcam_console.utils.get_tools(
-            [
-                "gain",
-                "bias",
-                "detcal",
-                "superflat",
-                "ptc",
-                "qe",
-                "dark",
-                "defects",
-                "dark",
-                "fe55",
-                "prnu",
-            ]
-        )
+        qe = azcam.db.tools["qe"]
 
-        # bias
-        azcam.utils.curdir("bias")
-        bias.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # gain
-        azcam.utils.curdir("gain")
-        gain.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # Fe-55
-        azcam.utils.curdir("fe55")
-        fe55.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # use fe55 gain from now on
-        if self.use_fe55_gain:
-            gain.fe55_gain()
-
-        # darks
-        azcam.utils.curdir("dark")
-        dark.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # superflats
-        azcam.utils.curdir("superflat")
-        superflat.analyze()
-        azcam.utils.curdir(rootfolder)
-
-        # PTC
-        azcam.utils.curdir("ptc")
-        ptc.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # linearity from PTC data
-        azcam.utils.curdir("ptc")
-        linearity.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # qe
-        azcam.utils.curdir("qe")
         # spec for DESI Blue: 360-400 > 75%, 400-600 > 85%
         # spec for DESI Red: 600-750 > 85%
         if self.coating.upper() == "BLUE":
@@ -361,31 +333,20 @@ class DesiDetCharClass(DetChar):
         else:
             azcam.log("Unknown AR coating, QE specs set to 0")
             qe.qe_specs = {w:0 for w in qe.wavelengths}
-        qe.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # prnu
-        azcam.utils.curdir("qe")
-        prnu.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # total defects
-        if 1:
-            fldr = os.path.abspath("./defects")
-            if os.path.exists(fldr):
-                pass
-            else:
-                os.mkdir(fldr)
-            azcam.utils.curdir("defects")
-            defects.analyze()
-            azcam.utils.curdir(rootfolder)
-            print("")
 
-        # report
-        self.make_summary_report()
-        self.make_report()
+        self.context = AnalysisContext(rootfolder)
+        pipeline = AnalysisPipeline(
+            self.analysis_stages(),
+            self.context,
+            self.analysis_workers,
+            use_cache=self.analysis_cache,
+        )
+        pipeline.run()
+
+        # make report in the report folder
+        with self.context.reporting():
+            self.make_summary_report()
+            self.make_report()
 
         return
 
@@ -414,21 +375,12 @@ class DesiDetCharClass(DetChar):
         azcam.log("cleaning dataset folder")
         itlutils.cleanup_files(pathname)
 
-        # copy folder to new name
-        azcam.log(f"copying dataset to {idstring}")
-        # shutil.copytree(os.path.basename(pathname), idstring)
-        shutil.copytree(pathname, idstring)
-
-        # make tar file
+        # make tar file with dataset renamed in the archive
         azcam.log(f"making tar file: {idstring}.tar")
-        tarfile = itlutils.archive(idstring, "tar")
+        tarfile = archiver.make_archive(pathname, f"{idstring}.tar", idstring)
 
         azcam.utils.curdir(cd)
 
-        # Remove the copied folder
-        azcam.log(f"Removing copied folder {idstring}")
-        shutil.rmtree(idstring)
-
         return tarfile
 
 
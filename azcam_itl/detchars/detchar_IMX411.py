@@ -11,14 +11,23 @@ import azcam
 import azcam.utils
 import azcam_console.console
 from azcam_console.testers.detchar import DetChar
+from azcam_itl import batch
 from azcam_itl import itlutils
+from azcam_itl.snapshots import SnapshotWorker
+from azcam_itl.analysis import AnalysisContext, AnalysisPipeline, AnalysisStage
 
 
 class IMX411DetChar(DetChar):
     def __init__(self):
         super().__init__()
 
+        self.analysis_workers = 1  # > 1 runs independent analysis stages in parallel
+        self.analysis_cache = False  # skip analysis stages with unchanged inputs
+        self.context = None  # AnalysisContext of current analysis
+
         self.imsnap_scale = 1.0
+        self.imsnap_fast = True  # subsample statistics for large frames
+        self.snapshots = SnapshotWorker()  # writes snapshots in background
         self.start_temperature = 0.0
 
         self.operator = ""
@@ -64,7 +73,7 @@ class IMX411DetChar(DetChar):
     def setup(self, camera_id=""):
 
         if camera_id == "":
-            self.camera_id = azcam.utils.prompt("Enter camera ID", camera_id)
+            self.camera_id = batch.ask("camera_id", "Enter camera ID", camera_id)
 
         # sponsor/report info
         self.customer = "UArizona"
@@ -186,7 +195,7 @@ class IMX411DetChar(DetChar):
 
             # bias images
             bias.acquire()
-            itlutils.imsnap(self.imsnap_scale, "last")
+            self.snapshots.submit(self.imsnap_scale, "last", fast=self.imsnap_fast)
 
             # gain images
             gain.find()
@@ -211,6 +220,7 @@ class IMX411DetChar(DetChar):
                 print("Close shutter and run dark.acquire()")
 
         finally:
+            self.snapshots.flush()
             azcam.utils.restore_imagepars(impars)
             azcam.utils.curdir(currentfolder)
 
@@ -218,105 +228,49 @@ class IMX411DetChar(DetChar):
 
         return
 
-    def analyze(self, report_id="unknown"):
+    def analysis_stages(self):
         """
-        Analyze data.
+        Return the analysis stages and their dependencies.
         """
 
-        rootfolder = azcam.utils.curdir()
-
-        (
-            exposure,
-            gain,
-            bias,
-            detcal,
-            superflat,
-            ptc,
-            qe,
-            dark,
-            defects,
-            linearity,
-        ) = azcam_console.utils.get_tools(
-            [
-                "exposure",
-                "gain",
-                "bias",
-                "detcal",
-                "superflat",
-                "ptc",
-                "qe",
-                "dark",
-                "defects",
-                "linearity",
-            ]
-        )
-
-        if not self.is_setup:
-            self.setup(report_id)
-
-        # analyze bias
-        azcam.utils.curdir("bias")
-        bias.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze gain
-        azcam.utils.curdir("gain")
-        gain.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
-
-        # analyze superflats
-        azcam.utils.curdir("superflat")
-        superflat.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        stages = [
+            AnalysisStage("bias"),
+            AnalysisStage("gain"),
+            AnalysisStage("superflat", depends=["bias", "gain"]),
+            AnalysisStage("ptc", depends=["bias"]),
+            AnalysisStage("linearity", folder="ptc", depends=["ptc"]),
+            AnalysisStage("dark", depends=["bias", "gain"]),
+            AnalysisStage("qe", depends=["bias", "gain"]),
+            AnalysisStage("prnu", depends=["bias", "gain"]),
+            AnalysisStage("defects", depends=["dark", "superflat"]),
+        ]
 
-        # analyze PTC
-        azcam.utils.curdir("ptc")
-        ptc.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        return stages
 
-        # analyze linearity from PTC data
-        azcam.utils.curdir("ptc")
-        linearity.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+    def analyze(self, report_id="unknown", folder: str = None):
+        """
+        Analyze data in report folder folder, default is the current folder.
+        Independent stages run in parallel if analysis_workers > 1.
+        """
 
-        # analyze darks
-        azcam.utils.curdir("dark")
-        dark.analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        rootfolder = azcam.utils.curdir() if folder is None else folder
 
-        # analyze qe
-        azcam.utils.curdir("qe")
-        azcam.db.tools["qe"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        if not self.is_setup:
+            self.setup(report_id)
 
-        # analyze prnu
-        azcam.utils.curdir("prnu")
-        azcam.db.tools["prnu"].analyze()
-        azcam.utils.curdir(rootfolder)
-        print("")
+        self.context = AnalysisContext(rootfolder)
+        pipeline = AnalysisPipeline(
+            self.analysis_stages(),
+            self.context,
+            self.analysis_workers,
+            use_cache=self.analysis_cache,
+        )
+        pipeline.run()
 
-        # total defects
-        if 1:
-            fldr = os.path.abspath("./defects")
-            if os.path.exists(fldr):
-                pass
-            else:
-                os.mkdir(fldr)
-            azcam.utils.curdir("defects")
-            defects.analyze()
-            azcam.utils.curdir(rootfolder)
-            print("")
-
-        # make report
-        self.make_summary_report()
-        self.make_report()
+        # make report in the report folder
+        with self.context.reporting():
+            self.make_summary_report()
+            self.make_report()
 
         return
 
@@ -1,16 +1,16 @@
 import datetime
-import fnmatch
 import os
-import shutil
 import subprocess
 import time
 
-from astropy.io import fits as pyfits
-
 import azcam
 import azcam_console
 from azcam_console.testers.detchar import DetChar
+from azcam_itl import batch
+from azcam_itl import fitsindex
 from azcam_itl import itlutils
+from azcam_itl.analysis import AnalysisContext, AnalysisPipeline, AnalysisStage
+from azcam_itl.instruments import wavelength_schedule
 
 
 class LVMDetChar(DetChar):
@@ -21,6 +21,11 @@ class LVMDetChar(DetChar):
     def __init__(self):
         super().__init__()
 
+        self.analysis_workers = 1  # > 1 runs independent analysis stages in parallel
+        self.analysis_cache = False  # skip analysis stages with unchanged inputs
+        self.context = None  # AnalysisContext of current analysis
+        self.qe_flux_log = False  # log power meter flux of QE exposures
+
         self.LVM_2amps = 0
         self.LVM_nearir = 0
 
@@ -165,9 +170,21 @@ class LVMDetChar(DetChar):
             azcam.db.parameters.restore_imagepars(impars)
             azcam.utils.curdir(currentfolder)
 
-        # QE sequence
+        # QE sequence in order of fewest monochromator moves from the superflat
+        # wavelength, monochromator moves during readout
         try:
-            azcam.db.tools["qe"].acquire()
+            qe = azcam.db.tools["qe"]
+            flux_log = None
+            if self.qe_flux_log:
+                flux_log = os.path.join(reportfolder, "qe_flux.bin")
+            with wavelength_schedule.scheduled(
+                qe,
+                "exposure_times",
+                azcam.db.tools["superflat"].wavelength,
+                os.path.join(reportfolder, "qe"),
+            ) as wavelengths:
+                with wavelength_schedule.sweep(wavelengths, flux_log):
+                    qe.acquire()
         except Exception as e:
             azcam.log(e)
             azcam.db.parameters.restore_imagepars(impars)
@@ -255,85 +272,103 @@ class LVMDetChar(DetChar):
 
         return
 
-    def analyze(self):
+    def analysis_stages(self):
         """
-        Analyze entire sequence of data for LVM.
+        Return the analysis stages and their dependencies.
+        Stages after Fe-55 use the Fe-55 gain if use_fe55_gain is set.
         """
 
-        self.setup_analyze()
+        if self.use_fe55_gain:
+            gain_stages = ["gain", "fe55"]
+            prepare = [("gain", "fe55_gain")]
+        else:
+            gain_stages = ["gain"]
+            prepare = []
+
+        stages = [
+            # raw bias
+            AnalysisStage("bias"),
+            # gain (no masks)
+            AnalysisStage("gain"),
+            # Fe-55 (used for gain below) (no masks)
+            AnalysisStage("fe55", depends=["bias"]),
+            # superflat (no masks)
+            AnalysisStage(
+                "superflat", depends=["bias"] + gain_stages, prepare=prepare
+            ),
+            # PTC (no masks)
+            AnalysisStage(
+                "ptc",
+                depends=["bias"] + gain_stages,
+                prepare=prepare,
+                exports=["analysis_folder"],
+            ),
+            # linearity from ptc data (no masks), in the folder set by ptc analysis
+            AnalysisStage(
+                "linearity",
+                folder="{ptc.analysis_folder}",
+                methods=["analyze", "copy_data_files"],
+                depends=["ptc"],
+                prepare=prepare,
+            ),
+            # darks (only edge mask used)
+            AnalysisStage("dark", depends=["bias"] + gain_stages, prepare=prepare),
+            # defects, defect mask valid after this
+            AnalysisStage(
+                "brightdefects",
+                tool="defects",
+                folder="dark",
+                methods=["analyze_bright_defects", "copy_data_files"],
+                depends=["dark"],
+                prepare=prepare,
+            ),
+            AnalysisStage(
+                "darkdefects",
+                tool="defects",
+                folder="superflat",
+                methods=["analyze_dark_defects", "copy_data_files"],
+                depends=["superflat", "brightdefects"],
+                prepare=prepare,
+            ),
+            AnalysisStage("defects", depends=["darkdefects"], prepare=prepare),
+            # prnu (full mask used)
+            AnalysisStage(
+                "prnu",
+                folder="qe",
+                methods=["analyze", "copy_data_files"],
+                depends=["defects"],
+                prepare=prepare,
+            ),
+            # qe (full mask used)
+            AnalysisStage("qe", depends=["defects"], prepare=prepare),
+        ]
+
+        return stages
 
-        rootfolder = azcam.utils.curdir()
+    def analyze(self, folder: str = None):
+        """
+        Analyze entire sequence of data for LVM in report folder folder,
+        default is the current folder.
+        Independent stages run in parallel if analysis_workers > 1.
+        """
 
-        # raw bias
-        azcam.utils.curdir("bias")
-        azcam.db.tools["bias"].analyze()
-        azcam.utils.curdir(rootfolder)
+        rootfolder = azcam.utils.curdir() if folder is None else folder
 
-        # gain (no masks)
-        azcam.utils.curdir("gain")
-        azcam.db.tools["gain"].analyze()
-        azcam.utils.curdir(rootfolder)
+        self.setup_analyze(folder=rootfolder)
 
-        # Fe-55 (used for gain below) (no masks)
-        azcam.utils.curdir("fe55")
-        # azcam.db.tools["fe55"].gain_estimate = azcam.db.tools["gain"].system_gain
-        azcam.db.tools["fe55"].analyze()
-        azcam.utils.curdir(rootfolder)
+        self.context = AnalysisContext(rootfolder)
+        pipeline = AnalysisPipeline(
+            self.analysis_stages(),
+            self.context,
+            self.analysis_workers,
+            use_cache=self.analysis_cache,
+        )
+        pipeline.run()
 
-        # use fe55 gain from now on
-        if self.use_fe55_gain:
-            azcam.db.tools["gain"].fe55_gain()
-
-        # superflat (no masks)
-        azcam.utils.curdir("superflat")
-        azcam.db.tools["superflat"].analyze()
-        azcam.utils.curdir(rootfolder)
-
-        # PTC (no masks)
-        azcam.utils.curdir("ptc")
-        azcam.db.tools["ptc"].analyze()
-        azcam.utils.curdir(rootfolder)
-
-        # linearity from ptc data (no masks)
-        azcam.utils.curdir(azcam.db.tools["ptc"].analysis_folder)
-        azcam.db.tools["linearity"].analyze()
-        azcam.db.tools["linearity"].copy_data_files()
-        azcam.utils.curdir(rootfolder)
-
-        # darks (only edge mask used)
-        azcam.utils.curdir("dark")
-        azcam.db.tools["dark"].analyze()
-        azcam.utils.curdir(rootfolder)
-
-        # defects, defect mask valid after this
-        azcam.utils.curdir("dark")
-        azcam.db.tools["defects"].analyze_bright_defects()
-        azcam.db.tools["defects"].copy_data_files()
-        azcam.utils.curdir(rootfolder)
-
-        azcam.utils.curdir("superflat")
-        azcam.db.tools["defects"].analyze_dark_defects()
-        azcam.db.tools["defects"].copy_data_files()
-        azcam.utils.curdir(rootfolder)
-
-        azcam.utils.curdir("defects")
-        azcam.db.tools["defects"].analyze()
-        azcam.utils.curdir(rootfolder)
-
-        # prnu (full mask used)
-        azcam.utils.curdir("qe")
-        azcam.db.tools["prnu"].analyze()
-        azcam.db.tools["prnu"].copy_data_files()
-        azcam.utils.curdir(rootfolder)
-
-        # qe (full mask used)
-        azcam.utils.curdir("qe")
-        azcam.db.tools["qe"].analyze()
-        azcam.utils.curdir(rootfolder)
-
-        # make report
-        self.report_summary()
-        self.report()
+        # make report in the report folder
+        with self.context.reporting():
+            self.report_summary()
+            self.report()
 
         print("Analysis sequence finished")
 
@@ -390,7 +425,7 @@ class LVMDetChar(DetChar):
             self.setup_analyze()
 
         if len(self.report_comment) == 0:
-            self.report_comment = azcam.utils.prompt("Enter report comment")
+            self.report_comment = batch.ask("report_comment", "Enter report comment")
 
         # get current date
         self.report_date = datetime.datetime.now().strftime("%b-%d-%Y")
@@ -447,13 +482,13 @@ class LVMDetChar(DetChar):
 
         return
 
-    def setup_analyze(self, EO=1):
+    def setup_analyze(self, EO=1, folder: str = None):
         """
         Set up configuration for analysis.
-        Start in the report folder.
+        Start in the report folder or specify it as folder.
         """
 
-        s = azcam.utils.curdir()
+        s = azcam.utils.curdir() if folder is None else folder
         try:
             x = s.index("/sn")
             if x > 0:
@@ -463,20 +498,18 @@ class LVMDetChar(DetChar):
         except ValueError:
             sn = 0
 
-        itlsn = azcam.utils.prompt("Enter sensor serial number (integer)", sn)
+        itlsn = batch.ask("itl_sn", "Enter sensor serial number (integer)", sn)
         self.itl_sn = itlsn
 
         self.summary_report_file = f"SummaryReport_SN{self.itl_sn}"
         self.SummaryPdfFile = f"{self.summary_report_file}.pdf"
 
-        # find first bias image for header info
-        azcam.utils.curdir("bias")
-        filename = azcam_console.utils.find_file_in_sequence("bias")[0]
-        azcam.utils.curdir("..")
+        # first bias image for header info
+        index = fitsindex.get_index(s, update=True)
+        filename = index.sequence("bias", "bias")[0]
 
-        try:
-            bb = pyfits.getheader(filename)["BACKBIAS"]
-        except KeyError:
+        bb = index.header(filename)["BACKBIAS"]
+        if bb is None:
             bb = 0
         self.backside_bias = float(bb)
 
@@ -496,11 +529,11 @@ class LVMDetChar(DetChar):
             self.itl_sn = 0
             self.itl_id = "0"
         else:
-            self.lot = azcam.utils.prompt("Enter lot")
-            self.device_type = azcam.utils.prompt("Enter device type")
-            self.wafer = azcam.utils.prompt("Enter wafer")
-            self.die = azcam.utils.prompt("Enter die")
-            self.itl_id = azcam.utils.prompt("Enter ITL ID")
+            self.lot = batch.ask("lot", "Enter lot")
+            self.device_type = batch.ask("device_type", "Enter device type")
+            self.wafer = batch.ask("wafer", "Enter wafer")
+            self.die = batch.ask("die", "Enter die")
+            self.itl_id = batch.ask("itl_id", "Enter ITL ID")
 
         self.is_setup = 1
 
@@ -567,19 +600,18 @@ class LVMDetChar(DetChar):
             os.mkdir(self.upload_folder)
         azcam.utils.curdir(self.upload_folder)
 
+        index = fitsindex.get_index(report_folder, update=True)
+        matches = index.find_all(list(self.upload_files), exclude="upload")
+
+        # copy concurrently, the last match of a pattern gives the upload file
+        copies = []
         for fname in self.upload_files:
-            matches = []
-            for root, dirnames, filenames in os.walk(report_folder):
-                for filename in fnmatch.filter(filenames, fname):
-                    matches.append(os.path.join(root, filename))
-
-            for match in matches:
-                if match is not None:
-                    print("Found: ", match)
-                    shutil.copy(
-                        match,
-                        os.path.join(self.upload_folder, self.upload_files[fname]),
-                    )
+            for match in matches[fname]:
+                print("Found: ", match)
+            if len(matches[fname]) > 0:
+                newname = os.path.join(self.upload_folder, self.upload_files[fname])
+                copies.append((matches[fname][-1], newname))
+        itlutils.copy_file_list(copies)
 
         azcam.utils.curdir(report_folder)
 
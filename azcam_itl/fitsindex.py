@@ -0,0 +1,319 @@
+"""
+Persistent index of the files and FITS header values in a report folder tree.
+
+Usage example:
+  index = get_index()
+  biasfile = index.sequence("bias", "bias")[0]
+  backbias = index.header(biasfile)["BACKBIAS"]
+"""
+
+import concurrent.futures
+import fnmatch
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+from astropy.io import fits as pyfits
+
+# index column: FITS keyword
+HEADER_KEYWORDS = {
+    "imagetyp": "IMAGETYP",
+    "exptime": "EXPTIME",
+    "wavelength": "WAVLNGTH",
+    "camtemp": "CAMTEMP",
+    "dewtemp": "DEWTEMP",
+    "backbias": "BACKBIAS",
+}
+
+# sequence files are named root.nnnn.fits
+_sequence_re = re.compile(r"^(.*)\.(\d+)\.fits$")
+
+# open indexes, key is (process id, folder)
+_indexes = {}
+
+# index files are kept here, not in the data folders
+INDEX_FOLDER = os.path.join(
+    os.environ.get("LOCALAPPDATA", os.path.join(os.path.expanduser("~"), ".cache")),
+    "azcam_itl",
+    "fitsindex",
+)
+
+
+def index_filename(folder: str) -> str:
+    """
+    Return the index file name of a folder, in INDEX_FOLDER.
+    """
+
+    folder = os.path.normcase(os.path.abspath(folder))
+    name = os.path.basename(folder) or "root"
+    digest = hashlib.sha1(folder.encode()).hexdigest()[:16]
+
+    return os.path.join(INDEX_FOLDER, f"{name}_{digest}.sqlite")
+
+
+class FitsIndex(object):
+    """
+    SQLite index of all files below a folder with sequence numbers and header
+    values of FITS files. The index is stored outside the folder, see
+    INDEX_FOLDER, so it is never copied or archived with the data, and is
+    updated incrementally, only new or changed files are read.
+    """
+
+    def __init__(self, folder: str = ".", filename: str = None):
+        """
+        Args:
+            folder: root folder of the index, usually a report folder.
+            filename: index file name, default from index_filename().
+        """
+
+        self.folder = os.path.abspath(folder)
+        self.filename = index_filename(self.folder) if filename is None else filename
+
+        # number of threads reading headers
+        self.number_threads = 8
+
+        self._lock = threading.RLock()
+
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self.db = self._open(self.filename)
+        except (OSError, sqlite3.Error):
+            # no writable index folder
+            self.db = self._open(":memory:")
+
+    @classmethod
+    def _open(cls, filename: str) -> sqlite3.Connection:
+        db = sqlite3.connect(filename, check_same_thread=False)
+        columns = ", ".join(f"{c} {cls._type(c)}" for c in HEADER_KEYWORDS)
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, folder TEXT, name TEXT, root TEXT, "
+                f"seqnum INTEGER, size INTEGER, mtime INTEGER, {columns})"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS files_name ON files (name)")
+
+        return db
+
+    @staticmethod
+    def _type(column: str) -> str:
+        return "TEXT" if column == "imagetyp" else "REAL"
+
+    def close(self):
+        """
+        Close the index database.
+        """
+
+        with self._lock:
+            self.db.close()
+
+        return
+
+    def update(self) -> int:
+        """
+        Update the index from the files on disk.
+        Returns number of new or changed files.
+        """
+
+        found = {}  # relative path: (size, mtime)
+        todo = [self.folder]
+        while todo:
+            folder = todo.pop()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        todo.append(entry.path)
+                    elif entry.is_file() and not entry.name.startswith(".fitsindex"):
+                        stat = entry.stat()
+                        path = os.path.relpath(entry.path, self.folder)
+                        found[path] = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            known = {
+                row[0]: (row[1], row[2])
+                for row in self.db.execute("SELECT path, size, mtime FROM files")
+            }
+        changed = [path for path in found if known.get(path) != found[path]]
+        removed = [path for path in known if path not in found]
+
+        with concurrent.futures.ThreadPoolExecutor(self.number_threads) as pool:
+            headers = pool.map(self._read_header, changed)
+            rows = [
+                self._row(path, found[path], header)
+                for path, header in zip(changed, headers)
+            ]
+
+        with self._lock, self.db:
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+            marks = ", ".join("?" * (7 + len(HEADER_KEYWORDS)))
+            self.db.executemany(f"INSERT OR REPLACE INTO files VALUES ({marks})", rows)
+
+        return len(changed)
+
+    def _read_header(self, path: str) -> dict:
+        """
+        Return indexed header values of a FITS file, empty for other files.
+        """
+
+        if not path.endswith(".fits"):
+            return {}
+
+        try:
+            header = pyfits.getheader(os.path.join(self.folder, path))
+        except Exception:
+            return {}
+
+        values = {}
+        for column, keyword in HEADER_KEYWORDS.items():
+            value = header.get(keyword)
+            if self._type(column) == "REAL":
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    value = None
+            values[column] = value
+
+        return values
+
+    @staticmethod
+    def _folder(folder: str) -> str:
+        folder = os.path.normpath(folder)
+        return "" if folder == "." else folder
+
+    def _row(self, path: str, stat: tuple, header: dict) -> tuple:
+        folder, name = os.path.split(path)
+        match = _sequence_re.match(name)
+        if match is None:
+            root, seqnum = None, None
+        else:
+            root, seqnum = match.group(1), int(match.group(2))
+
+        values = tuple(header.get(column) for column in HEADER_KEYWORDS)
+
+        return (path, folder, name, root, seqnum) + stat + values
+
+    def _select(self, query: str, args: list) -> list:
+        with self._lock:
+            rows = self.db.execute(query, args).fetchall()
+
+        return [os.path.join(self.folder, row[0]) for row in rows]
+
+    def find(self, pattern: str, folder: str = None, exclude: str = None) -> list:
+        """
+        Return sorted list of files whose name matches a filename pattern.
+
+        Args:
+            pattern: filename pattern like "qe.0004.fits" or "*_Report_*.pdf".
+            folder: only files in this folder, relative to the index folder.
+            exclude: skip files below this folder, relative to the index folder.
+        """
+
+        return self.find_all([pattern], folder, exclude)[pattern]
+
+    def find_all(self, patterns: list, folder: str = None, exclude: str = None) -> dict:
+        """
+        Match several filename patterns in one pass over the index.
+        Returns dict of pattern: sorted list of files, see find().
+        """
+
+        query = "SELECT path, name FROM files"
+        args = []
+        if folder is not None:
+            query += " WHERE folder = ?"
+            args.append(self._folder(folder))
+        query += " ORDER BY path"
+
+        with self._lock:
+            rows = self.db.execute(query, args).fetchall()
+
+        if exclude is not None:
+            exclude = os.path.normpath(exclude) + os.sep
+
+        matches = {pattern: [] for pattern in patterns}
+        for path, name in rows:
+            if exclude is not None and path.startswith(exclude):
+                continue
+            for pattern in patterns:
+                if fnmatch.fnmatch(name, pattern):
+                    matches[pattern].append(os.path.join(self.folder, path))
+
+        return matches
+
+    def sequence(self, root: str, folder: str = None) -> list:
+        """
+        Return list of the files of an image sequence ordered by sequence number.
+
+        Args:
+            root: sequence root name like "bias" for bias.0001.fits.
+            folder: only files in this folder, relative to the index folder.
+        """
+
+        query = "SELECT path FROM files WHERE root = ?"
+        args = [root]
+        if folder is not None:
+            query += " AND folder = ?"
+            args.append(self._folder(folder))
+        query += " ORDER BY folder, seqnum"
+
+        return self._select(query, args)
+
+    def select(self, folder: str = None, **values) -> list:
+        """
+        Return FITS files with the given indexed header values, ordered by path.
+        Example: index.select("qe", imagetyp="flat", wavelength=500.0)
+        """
+
+        query = "SELECT path FROM files WHERE path LIKE '%.fits'"
+        args = []
+        if folder is not None:
+            query += " AND folder = ?"
+            args.append(self._folder(folder))
+        for column, value in values.items():
+            if column not in HEADER_KEYWORDS:
+                raise KeyError(f"{column} is not an indexed header value")
+            query += f" AND {column} = ?"
+            args.append(value)
+        query += " ORDER BY path"
+
+        return self._select(query, args)
+
+    def header(self, filename: str) -> dict:
+        """
+        Return indexed header values of a file as dict of FITS keyword: value.
+        Values are None for keywords not in the header.
+        """
+
+        path = os.path.relpath(os.path.abspath(filename), self.folder)
+        columns = ", ".join(HEADER_KEYWORDS)
+        with self._lock:
+            row = self.db.execute(
+                f"SELECT {columns} FROM files WHERE path = ?", [path]
+            ).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"file not in index: {filename}")
+
+        return {keyword: v for keyword, v in zip(HEADER_KEYWORDS.values(), row)}
+
+
+def get_index(folder: str = ".", update: bool = False) -> FitsIndex:
+    """
+    Return the index of a folder, opened and updated once per process.
+    Use update=True once at the start of a run which needs files written since.
+
+    Args:
+        folder: root folder of the index.
+        update: update an open index from disk before returning it.
+    """
+
+    key = (os.getpid(), os.path.abspath(folder))
+    if key not in _indexes:
+        _indexes[key] = FitsIndex(folder)
+        update = True
+    index = _indexes[key]
+
+    if update:
+        index.update()
+
+    return index
@@ -0,0 +1,284 @@
+"""
+Persistent TCP link to the ebserver Arduino which controls LEDs and Fe55.
+Commands are fixed length strings like "CFFNFFFFF" (mode character and 8 pin states).
+"""
+
+import queue
+import select
+import socket
+import threading
+import time
+
+import azcam
+import azcam.exceptions
+
+
+class ArduinoLink(object):
+    """
+    Keeps one connection open to the Arduino and sends commands from a queue in a
+    background thread. The connection is reopened after errors and after being
+    idle longer than idle_timeout, as the Arduino does not reply to commands.
+    """
+
+    def __init__(self, host: str = "10.131.0.9", port: int = 80):
+        self.host = host
+        self.port = port
+
+        # seconds for connect and send
+        self.timeout = 2.0
+
+        # seconds idle after which the connection is reopened before sending
+        self.idle_timeout = 30.0
+
+        # send attempts per command
+        self.retries = 2
+
+        self.commands = queue.Queue()
+
+        # latency metrics
+        self.number_sent = 0
+        self.number_errors = 0
+        self.number_connects = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+        self._socket = None
+        self._last_send = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Open the connection, closing any current connection.
+        """
+
+        self.close()
+
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._socket = sock
+        self._last_send = time.monotonic()
+        self.number_connects += 1
+
+        return
+
+    def close(self):
+        """
+        Close the connection.
+        """
+
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
+        return
+
+    def start(self):
+        """
+        Start the sending thread if not running.
+        """
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="arduino_link", daemon=True
+                )
+                self._thread.start()
+
+        return
+
+    def send(self, command: str, wait: bool = True):
+        """
+        Queue a command for the Arduino.
+
+        Args:
+            command: command string like "CFFNFFFFF".
+            wait: wait until the command is sent and raise an error if it failed.
+        """
+
+        self.start()
+
+        job = [command, time.perf_counter(), threading.Event(), None]
+        self.commands.put(job)
+
+        if wait:
+            job[2].wait()
+            if job[3] is not None:
+                raise azcam.exceptions.AzcamError(
+                    f"Arduino command {command} failed: {job[3]}"
+                )
+
+        return
+
+    def _is_closed(self) -> bool:
+        """
+        Return True if the Arduino closed the connection.
+        The Arduino never sends data, so a readable socket is closed. Without
+        this check the first command after a drop is written into a dead
+        connection and lost.
+        """
+
+        try:
+            readable, _, _ = select.select([self._socket], [], [], 0)
+            if readable and self._socket.recv(64) == b"":
+                return True
+        except OSError:
+            return True
+
+        return False
+
+    def _write(self, data: bytes):
+        """
+        Write to the Arduino, reconnecting as needed.
+        """
+
+        for attempt in range(self.retries):
+            try:
+                if (
+                    self._socket is None
+                    or time.monotonic() - self._last_send > self.idle_timeout
+                    or self._is_closed()
+                ):
+                    self.connect()
+                self._socket.sendall(data)
+                self._last_send = time.monotonic()
+                return
+            except OSError:
+                self.close()
+                if attempt == self.retries - 1:
+                    raise
+
+    def _run(self):
+        """
+        Sending thread loop.
+        """
+
+        while True:
+            job = self.commands.get()
+            command, t0, done = job[:3]
+            try:
+                self._write(command.encode())
+                latency = time.perf_counter() - t0
+                self.number_sent += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_latency += latency
+            except OSError as e:
+                self.number_errors += 1
+                job[3] = e
+                azcam.log(f"Arduino link error: {e}")
+            finally:
+                done.set()
+
+    def get_metrics(self) -> dict:
+        """
+        Return link metrics, latencies in seconds from queueing to sent.
+        """
+
+        mean = self.total_latency / self.number_sent if self.number_sent else 0.0
+
+        return {
+            "sent": self.number_sent,
+            "errors": self.number_errors,
+            "connects": self.number_connects,
+            "queued": self.commands.qsize(),
+            "last_latency": self.last_latency,
+            "mean_latency": mean,
+            "max_latency": self.max_latency,
+        }
+
+
+class ArduinoStandin(object):
+    """
+    Local TCP server which parses Arduino commands like the ebserver sketch,
+    for testing without hardware.
+    Usage: standin = ArduinoStandin(); standin.start(); link = ArduinoLink(*standin.address)
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.address = self.server.getsockname()
+
+        self.mode = "S"  # "S" shutter mode or "C" control mode
+        self.ledstring = "FFFFFFFF"
+        self.received = []  # commands received
+        self.number_connections = 0
+
+        self._clients = []
+        self._running = False
+
+    def start(self):
+        """
+        Start listening in a background thread.
+        """
+
+        self.server.listen(4)
+        self._running = True
+        threading.Thread(target=self._serve, daemon=True).start()
+
+        return
+
+    def stop(self):
+        """
+        Stop listening.
+        """
+
+        self._running = False
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)  # wakes accept
+        except OSError:
+            pass
+        self.server.close()
+        self.drop()
+
+        return
+
+    def drop(self):
+        """
+        Close all client connections, like an Arduino reset.
+        """
+
+        for client in self._clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+        self._clients = []
+
+        return
+
+    def _serve(self):
+        while self._running:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            self.number_connections += 1
+            self._clients.append(client)
+            threading.Thread(target=self._client, args=(client,), daemon=True).start()
+
+    def _client(self, client):
+        buffer = b""
+        with client:
+            while True:
+                try:
+                    data = client.recv(64)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buffer += data
+                while len(buffer) >= 9:
+                    command, buffer = buffer[:9].decode(), buffer[9:]
+                    if command[0] in ("S", "C"):
+                        self.mode = command[0]
+                        self.ledstring = command[1:]
+                    self.received.append(command)
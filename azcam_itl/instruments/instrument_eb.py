@@ -1,15 +1,17 @@
 import time
-import socket
 
 import pyvisa
 
 import azcam
 import azcam.exceptions
 from azcam.tools.instrument import Instrument
+from azcam_itl.instruments.arduino_link import ArduinoLink
 from azcam_itl.instruments import pressure_vgc501
 from azcam_itl.instruments import pressure_mks900
+from azcam_itl.instruments.pressure_poller import PressurePoller
 from azcam_itl.instruments import webpower
 from azcam_itl.instruments.pollux import PolluxCtrl
+from azcam_itl.instruments.state_cache import StateCache
 
 """
 COM3 is Arduino serial port
@@ -39,6 +41,9 @@ class InstrumentEB(Instrument):
             "uv": 7,
         }
 
+        # persistent link to Arduino for LEDs and Fe55, set arduino.host to configure
+        self.arduino = ArduinoLink("10.131.0.9", 80)
+
         # current state
         self.led_state = "FFFFFFFF"  # start with all Arduino pins off
 
@@ -81,6 +86,11 @@ class InstrumentEB(Instrument):
         # filter wheel
         self.filters = FilterWheelEB()
 
+        # cached focus and filter for header keywords
+        self.state = StateCache()
+        self.state.add("FOCUSVAL", self._poll_focus)
+        self.state.add("FILTER", lambda: self.filters.get_filter())
+
         # self.pressure = pressure_mks900.PressureController("COM4")
 
         # initialization - may fail if turned off
@@ -107,6 +117,9 @@ class InstrumentEB(Instrument):
         # init filter wheel
         self.filters.initialize()
 
+        # poll focus and filter for header keywords
+        self.state.start()
+
         self.is_initialized = True
 
         azcam.log("Instrument initialized")
@@ -132,15 +145,16 @@ class InstrumentEB(Instrument):
     def get_keyword(self, keyword):
         """
         Read an instrument keyword value.
-        This command will read hardware to obtain the keyword value.
+        Focus and filter values are read from the state cache, which reads
+        hardware only when a value is older than state.max_age.
         """
 
         if keyword == "WAVLNGTH":
             reply = self.get_wavelength()
         elif keyword == "FOCUSVAL":
-            reply = self.get_focus()
+            reply = self.state.get("FOCUSVAL")
         elif keyword == "FILTER":
-            reply = self.get_filter()
+            reply = self.state.get("FILTER")
         else:
             raise azcam.exceptions.AzcamError("invalid keyword")
 
@@ -273,18 +287,7 @@ class InstrumentEB(Instrument):
         mode is 'C' for Control or 'S' for Shutter.
         """
 
-        output = mode + state
-
-        # set up socket
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Declare Arduino address and port
-        arduino_address = ("10.131.0.9", 80)
-
-        # send string over socket
-        client_socket.connect(arduino_address)
-        client_socket.send(output.encode())
-        client_socket.close()
+        self.arduino.send(mode + state)
 
         return
 
@@ -407,21 +410,43 @@ class InstrumentEB(Instrument):
         if AxisID not in self.pollux.valid_axes:
             raise azcam.exceptions.AzcamError(f"focus axis {AxisID} not supported")
 
-        self.pollux.go_home(AxisID)
+        with self.state.lock:
+            self.pollux.go_home(AxisID)
+        if AxisID == 1:
+            self.state.invalidate("FOCUSVAL")
 
         return
 
     def get_focus(self, AxisID=1, wait=1):
+        position = self._get_focus(AxisID, wait)
+        if int(AxisID) == 1:
+            self.state.set("FOCUSVAL", position)
+
+        return position
+
+    def _get_focus(self, AxisID=1, wait=1):
         if AxisID not in self.pollux.valid_axes:
             raise azcam.exceptions.AzcamError(f"focus axis {AxisID} not supported")
 
-        reply = self.pollux.get_pos(AxisID, wait)
+        with self.state.lock:
+            reply = self.pollux.get_pos(AxisID, wait)
 
         position = reply[1]
         position = float(position)
 
         return position
 
+    def _poll_focus(self):
+        """
+        Read focus position for the state cache without waiting for motion.
+        Returns None while the focus axis is moving, keeping the cached value.
+        """
+
+        with self.state.lock:
+            if self.pollux.is_moving(1):
+                return None
+            return self._get_focus(1, 0)
+
     def set_focus(self, FocusPosition, AxisID=1, focus_type="absolute"):
         if AxisID not in self.pollux.valid_axes:
             raise azcam.exceptions.AzcamError(f"focus axis {AxisID} not supported")
@@ -443,7 +468,10 @@ class InstrumentEB(Instrument):
             raise azcam.exceptions.AzcamError(f"focus axis {AxisID} not supported")
 
         Position = float(Position)
-        self.pollux.move_absolute(AxisID, Position)
+        with self.state.lock:
+            self.pollux.move_absolute(AxisID, Position)
+        if AxisID == 1:
+            self.state.set("FOCUSVAL", Position)
 
         return
 
@@ -452,33 +480,89 @@ class InstrumentEB(Instrument):
             raise azcam.exceptions.AzcamError(f"focus axis {AxisID} not supported")
 
         PositionChange = float(PositionChange)
-        self.pollux.move_relative(AxisID, PositionChange)
+        with self.state.lock:
+            self.pollux.move_relative(AxisID, PositionChange)
+        if AxisID == 1:
+            self.state.invalidate("FOCUSVAL")
+
+        return
+
+    def move_xyz(self, x=None, y=None, z=None, focus_type="absolute", wait=1):
+        """
+        Move several stage axes together with one batched command and
+        optionally wait for all axes to stop.
+        x is axis 2 (right-left), y is axis 3 (up-down), z is axis 1 (focus).
+        Axes which are None are not moved.
+
+        Args:
+            x: x position or step.
+            y: y position or step.
+            z: z (focus) position or step.
+            focus_type: "absolute" or "step".
+            wait: wait for motion to stop.
+        """
+
+        if focus_type not in ["absolute", "step"]:
+            raise azcam.exceptions.AzcamError("invalid focus_type")
+
+        positions = {}
+        for AxisID, value in [(1, z), (2, x), (3, y)]:
+            if value is not None:
+                positions[AxisID] = float(value)
+        if len(positions) == 0:
+            return
+
+        with self.state.lock:
+            finished = self.pollux.move_axes(
+                positions, relative=(focus_type == "step"), wait=wait
+            )
+        if not finished:
+            azcam.exceptions.warning("stage motion did not finish")
+
+        if 1 in positions:
+            if focus_type == "absolute":
+                self.state.set("FOCUSVAL", positions[1])
+            else:
+                self.state.invalidate("FOCUSVAL")
 
         return
 
+    def get_xyz(self):
+        """
+        Return stage positions [x, y, z] with one batched query.
+        """
+
+        with self.state.lock:
+            positions = self.pollux.get_positions([2, 3, 1])
+        self.state.set("FOCUSVAL", positions[1])
+
+        return [positions[2], positions[3], positions[1]]
+
     def calibrate_focus(self, AxisID=1):
         """
         Run calibration sequence for axis.
         """
 
-        print("Moving to end of travel")
-        self.pollux.calibrate(AxisID)
-        self.pollux.get_motion(AxisID, 1)  # wait for motion to stop
+        # hold hardware lock so the state poller skips reads
+        with self.state.lock:
+            print("Moving to end of travel")
+            self.pollux.calibrate(AxisID)
+            self.pollux.get_motion(AxisID, 1)  # wait for motion to stop
 
-        print("Measuring range of travel")
-        self.pollux.range_measure(AxisID)
-        self.pollux.get_motion(AxisID, 1)  # wait for motion to stop
+            print("Measuring range of travel")
+            self.pollux.range_measure(AxisID)
+            self.pollux.get_motion(AxisID, 1)  # wait for motion to stop
 
-        reply = self.pollux.get_limits(AxisID)
-        print(reply)
-        limits = [float(x) for x in reply[1].split()]
-        print(f"Limits: {limits[0]} - {limits[1]}")
-        midrange = (limits[1] - limits[0]) / 2.0
-        self.set_focus(midrange, AxisID)
+            reply = self.pollux.get_limits(AxisID)
+            print(reply)
+            limits = [float(x) for x in reply[1].split()]
+            print(f"Limits: {limits[0]} - {limits[1]}")
+            midrange = (limits[1] - limits[0]) / 2.0
+            self.set_focus(midrange, AxisID)
 
-        self.pollux.set_home(AxisID)
-        reply = self.get_focus(AxisID)
-        print("Homed position in center:", reply)
+            self.pollux.set_home(AxisID)
+            reply = self.get_focus(AxisID)
+            print("Homed position in center:", reply)
 
         return
 
@@ -487,7 +571,9 @@ class InstrumentEB(Instrument):
         Send a command to focus device.
         """
 
-        reply = self.pollux.send_cmd(Command, GetReply)
+        with self.state.lock:
+            reply = self.pollux.send_cmd(Command, GetReply)
+        self.state.invalidate("FOCUSVAL")
 
         return reply
 
@@ -508,7 +594,9 @@ class InstrumentEB(Instrument):
         Initialize filters.
         """
 
-        reply = self.filters.initialize()
+        with self.state.lock:
+            reply = self.filters.initialize()
+        self.state.invalidate("FILTER")
 
         return reply
 
@@ -527,7 +615,9 @@ class InstrumentEB(Instrument):
         filter_id is the filter mechanism ID.
         """
 
-        reply = self.filters.get_filter()
+        with self.state.lock:
+            reply = self.filters.get_filter()
+        self.state.set("FILTER", reply)
 
         return reply
 
@@ -538,7 +628,9 @@ class InstrumentEB(Instrument):
         filter_id is the filter mechanism ID.
         """
 
-        self.filters.set_filter(filter_name)
+        with self.state.lock:
+            self.filters.set_filter(filter_name)
+        self.state.set("FILTER", filter_name)
 
         return
 
@@ -588,6 +680,14 @@ class FilterWheelEB(object):
             "FILT6": "dark",
         }
 
+        # current wheel position, None if unknown
+        self.position = None
+
+        # motion completion polling, in seconds
+        self.move_timeout = 5.0
+        self.min_poll = 0.02
+        self.max_poll = 0.25
+
         # filter wheel
         if not self.mock:
             self.rm = pyvisa.ResourceManager()
@@ -606,6 +706,7 @@ class FilterWheelEB(object):
             # self.fw = self.rm.open_resource("COM3")
 
         reply = self.fw.query("RST")
+        self.position = None
 
         self.is_initialized = True
 
@@ -619,24 +720,63 @@ class FilterWheelEB(object):
         FilterID is the filter mechanism ID.
         """
 
-        filt = self.fw.query("FILT?")  # like FILT4
-        filter_name = self.filter_names[filt]
+        pos = self.get_position()
+        if pos is None:
+            raise azcam.exceptions.AzcamError("invalid filter wheel position reply")
+        filter_name = self.filter_names[f"FILT{pos}"]
 
         return filter_name
 
+    def get_position(self):
+        """
+        Read and return the wheel position number, or None if the reply is not valid.
+        """
+
+        filt = self.fw.query("FILT?")  # like FILT4
+        self.position = self.parse_position(filt)
+
+        return self.position
+
+    @staticmethod
+    def parse_position(reply):
+        """
+        Return position number from a reply like "FILT4", or None if not valid.
+        """
+
+        reply = reply.strip().upper()
+        if not reply.startswith("FILT"):
+            return None
+        try:
+            return int(reply[4:])
+        except ValueError:
+            return None
+
     def set_filter(self, filter_name, filter_id=0):
         """
-        Set the filter in the beam.
+        Set the filter in the beam and wait for the wheel to reach it.
+        Returns immediately if the filter is already in the beam.
         FilterID is the filter mechanism ID.
         """
 
+        if filter_name not in self.filter_wavelengths:
+            raise azcam.exceptions.AzcamError(f"invalid filter {filter_name}")
+
         pos = self.filter_wavelengths[filter_name]
+        if pos == self.position:
+            return
+
+        self.position = None
         self.fw.query(f"FILT{pos}")
-        for _ in range(5):  # wait for motion
-            current = self.fw.query(f"FILT?")
-            if current == filter_name:
-                break
-            time.sleep(0.5)
+
+        # wait for motion
+        t0 = time.monotonic()
+        poll = self.min_poll
+        while self.get_position() != pos:
+            if time.monotonic() - t0 > self.move_timeout:
+                azcam.exceptions.warning(f"filter wheel did not reach {filter_name}")
+                return
+            time.sleep(poll)
+            poll = min(2 * poll, self.max_poll)
 
         return
 
@@ -678,6 +818,14 @@ class InstrumentEBXXX(Instrument):
         self.pressure2 = pressure_vgc501.PressureController(
             "COM11"
         )  # EB ethernet mapped Agilent
+
+        # pressure_ids polled in background, see initialize()
+        self.pressure_poller = PressurePoller()
+        self.pressure_period = 1.0
+
+        # VGC501 gauges send readings continuously, so reading them needs no command
+        self.pressure_stream = True
+
         self.wavelength = ""  # wavelengths are LED strings like "green"
         self.valid_wavelengths = ["UV", "violet", "green", "orange", "red", "IR"]
         self.wavelengthLeds = {
@@ -728,32 +876,69 @@ class InstrumentEBXXX(Instrument):
         # create header
         self.define_keywords()
 
+    def initialize(self):
+        """
+        Initialize the instrument interface and start polling pressures.
+        """
+
+        super().initialize()
+
+        if self.pressure_stream:
+            streamed = {1: self.pressure1, 2: self.pressure2}
+            for pressure_id in self.pressure_ids:
+                if pressure_id not in streamed:
+                    continue
+                try:
+                    streamed[pressure_id].start_stream()
+                except Exception as e:
+                    azcam.log(f"Could not start pressure {pressure_id} stream - {e}")
+
+        if not self.pressure_poller.is_running():
+            for pressure_id in self.pressure_ids:
+                self.pressure_poller.add(
+                    pressure_id,
+                    lambda pressure_id=pressure_id: self._read_pressure(pressure_id),
+                    self.pressure_period,
+                )
+            self.pressure_poller.start()
+
+        return
+
     def get_pressure(self, pressure_id=0):
         """
-        Read an instrument pressure.
+        Read an instrument pressure, the latest polled value when polling.
         Args:
             pressure_id: 0 is MKS, 1 is Pfeiffer
         Returns:
             pressure: -999 for bad pressure
         """
 
+        if self.pressure_poller.is_running() and pressure_id in self.pressure_ids:
+            return self.pressure_poller.get_pressure(pressure_id)
+
         try:
-            if pressure_id == 0:
-                reply = self.pressure0.read_pressure(1)  # temp 2 is for MKS CC
+            reply = self._read_pressure(pressure_id)
+        except Exception:
+            reply = -1
 
-            elif pressure_id == 1:
-                self.pressure1.read_pressure()
-                reply = self.pressure1.read_pressure()
+        return reply
 
-            elif pressure_id == 2:
-                self.pressure2.read_pressure()
-                reply = self.pressure2.read_pressure()
+    def _read_pressure(self, pressure_id):
+        """
+        Read a pressure gauge.
+        """
 
-            else:
-                reply = -999
+        if pressure_id == 0:
+            reply = self.pressure0.read_pressure(1)  # temp 2 is for MKS CC
 
-        except Exception:
-            reply = -1
+        elif pressure_id == 1:
+            reply = self.pressure1.read_pressure()
+
+        elif pressure_id == 2:
+            reply = self.pressure2.read_pressure()
+
+        else:
+            reply = -999
 
         return reply
 
@@ -1,11 +1,11 @@
 import time
-import socket
 
 import pyvisa
 
 import azcam
 import azcam.exceptions
 from azcam.tools.instrument import Instrument
+from azcam_itl.instruments.arduino_link import ArduinoLink
 from azcam_itl.instruments import webpower
 
 
@@ -32,6 +32,9 @@ class InstrumentProber(Instrument):
             "uv": 7,
         }
 
+        # persistent link to Arduino for LEDs and Fe55, set arduino.host to configure
+        self.arduino = ArduinoLink("", 80)
+
         # current state
         self.led_state = "FFFFFFFF"  # start with all Arduino pins off
 
@@ -249,19 +252,7 @@ class InstrumentProber(Instrument):
         mode is 'C' for Control or 'S' for Shutter.
         """
 
-        output = mode + state
-
-        # set up socket
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Declare Arduino address and port
-        # arduino_address = ("10.131.0.9", 80)
-        arduino_address = ("", 80)
-
-        # send string over socket
-        client_socket.connect(arduino_address)
-        client_socket.send(output.encode())
-        client_socket.close()
+        self.arduino.send(mode + state)
 
         return
 
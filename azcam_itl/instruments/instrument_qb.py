@@ -1,15 +1,21 @@
+import concurrent.futures
+import threading
 import time
 
+import numpy
+
 import azcam
 import azcam.exceptions
 import azcam.sockets
 from azcam.tools.instrument import Instrument
 from azcam_itl.instruments.ms257 import MS257
-from azcam_itl.instruments.newport_1936_R import NewPort_1936r
+from azcam_itl.instruments.newport_1936_R import NewPort_1936r, PowerSampler
 from azcam_itl.instruments.arduino_qb import ArduinoQB
+from azcam_itl.instruments.state_cache import StateCache
 from azcam_itl.instruments import webpower
 
 from azcam_itl.instruments import pressure_mks900
+from azcam_itl.instruments.pressure_poller import PressurePoller
 
 
 class InstrumentQB(Instrument):
@@ -26,6 +32,39 @@ class InstrumentQB(Instrument):
         # comps
         self.active_comps = ["shutter"]
 
+        # cached monochromator state for header keywords
+        self.state = StateCache()
+        self.state.add("WAVLNGTH", lambda: self.mono.get_wavelength())
+        self.state.add("FILTER1", lambda: self.mono.get_filter(1))
+        self.state.add("FILTER2", lambda: self.mono.get_filter(2))
+
+        # pipelined sweeps, see start_sweep()
+        self.sweeping = False
+        self.sweep_wavelengths = []  # wavelengths still to visit
+        self.exposure_wavelength = None  # WAVLNGTH latched when exposure starts
+        self._requested_wavelength = None  # last wavelength from set_wavelength
+        self._move = None  # future of the monochromator move in progress
+        self._target_wavelength = None  # last wavelength commanded to monochromator
+        self._mover = concurrent.futures.ThreadPoolExecutor(1)
+
+        # power meter sampling in background while flux logging
+        self.power_sampler = None
+
+        # flux logging while exposure shutter is open, see start_flux_log()
+        self.flux_logging = False
+        self.flux_log = None  # binary log file
+        self.flux_exposures = 0  # number of exposures logged
+        self._flux_open_time = None
+
+        # seconds between checks of the exposure flag during an exposure
+        self.exposure_poll = 0.005
+        self._watch = None
+        self._watch_stop = threading.Event()
+
+        # pressures polled in background, seconds between readings
+        self.pressure_poller = PressurePoller()
+        self.pressure_period = 1.0
+
         # define header keywords
         self.define_keywords()
 
@@ -46,12 +85,14 @@ class InstrumentQB(Instrument):
         try:
             self.n1936 = NewPort_1936r()
             self.n1936.initialize()
+            self.power_sampler = PowerSampler(self.n1936)
         except Exception as e:
             azcam.log(f"Could not initialize power meter - {e}")
 
         try:
             self.mono = MS257()
             self.mono.initialize()
+            self.state.start()
         except Exception as e:
             azcam.log(f"could not initialize monochromator {e}")
 
@@ -70,6 +111,15 @@ class InstrumentQB(Instrument):
 
         try:
             self.pressure = pressure_mks900.PressureController("COM9")  # COM9 on QB
+            for pressure_id in self.pressure_ids:
+                self.pressure_poller.add(
+                    pressure_id,
+                    lambda pressure_id=pressure_id: self.pressure.read_pressure(
+                        pressure_id
+                    ),
+                    self.pressure_period,
+                )
+            self.pressure_poller.start()
         except Exception as e:
             azcam.log(f"Could not initialize pressure - {e}")
 
@@ -98,17 +148,17 @@ class InstrumentQB(Instrument):
     def get_keyword(self, keyword):
         """
         Read an instrument keyword value.
-        This command will read hardware to obtain the keyword value.
+        Monochromator values are read from the state cache, which reads
+        hardware only when a value is older than state.max_age.
         """
 
         if keyword == "WAVEUNIT":
             reply = "nm"
-        elif keyword == "WAVLNGTH":
-            reply = self.get_wavelength()
-        elif keyword == "FILTER1":
-            reply = self.get_filter(1)
-        elif keyword == "FILTER2":
-            reply = self.get_filter(2)
+        elif keyword == "WAVLNGTH" and self.exposure_wavelength is not None:
+            # monochromator may already be moving to next sweep wavelength
+            reply = self.exposure_wavelength
+        elif keyword in ["WAVLNGTH", "FILTER1", "FILTER2"]:
+            reply = self.state.get(keyword)
         else:
             try:
                 reply = self.header.values[keyword]
@@ -203,7 +253,8 @@ class InstrumentQB(Instrument):
 
         if shutter_id == 0:
             try:
-                self.mono.set_shutter(state)
+                with self.state.lock:
+                    self.mono.set_shutter(state)
             except Exception as e:
                 azcam.log(f"Error setting monochromator shutter state: {e}")
 
@@ -214,7 +265,81 @@ class InstrumentQB(Instrument):
                 azcam.log(f"Error setting arduino shutter state: {e}")
 
         return
-    
+
+    # exposure hooks
+
+    def exposure_start(self):
+        """
+        Called by the exposure tool before each exposure, before headers are read.
+        During a sweep makes sure the monochromator is at the requested wavelength.
+        During a sweep or flux logging follows the exposure flag in a thread, so
+        this works with any shutter configuration, including shutter_strobe
+        where the controller drives the shutter and set_shutter is never called.
+        """
+
+        self._shutter_opening()
+
+        # no flux keywords unless measured during this exposure
+        if self.flux_logging:
+            for keyword in ["FLUXMEAN", "FLUXSDEV", "FLUXINT"]:
+                self.delete_keyword(keyword)
+
+        if self.sweeping or self.flux_logging:
+            self._stop_watch()
+            self._watch_stop.clear()
+            self._watch = threading.Thread(
+                target=self._watch_exposure, name="qb_exposure_watch", daemon=True
+            )
+            self._watch.start()
+
+        return
+
+    def exposure_finish(self):
+        """
+        Called by the exposure tool after each exposure.
+        Ends the exposure if the flag watcher did not, like after an abort.
+        """
+
+        self._stop_watch()
+        self._flux_end()
+        self._shutter_closed()
+
+        return
+
+    def _stop_watch(self):
+        self._watch_stop.set()
+        if self._watch is not None:
+            self._watch.join()
+            self._watch = None
+
+        return
+
+    def _watch_exposure(self):
+        """
+        Start flux logging when the exposure flag becomes EXPOSING, and end
+        it and start the next sweep move when integration ends.
+        """
+
+        exposure = azcam.db.tools["exposure"]
+        exposing = exposure.exposureflags["EXPOSING"]
+
+        started = False
+        while not self._watch_stop.is_set():
+            flag = exposure.exposure_flag
+            if not started and flag == exposing:
+                started = True
+                # no flux for zeros and darks, the shutter stays closed
+                image_type = exposure.image_type.lower()
+                if exposure.shutter_dict.get(image_type, 1):
+                    self._flux_start()
+            elif started and flag != exposing:
+                self._flux_end()
+                self._shutter_closed()
+                return
+            self._watch_stop.wait(self.exposure_poll)
+
+        return
+
     def set_shutter_arduino(self, state):
         """
         Set the arduino shutter state.
@@ -236,9 +361,135 @@ class InstrumentQB(Instrument):
     def set_wavelength(self, wavelength, *args, **kwargs):#, wavelength_id=0):
         """
         Set monochromator wavelength (nm).
+        During a sweep this waits for a move to this wavelength which was
+        started when the shutter closed.
+        """
+
+        wavelength = float(wavelength)
+        self._requested_wavelength = wavelength
+
+        if self._move is not None and self._target_wavelength == wavelength:
+            self.wait_move()
+        else:
+            self.wait_move()
+            self._set_wavelength(wavelength)
+            self._target_wavelength = wavelength
+
+        if len(self.sweep_wavelengths) > 0 and self.sweep_wavelengths[0] == wavelength:
+            self.sweep_wavelengths.pop(0)
+
+        return
+
+    def _set_wavelength(self, wavelength):
+        """
+        Move monochromator and update cached state.
+        """
+
+        with self.state.lock:
+            self.mono.set_wavelength(float(wavelength))
+        self.state.set("WAVLNGTH", self.mono.CurrentWavelength)
+
+        # filters may change with wavelength in auto mode
+        self.state.invalidate("FILTER1")
+        self.state.invalidate("FILTER2")
+
+        return
+
+    def set_wavelength_async(self, wavelength) -> concurrent.futures.Future:
+        """
+        Start a monochromator move and return without waiting.
+        The returned future completes when the move has settled.
+        """
+
+        self.wait_move()  # one move at a time
+
+        self._target_wavelength = float(wavelength)
+        self._move = self._mover.submit(self._set_wavelength, self._target_wavelength)
+
+        return self._move
+
+    def wait_move(self):
+        """
+        Wait for a move started by set_wavelength_async to finish.
+        Raises the move's exception if it failed.
+        """
+
+        move, self._move = self._move, None
+        if move is not None:
+            move.result()
+
+        return
+
+    def start_sweep(self, *wavelengths):
+        """
+        Start a pipelined sweep through wavelengths, given as a list, a string
+        or several arguments (as from the command server).
+        The move to the next wavelength starts when integration ends, so it runs
+        during readout, and the next set_wavelength waits for it to finish.
+        WAVLNGTH is latched in exposure_start() for header values.
+        Exposures are always taken at the last set_wavelength value.
+        Works with any shutter configuration, see exposure_start().
+        """
+
+        values = []
+        for w in wavelengths:
+            if isinstance(w, str):
+                values.extend(w.replace(",", " ").split())
+            elif isinstance(w, (list, tuple, dict)):
+                values.extend(w)
+            else:
+                values.append(w)
+        self.sweep_wavelengths = [float(w) for w in values]
+        self.exposure_wavelength = None
+        self.sweeping = True
+
+        return
+
+    def stop_sweep(self):
+        """
+        End a pipelined sweep.
+        """
+
+        self._stop_watch()
+        self.sweeping = False
+        self.sweep_wavelengths = []
+        self.wait_move()
+        self.exposure_wavelength = None
+
+        return
+
+    def _shutter_opening(self):
+        """
+        Make sure monochromator is at the requested wavelength before an exposure.
         """
 
-        self.mono.set_wavelength(float(wavelength))
+        if not self.sweeping:
+            return
+
+        self.wait_move()
+
+        # a move to the next sweep wavelength started, but this exposure is
+        # at the last requested wavelength
+        requested = self._requested_wavelength
+        if requested is not None and self._target_wavelength != requested:
+            self._set_wavelength(requested)
+            self._target_wavelength = requested
+
+        self.exposure_wavelength = self.mono.CurrentWavelength
+
+        return
+
+    def _shutter_closed(self):
+        """
+        Start the move to the next sweep wavelength.
+        """
+
+        if not self.sweeping or len(self.sweep_wavelengths) == 0:
+            return
+        if self._move is not None:  # already moving
+            return
+
+        self.set_wavelength_async(self.sweep_wavelengths[0])
 
         return
 
@@ -247,14 +498,23 @@ class InstrumentQB(Instrument):
         Get monochromator wavelength (nm).
         """
 
-        return self.mono.get_wavelength()
+        with self.state.lock:
+            reply = self.mono.get_wavelength()
+        self.state.set("WAVLNGTH", reply)
+
+        return reply
 
     def get_filter(self, filter_id=0):
         """
         Get filter wheel position.
         """
 
-        return self.mono.get_filter(filter_id)
+        with self.state.lock:
+            reply = self.mono.get_filter(filter_id)
+        if int(filter_id) in [1, 2]:
+            self.state.set(f"FILTER{int(filter_id)}", reply)
+
+        return reply
 
     def get_filters(self, *args, **kwargs): #filter_id=0):
         """
@@ -273,7 +533,10 @@ class InstrumentQB(Instrument):
         Return is like A:3 or M:2 for auto or manual mode.
         """
 
-        return self.mono.get_loaded_filters()
+        with self.state.lock:
+            reply = self.mono.get_loaded_filters()
+
+        return reply
 
     def set_filter(self, filter, filter_id=1):
         """
@@ -284,7 +547,11 @@ class InstrumentQB(Instrument):
         fid = int(filter_id)
         position = int(filter)
 
-        return self.mono.set_filter(position, filter_id=fid)
+        with self.state.lock:
+            reply = self.mono.set_filter(position, filter_id=fid)
+        self.state.invalidate(f"FILTER{fid}")
+
+        return reply
 
 
     # Newport power meter
@@ -330,11 +597,125 @@ class InstrumentQB(Instrument):
 
         return power
 
+    # flux logging
+
+    def start_flux_log(self, filename: str = None):
+        """
+        Log power meter flux while each exposure integrates, see exposure_start().
+        FLUXMEAN, FLUXSDEV and FLUXINT header keywords are set when integration
+        ends, before the image is written. They are left out of the header if
+        the power meter gave no samples during the exposure.
+        Samples are appended to the binary log file filename if specified,
+        see read_flux_log() for the format.
+        The power meter is sampled only while flux logging.
+        """
+
+        if self.power_sampler is None:
+            raise azcam.exceptions.AzcamError("power meter is not initialized")
+
+        self.stop_flux_log()
+        self.power_sampler.start()
+
+        if filename is not None:
+            self.flux_log = open(filename, "ab")
+        self.flux_exposures = 0
+        self.flux_logging = True
+
+        return
+
+    def stop_flux_log(self):
+        """
+        Stop flux logging, power meter sampling and close the log file.
+        """
+
+        self._stop_watch()
+        self.flux_logging = False
+        if self.power_sampler is not None:
+            self.power_sampler.stop()
+        self._flux_open_time = None
+        for keyword in ["FLUXMEAN", "FLUXSDEV", "FLUXINT"]:
+            self.delete_keyword(keyword)
+        if self.flux_log is not None:
+            self.flux_log.close()
+            self.flux_log = None
+
+        return
+
+    @staticmethod
+    def read_flux_log(filename: str):
+        """
+        Read a binary flux log.
+        The log is float64 triplets of (exposure number, unix time, flux [W/cm2]).
+        Returns array of shape (number of samples, 3).
+        """
+
+        return numpy.fromfile(filename, dtype="<f8").reshape(-1, 3)
+
+    def _flux_start(self):
+        """
+        Start flux measurement when the exposure starts integrating.
+        """
+
+        if not self.flux_logging or self._flux_open_time is not None:
+            return
+
+        try:
+            self.power_sampler.set_wavelength(self.mono.CurrentWavelength)
+        except Exception as e:
+            azcam.log(f"Could not set power meter wavelength - {e}")
+        self._flux_open_time = time.monotonic()
+
+        return
+
+    def _flux_end(self):
+        """
+        Set flux keywords and log samples when integration ends.
+        """
+
+        if not self.flux_logging or self._flux_open_time is None:
+            return
+
+        t1, t2 = self._flux_open_time, time.monotonic()
+        self._flux_open_time = None
+        times, values = self.power_sampler.get_samples(t1, t2)
+        self.flux_exposures += 1
+
+        if len(values) == 0:
+            azcam.log("No power meter samples during exposure, flux not recorded")
+            return
+        elif len(values) == 1:
+            mean, sdev = float(values[0]), 0.0
+            flux = mean * (t2 - t1)
+        else:
+            # time weighted mean, as samples may not be evenly spaced
+            area = numpy.sum((values[1:] + values[:-1]) / 2.0 * numpy.diff(times))
+            mean = float(area / (times[-1] - times[0]))
+            sdev = float(values.std())
+            flux = mean * (t2 - t1)
+
+        self.set_keyword("FLUXMEAN", mean, "Mean flux during exposure [W/cm2]", "float")
+        self.set_keyword("FLUXSDEV", sdev, "Flux sdev during exposure [W/cm2]", "float")
+        self.set_keyword("FLUXINT", flux, "Integrated flux of exposure [J/cm2]", "float")
+
+        if self.flux_log is not None:
+            offset = time.time() - time.monotonic()
+            records = numpy.empty((len(values), 3), dtype="<f8")
+            records[:, 0] = self.flux_exposures
+            records[:, 1] = times + offset
+            records[:, 2] = values
+            records.tofile(self.flux_log)
+            self.flux_log.flush()
+
+        return
+
     def get_pressure(self, pressure_id=0):
         """
-        Read an instrument pressure.
+        Read an instrument pressure, the latest polled value when polling.
         """
 
+        if self.pressure_poller.is_running():
+            return self.pressure_poller.get_pressure(pressure_id)
+
         return self.pressure.read_pressure(pressure_id)
 
     def set_comps(self, comp_names=["shutter"]):
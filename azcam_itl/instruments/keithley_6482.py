@@ -1,6 +1,8 @@
 import serial
 
 import azcam
+import azcam.exceptions
+from azcam_itl.instruments.serial_transport import SerialTransport
 
 
 class DiodeControllerClass(object):
@@ -11,15 +13,9 @@ class DiodeControllerClass(object):
     def __init__(self, port="COM21"):
 
         self.ComPort = port
-        self.BaudRate = 9600
-        self.Parity = serial.PARITY_NONE
-        self.ByteSize = 8
-        self.StopBits = 1
-        self.timeout = 3
-        self.RtsCts = 0
-        self.XonXoff = 0
 
-        self.ser = 0
+        self.transport = SerialTransport(port, 9600, 8, serial.PARITY_NONE, 1)
+        self.transport.timeout = 3.0
 
     def initialize(self):
         """
@@ -29,11 +25,9 @@ class DiodeControllerClass(object):
         reply = self.open_port()
 
         # set hi accuracy and autozero
-        reply = self.ser.write(str.encode(":SYST:AZER ON\n"))
-        reply = self.ser.read(28).decode()
+        reply = self.transport.write(":SYST:AZER ON\n")
 
-        reply = self.ser.write(str.encode(":SENS1:CURR:NPLC 10\n"))
-        reply = self.ser.read(28).decode()
+        reply = self.transport.write(":SENS1:CURR:NPLC 10\n")
 
         return
 
@@ -42,21 +36,11 @@ class DiodeControllerClass(object):
         Open serial port.
         """
 
-        if self.ser == 0 or not self.ser.isOpen():
-            try:
-                self.ser = serial.Serial(
-                    port=self.ComPort,
-                    baudrate=self.BaudRate,
-                    timeout=self.timeout,
-                    parity=self.Parity,
-                    stopbits=self.StopBits,
-                    bytesize=self.ByteSize,
-                    rtscts=self.RtsCts,
-                    xonxoff=self.XonXoff,
-                )
-            except Exception as message:
-                azcam.log(message)
-                return ["ERROR", "could not open diode serial port"]
+        try:
+            self.transport.open()
+        except Exception as message:
+            azcam.log(message)
+            return ["ERROR", "could not open diode serial port"]
 
         return
 
@@ -65,10 +49,14 @@ class DiodeControllerClass(object):
         Read diode values.  First value is sphere, second is DUT.
         """
 
-        reply = self.open_port()
-
-        reply = self.ser.write(str.encode(":MEAS:CURR:DC?\n"))
-        reply = self.ser.read(28).decode()
+        try:
+            # reply is ended by CR or LF, depending on the RS-232 terminator setting
+            reply = self.transport.transact(
+                ":MEAS:CURR:DC?\n", terminator=[b"\r", b"\n"]
+            )
+            reply = reply.decode()
+        except azcam.exceptions.AzcamError:
+            reply = ""
         reply = reply.strip()
         currents = reply.split(",")
         try:
@@ -85,9 +73,6 @@ class DiodeControllerClass(object):
         Close serial port.
         """
 
-        try:
-            self.ser.close()
-        except Exception:
-            pass
+        self.transport.close()
 
         return
@@ -2,7 +2,10 @@
 MS257 77781 monochromator
 """
 
+import json
+import os
 import time
+
 import pyvisa
 
 import azcam
@@ -25,6 +28,23 @@ class MS257(object):
         self.Filter2 = -1  # nd FW
         self.port = port
 
+        # settle model, times in seconds, see calibrate_settle()
+        # defaults are the fixed 1 sec wait used before calibration, calibrate_settle()
+        # is required for shorter waits and for grating and filter change times
+        self.settle = {
+            "base": 1.0,  # time for any move
+            "per_nm": 0.0,  # time per nm of travel
+            "grating": 0.0,  # extra time when crossing grating_change
+            "filter": 2.0,  # extra time for a filter wheel change
+            "filter_changes": [],  # wavelengths where the auto filters change
+        }
+        self.settle_file = None  # default is datafolder/ms257_settle.json
+        self.grating_change = 395.0  # =CHNGPI transition wavelength
+        self.settle_tolerance = 0.05  # nm for ?PW verification
+        self.filter_change_tolerance = 5.0  # nm to locate filter changes
+        self.settle_timeout = 20.0
+        self.poll_period = 0.05
+
         self.mono = None
         self.rm = pyvisa.ResourceManager()
 
@@ -63,6 +83,7 @@ class MS257(object):
         self.query("=SHTRTYPE F")  # Set shutter type to fast
         self.query("!PORTIN 0")    # Set to 0 for Auto Port selection BNC AUX OUT level
         self.query("=CHNGPI D:395:A") # Wavelength transition point between D and A (although, there is no D???)
+        self.load_settle()
         if reset:
             # Command value 0 on each filter wheel for position auto selection
             self._set_filter(0, filter_id=1)
@@ -123,12 +144,218 @@ class MS257(object):
             azcam.log(f"MS257: wavelength {wavelength} already set, no change", level=2)
             return
 
+        start = self.CurrentWavelength
         self.mono.query(f"!GW {wavelength}").strip()
-        time.sleep(1)
-        _ = self.get_wavelength()  # update current wavelength
+        time.sleep(self.settle_time(start, float(wavelength)))
+        self.wait_wavelength(float(wavelength))  # updates current wavelength
 
         return
 
+    def wait_wavelength(self, wavelength: float, timeout: float = None) -> bool:
+        """
+        Poll ?PW until the wavelength is stable at the target.
+        Returns True if settled, False on timeout.
+        """
+
+        if timeout is None:
+            timeout = self.settle_timeout
+
+        t0 = time.monotonic()
+        last = None
+        while True:
+            self.get_wavelength()
+            current = self.CurrentWavelength
+            if (
+                abs(current - wavelength) <= self.settle_tolerance
+                and last is not None
+                and abs(current - last) <= self.settle_tolerance
+            ):
+                return True
+            if time.monotonic() - t0 > timeout:
+                azcam.log(f"MS257: wavelength {wavelength} not settled, read {current}")
+                return False
+            last = current
+            time.sleep(self.poll_period)
+
+    def settle_time(self, start: float, wavelength: float) -> float:
+        """
+        Return expected settle time (sec) for a move between wavelengths.
+        """
+
+        settle = self.settle
+
+        if start < 0:  # unknown start
+            return settle["base"] + settle["grating"] + settle["filter"]
+
+        low, high = min(start, wavelength), max(start, wavelength)
+        t = settle["base"] + settle["per_nm"] * (high - low)
+        if low < self.grating_change <= high:
+            t += settle["grating"]
+        for w in settle["filter_changes"]:
+            if low < w <= high:
+                t += settle["filter"]
+                break
+
+        return t
+
+    def get_settle_file(self) -> str:
+        """
+        Return settle model filename.
+        """
+
+        if self.settle_file is not None:
+            return self.settle_file
+
+        folder = getattr(azcam.db, "datafolder", None) or ""
+
+        return os.path.join(folder, "ms257_settle.json")
+
+    def load_settle(self):
+        """
+        Load settle model from settle file if it exists.
+        """
+
+        filename = self.get_settle_file()
+        if not os.path.exists(filename):
+            azcam.log("MS257: settle model not calibrated, run calibrate_settle()")
+            return
+
+        with open(filename, "r") as f:
+            self.settle.update(json.load(f))
+        if "filter_ranges" in self.settle:  # older model, run calibrate_settle()
+            self.settle.pop("filter_ranges")
+
+        return
+
+    def save_settle(self):
+        """
+        Save settle model to settle file.
+        """
+
+        with open(self.get_settle_file(), "w") as f:
+            json.dump(self.settle, f, indent=2)
+
+        return
+
+    def calibrate_settle(self, wavelengths: list = None, save: bool = True) -> dict:
+        """
+        Measure move times and fit the settle model.
+        Each move is timed until ?PW is stable at the target. Moves with no grating
+        or filter change give the base and per_nm terms, the extra time of
+        the other moves gives the grating and filter terms. The wavelengths
+        where the auto filters change are then located by bisection of the
+        moves which changed a filter.
+
+        Args:
+            wavelengths: wavelengths visited in order, with a range of step sizes
+              which cross the grating change.
+            save: save the model to the settle file.
+        Returns:
+            settle model dict.
+        """
+
+        if wavelengths is None:
+            wavelengths = [400, 410, 450, 550, 750, 1000, 1100, 900, 600, 420, 380]
+            wavelengths += [300, 350, 400]
+
+        self.set_wavelength(wavelengths[0])
+        filters = self.get_loaded_filters()
+
+        moves = []  # [distance, grating change, filter change, time]
+        for start, wavelength in zip(wavelengths[:-1], wavelengths[1:]):
+            t0 = time.monotonic()
+            self.mono.query(f"!GW {wavelength}").strip()
+            self.wait_wavelength(float(wavelength), 60.0)
+            dt = time.monotonic() - t0
+
+            newfilters = self.get_loaded_filters()
+            low, high = min(start, wavelength), max(start, wavelength)
+            grating = low < self.grating_change <= high
+            filter_change = newfilters != filters
+            filters = newfilters
+            moves.append([high - low, grating, filter_change, dt])
+            azcam.log(f"MS257 settle: {start} -> {wavelength} nm: {dt:.2f} sec", level=2)
+
+        settle = dict(self.settle)
+
+        # linear fit of plain moves
+        plain = [(m[0], m[3]) for m in moves if not m[1] and not m[2]]
+        if len(plain) >= 2:
+            n = len(plain)
+            mx = sum(x for x, _ in plain) / n
+            my = sum(y for _, y in plain) / n
+            sxx = sum((x - mx) ** 2 for x, _ in plain)
+            slope = sum((x - mx) * (y - my) for x, y in plain) / sxx if sxx > 0 else 0.0
+            slope = max(slope, 0.0)
+            settle["per_nm"] = slope
+            settle["base"] = max(my - slope * mx, 0.0)
+
+        def excess(selected):
+            times = [m[3] - settle["base"] - settle["per_nm"] * m[0] for m in selected]
+            return max(sum(times) / len(times), 0.0)
+
+        grating = [m for m in moves if m[1] and not m[2]]
+        if len(grating) > 0:
+            settle["grating"] = excess(grating)
+
+        filter_moves = [m for m in moves if m[2] and not m[1]]
+        if len(filter_moves) > 0:
+            settle["filter"] = excess(filter_moves)
+
+        changes = []
+        for (start, wavelength), m in zip(zip(wavelengths[:-1], wavelengths[1:]), moves):
+            if m[2]:
+                low, high = min(start, wavelength), max(start, wavelength)
+                changes += self._find_filter_changes(low, high)
+        # the same change may be found from several moves
+        settle["filter_changes"] = []
+        for w in sorted(changes):
+            last = settle["filter_changes"][-1:]
+            if len(last) == 0 or w - last[0] > self.filter_change_tolerance:
+                settle["filter_changes"].append(w)
+        if len(changes) > 0:
+            self.mono.query(f"!GW {wavelengths[-1]}").strip()
+            self.wait_wavelength(float(wavelengths[-1]), 60.0)
+
+        self.settle = settle
+        if save:
+            self.save_settle()
+
+        return settle
+
+    def _filters_at(self, wavelength: float) -> list:
+        """
+        Move to wavelength and return the auto selected filters.
+        """
+
+        self.mono.query(f"!GW {wavelength}").strip()
+        self.wait_wavelength(float(wavelength), 60.0)
+
+        return self.get_loaded_filters()
+
+    def _find_filter_changes(self, low: float, high: float) -> list:
+        """
+        Return the wavelengths between low and high where the auto filters
+        change, within filter_change_tolerance. Each is the lowest wavelength
+        with the new filters.
+        """
+
+        changes = []
+        todo = [(low, self._filters_at(low), high, self._filters_at(high))]
+        while len(todo) > 0:
+            w1, f1, w2, f2 = todo.pop()
+            if f1 == f2:
+                continue
+            if w2 - w1 <= self.filter_change_tolerance:
+                changes.append(w2)
+                continue
+            mid = round((w1 + w2) / 2.0, 1)
+            fmid = self._filters_at(mid)
+            todo.append((w1, f1, mid, fmid))
+            todo.append((mid, fmid, w2, f2))
+
+        return sorted(changes)
+
     def get_wavelength(self):#, wavelength_id=0):
         """
         Get monochromator wavelength (nm).
@@ -190,7 +417,16 @@ class MS257(object):
         else:
             raise azcam.exceptions.AzcamError(f"bad filter_id {filter_id} in set_filter")
 
-        time.sleep(2)
-        _ = self.get_loaded_filters()  # update current filter positions
+        # wait for wheel, then verify position unless auto (0)
+        time.sleep(self.settle["filter"])
+        t0 = time.monotonic()
+        while True:
+            filters = self.get_loaded_filters()  # update current filter positions
+            if pint == 0 or filters[fid - 1] == pint:
+                break
+            if time.monotonic() - t0 > self.settle_timeout:
+                azcam.log(f"MS257: filter {fid} not at position {pint}")
+                break
+            time.sleep(self.poll_period)
 
         return
\ No newline at end of file
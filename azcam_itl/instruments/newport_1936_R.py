@@ -1,4 +1,5 @@
 import ctypes
+import threading
 import time
 
 import numpy as np
@@ -12,7 +13,16 @@ class CommandError(Exception):
 
 class NewPort_1936r:
     def __init__(self):
-        pass
+        # seconds to wait for a query reply
+        self.query_timeout = 2.0
+        self.poll_period = 0.002
+
+        # [min, max] wavelength of detector, read once
+        self.lambda_range = None
+        self.wavelength = None
+
+        # device commands from several threads
+        self.lock = threading.RLock()
 
     def initialize(self, **kwargs):
         try:
@@ -157,13 +167,30 @@ class NewPort_1936r:
         query_byte = query_string.encode("ascii")
         query = ctypes.create_string_buffer(query_byte)
         leng = ctypes.c_ulong(ctypes.sizeof(query))
-        status = self.lib.newp_usb_send_ascii(self.device_id, ctypes.byref(query), leng)
-        if status != 0:
-            raise CommandError("Something apperars to be wrong with your query string")
-        else:
-            pass
-        time.sleep(0.2)
-        answer = self.read()
+
+        with self.lock:
+            status = self.lib.newp_usb_send_ascii(
+                self.device_id, ctypes.byref(query), leng
+            )
+            if status != 0:
+                raise CommandError(
+                    "Something apperars to be wrong with your query string"
+                )
+
+            # read as soon as the reply is available
+            t0 = time.monotonic()
+            while True:
+                try:
+                    answer = self.read()
+                    if answer != "":
+                        break
+                except CommandError:
+                    pass
+                if time.monotonic() - t0 > self.query_timeout:
+                    raise CommandError(
+                        f"No reply to {query_string} in {self.query_timeout} sec"
+                    )
+                time.sleep(self.poll_period)
 
         return answer
 
@@ -177,7 +204,10 @@ class NewPort_1936r:
         command = ctypes.create_string_buffer(command_byte)
         length = ctypes.c_ulong(ctypes.sizeof(command))
         cdevice_id = ctypes.c_long(self.device_id)
-        status = self.lib.newp_usb_send_ascii(cdevice_id, ctypes.byref(command), length)
+        with self.lock:
+            status = self.lib.newp_usb_send_ascii(
+                cdevice_id, ctypes.byref(command), length
+            )
         try:
             if status != 0:
                 raise CommandError(
@@ -220,17 +250,31 @@ class NewPort_1936r:
         if isinstance(wavelength, float):
             azcam.log("Warning: Wavelength has to be an integer. Converting to integer")
             wavelength = int(wavelength)
-        if (
-            int(self.query("PM:MIN:Lambda?"))
-            <= wavelength
-            <= int(self.query("PM:MAX:Lambda?"))
-        ):
+        if wavelength == self.wavelength:
+            return
+
+        minlambda, maxlambda = self.get_lambda_range()
+        if minlambda <= wavelength <= maxlambda:
             self.write("PM:Lambda " + str(wavelength))
+            self.wavelength = wavelength
         else:
             azcam.log("Wavelenth out of range, use the current lambda")
 
         return
 
+    def get_lambda_range(self):
+        """
+        Return [min, max] wavelength of the detector, read from the device once.
+        """
+
+        if self.lambda_range is None:
+            self.lambda_range = [
+                int(self.query("PM:MIN:Lambda?")),
+                int(self.query("PM:MAX:Lambda?")),
+            ]
+
+        return self.lambda_range
+
     def set_filtering(self, filter_type=0):
         """
         Set the filtering on the device
@@ -394,6 +438,154 @@ class NewPort_1936r:
         return
 
 
+class PowerSampler(object):
+    """
+    Reads power from a Newport 1936-R continuously in a background thread into
+    a ring buffer of (time, power) samples, so power statistics over a time
+    window are available without blocking on the meter.
+    """
+
+    def __init__(self, meter: NewPort_1936r, size: int = 100000):
+        """
+        Args:
+            meter: initialized power meter.
+            size: number of samples kept.
+        """
+
+        self.meter = meter
+        self.size = size
+
+        # seconds between samples, 0 to read as fast as possible
+        # 0.01 leaves the meter free for other commands between samples
+        self.period = 0.01
+
+        self.times = np.zeros(size)
+        self.values = np.zeros(size)
+        self.count = 0  # total samples read
+        self.start_time = 0.0  # time of first sample at current wavelength
+        self.wavelength = None
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Start sampling if not running.
+        """
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        # meter wavelength may have been changed while not sampling
+        self.wavelength = None
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="power_sampler", daemon=True
+        )
+        self._thread.start()
+
+        return
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        return
+
+    def is_running(self) -> bool:
+        """
+        Return True if sampling.
+        """
+
+        return self._thread is not None and self._thread.is_alive()
+
+    def set_wavelength(self, wavelength):
+        """
+        Set meter wavelength. Samples at the previous wavelength are not used.
+        """
+
+        wavelength = int(wavelength)
+        if wavelength == self.wavelength:
+            return
+
+        self.meter.set_wavelength(wavelength)
+        with self._lock:
+            self.wavelength = wavelength
+            self.start_time = time.monotonic()
+
+        return
+
+    def get_samples(self, t1: float, t2: float = None):
+        """
+        Return arrays of (times, values) of samples between times t1 and t2,
+        from time.monotonic().
+        """
+
+        if t2 is None:
+            t2 = time.monotonic()
+
+        with self._lock:
+            n = min(self.count, self.size)
+            index = (self.count - n + np.arange(n)) % self.size
+            times = self.times[index]
+            values = self.values[index]
+
+        selected = (times >= t1) & (times <= t2)
+
+        return times[selected], values[selected]
+
+    def get_stats(self, window: float = 0.1, wait: bool = True):
+        """
+        Return [mean, sdev, number] of power over the last window seconds.
+        If wait is True and the current wavelength was set less than window
+        seconds ago, wait until window seconds of samples are available.
+        """
+
+        if wait:
+            remaining = self.start_time + window - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+
+        t2 = time.monotonic()
+        t1 = max(t2 - window, self.start_time)
+        _, values = self.get_samples(t1, t2)
+        if len(values) == 0:
+            return [np.nan, np.nan, 0]
+
+        return [float(values.mean()), float(values.std()), len(values)]
+
+    def _run(self):
+        """
+        Sampling thread loop.
+        """
+
+        while not self._stop.is_set():
+            # time before query so no sample is newer than a wavelength change
+            t = time.monotonic()
+            try:
+                power = float(self.meter.query("PM:Power?"))
+            except Exception as e:
+                azcam.log(f"Power sampler error: {e}", level=2)
+                self._stop.wait(1.0)
+                continue
+
+            with self._lock:
+                i = self.count % self.size
+                self.times[i] = t
+                self.values[i] = power
+                self.count += 1
+
+            if self.period > 0:
+                self._stop.wait(self.period)
+
+
 if __name__ == "__main__":
     # Initialze a instrument tool. You might have to change the LIBname or product_id.
     nd = NewPort_1936r()
@@ -8,12 +8,14 @@ Serial port is mapped to COM13 on quantum PC through moxaeb.
 
 # TODO: reformat to fix cases and variable names
 
+import math
 import time
 
 import serial
 
 import azcam
 import azcam.exceptions
+from azcam_itl.instruments.serial_transport import SerialTransport
 
 
 class PolluxCtrl(object):
@@ -30,32 +32,46 @@ class PolluxCtrl(object):
         self.XonXoff = 0
         self.maxCtrl = 3
 
+        self.transport = None  # SerialTransport, created in initialize()
+
         self.valid_axes = [1, 2, 3]
 
+        # motion waits, in seconds
+        self.min_poll = 0.01  # first status poll period after expected end of move
+        self.max_poll = 0.2  # poll period grows up to this value
+        self.motion_timeout = 40.0  # added to expected move time
+        self.settle_fraction = 0.9  # fraction of expected move time to sleep before polling
+
+        self.positions = {}  # last commanded or read position of each axis
+        self.motion_params = {}  # (velocity, acceleration) of each axis
+        self.motion_end = {}  # expected end time of last move of each axis
+
     def initialize(self):
         if self.is_initialized:
             return
 
-        # create serial object
+        self.transport = SerialTransport(
+            self.ComPort,
+            self.BaudRate,
+            self.ByteSize,
+            self.Parity,
+            self.StopBits,
+            self.RtsCts,
+            self.XonXoff,
+        )
+        self.transport.timeout = self.Timeout
+
+        # open serial port
         try:
-            self.sPort = serial.Serial(
-                port=self.ComPort,
-                baudrate=self.BaudRate,
-                timeout=self.Timeout,
-                parity=self.Parity,
-                stopbits=self.StopBits,
-                bytesize=self.ByteSize,
-                rtscts=self.RtsCts,
-                xonxoff=self.XonXoff,
-            )
+            self.transport.open()
+            self.isOpen = 1
         except Exception as message:
             azcam.log(message)
-            self.sPort = 0
 
         # identify all controllers
         self.nAxis = 0
 
-        if self.sPort != 0 and self.sPort.isOpen():
+        if self.isOpen:
             self.identify()
 
         self.is_initialized = 1
@@ -68,44 +84,19 @@ class PolluxCtrl(object):
         26Oct2015 last change Zareba
         """
 
-        if self.sPort == 0:
-            try:
-                self.sPort = serial.Serial(
-                    port=self.ComPort,
-                    baudrate=self.BaudRate,
-                    timeout=self.Timeout,
-                    parity=self.Parity,
-                    stopbits=self.StopBits,
-                    bytesize=self.ByteSize,
-                    rtscts=self.RtsCts,
-                    xonxoff=self.XonXoff,
-                )
-
-                message = (
-                    "Port name = %s" % (self.sPort.name),
-                    " Port is open = %s" % (self.sPort.isOpen()),
-                )
-                return ["OK", message]
-            except Exception as message:
-                return ["ERROR", message]
-
-        else:
-            try:
-                if self.sPort.isOpen():
-                    message = (
-                        "Port name = %s" % (self.sPort.name),
-                        " Port is open = %s" % (self.sPort.isOpen()),
-                    )
-                else:
-                    self.sPort.open()
-                    message = (
-                        "Port name = %s" % (self.sPort.name),
-                        " Port is open = %s" % (self.sPort.isOpen()),
-                    )
+        if self.transport is None:
+            return ["ERROR", "Serial port is not initialized"]
 
-                return ["OK", message]
-            except Exception as message:
-                return ["ERROR", message]
+        try:
+            self.transport.open()
+            self.isOpen = 1
+            message = (
+                "Port name = %s" % (self.transport.port),
+                " Port is open = %s" % (self.transport.is_open()),
+            )
+            return ["OK", message]
+        except Exception as message:
+            return ["ERROR", message]
 
     def close_port(self):
         """
@@ -113,14 +104,13 @@ class PolluxCtrl(object):
         22Oct2015 last change Zareba
         """
 
-        try:
-            if self.sPort != 0:
-                self.sPort.close()
-                return ["OK"]
-            else:
-                return ["ERROR", "Port not opened"]
-        except Exception as message:
-            return ["ERROR", message]
+        if self.transport is None:
+            return ["ERROR", "Port not opened"]
+
+        self.transport.close()
+        self.isOpen = 0
+
+        return ["OK"]
 
     def get_port_status(self):
         """
@@ -128,39 +118,109 @@ class PolluxCtrl(object):
         22Oct2015 last change Zareba
         """
 
-        if self.sPort != 0:
-            try:
-                message = (
-                    "Port name = %s" % (self.sPort.name),
-                    " Port is open = %s" % (self.sPort.isOpen()),
-                )
-                return ["OK", message]
-
-            except Exception as message:
-                return ["ERROR", message]
-        else:
+        if self.transport is None:
             return ["ERROR", "Serial port is not initialized"]
 
+        message = (
+            "Port name = %s" % (self.transport.port),
+            " Port is open = %s" % (self.transport.is_open()),
+        )
+
+        return ["OK", message]
+
+    def _check_port(self):
+        """
+        Raise AzcamError if the serial port is not open.
+        The transport reopens the port itself after serial errors.
+        """
+
+        if self.transport is None or not self.isOpen:
+            raise azcam.exceptions.AzcamError("Pollux serial port not open")
+
+        return
+
+    def _readline(self) -> str:
+        """
+        Read a reply line, empty string if none arrives within Timeout.
+        """
+
+        try:
+            reply = self.transport.read(b"\n", timeout=self.Timeout)
+        except azcam.exceptions.AzcamError:
+            return ""
+
+        return reply.decode().strip("\r\n")
+
+    def _query(self, command: str) -> str:
+        """
+        Send a command and return its reply line.
+        Stale input is discarded first, raises AzcamError if no reply.
+        """
+
+        reply = self.transport.transact(command, terminator=b"\n")
+
+        return reply.decode().strip("\r\n")
+
     def send_cmd(self, command: str, readback: bool = True):
         """
         Send a command to the pollux stage and optional read reply.
         Includes string cleanup.
+        Raises AzcamError if a reply is expected but none arrives.
         """
 
-        if self.sPort.isOpen():
-            cmd = command + "\r\n"
+        self._check_port()
 
-            reply = self.sPort.write(str.encode(cmd))
-            # self.sPort.flush()
+        cmd = command + "\r\n"
 
-            if readback:
-                reply = self.sPort.readline().decode().strip("\r\n").strip()
-                return reply
+        if readback:
+            return self._query(cmd).strip()
+
+        self.transport.write(cmd)
+
+        return
+
+    def send_batch(self, commands: list) -> list:
+        """
+        Send several commands in one write and read their replies together.
+        Replies are returned in command order, so commands for several axes
+        cost a single serial round trip. Replies are matched to commands by
+        position, so stale input is discarded first and a missing reply is an error.
+
+        Args:
+            commands: list of command strings (no reply) or (command, readback) tuples.
+        Returns:
+            list of replies for the commands with readback.
+        Raises AzcamError if fewer replies than expected are read.
+        """
+
+        self._check_port()
+
+        data = ""
+        number_replies = 0
+        for command in commands:
+            if isinstance(command, str):
+                command, readback = command, False
             else:
-                return
+                command, readback = command
+            data += command + "\r\n"
+            if readback:
+                number_replies += 1
+
+        replies = []
+        with self.transport.lock:
+            self.transport.clear()
+            self.transport.write(data)
+
+            for i in range(number_replies):
+                try:
+                    line = self.transport.read(b"\n", timeout=self.Timeout)
+                except azcam.exceptions.AzcamError:
+                    raise azcam.exceptions.AzcamError(
+                        f"Pollux batch reply timeout, {i} of {number_replies} replies read"
+                    )
+                replies.append(line.decode().strip("\r\n").strip())
 
-        else:
-            raise azcam.exceptions.AzcamError("Pollux serial port not open")
+        return replies
 
     def get_reply(self):
         """
@@ -168,20 +228,13 @@ class PolluxCtrl(object):
         26Oct2015 last change Zareba
         """
 
-        if self.sPort != 0:
-            try:
-                if self.sPort.isOpen():
-                    reply = self.sPort.readline().decode().strip("\r\n")
-                    return ["OK", reply]
-                else:
-                    return ["ERROR", "Serial port is not opened"]
+        if self.transport is None:
+            return ["ERROR", "Serial port is not initialized"]
 
-            except Exception as message:
-                return ["ERROR", message]
-            pass
+        if not self.isOpen:
+            return ["ERROR", "Serial port is not opened"]
 
-        else:
-            return ["ERROR", "Serial port is not initialized"]
+        return ["OK", self._readline()]
 
     def identify(self, disp=-1):
         """
@@ -192,43 +245,33 @@ class PolluxCtrl(object):
         self.nAxis = 0
         self.nNames = []
 
-        if self.sPort != 0:
-            try:
-                if not self.sPort.isOpen():
-                    self.sPort = serial.Serial(
-                        port=self.ComPort,
-                        baudrate=self.BaudRate,
-                        timeout=self.Timeout,
-                        parity=self.Parity,
-                        stopbits=self.StopBits,
-                        bytesize=self.ByteSize,
-                        rtscts=self.RtsCts,
-                        xonxoff=self.XonXoff,
-                    )
-
-                for nport in range(1, self.maxCtrl + 1):
-                    cmd = str(nport) + "  nidentify\r\n"
-                    self.sPort.write(str.encode(cmd))
+        if self.transport is None:
+            return ["ERROR", "Serial port is not initialized"]
 
-                    reply = self.sPort.readline().decode().strip("\r\n")
+        try:
+            self.transport.open()
 
-                    if len(reply) > 0:
-                        self.nAxis += 1
+            for nport in range(1, self.maxCtrl + 1):
+                cmd = str(nport) + "  nidentify\r\n"
+                with self.transport.lock:
+                    self.transport.clear()
+                    self.transport.write(cmd)
+                    reply = self._readline()
 
-                        self.nNames.append(reply.strip("r\n"))
+                if len(reply) > 0:
+                    self.nAxis += 1
 
-                if disp != -1:
-                    for nport in range(1, self.maxCtrl + 1):
-                        azcam.log("Controller ", nport, " ", self.nNames[nport - 1])
+                    self.nNames.append(reply.strip("r\n"))
 
-                    message = "Found %s %s" % (self.nAxis, "controllers")
-                    return ["OK", message]
+            if disp != -1:
+                for nport in range(1, self.maxCtrl + 1):
+                    azcam.log("Controller ", nport, " ", self.nNames[nport - 1])
 
-            except Exception as message:
-                return ["ERROR", message]
+                message = "Found %s %s" % (self.nAxis, "controllers")
+                return ["OK", message]
 
-        else:
-            return ["ERROR", "Serial port is not initialized"]
+        except Exception as message:
+            return ["ERROR", message]
 
     def get_error(self, nAxis):
         """
@@ -250,38 +293,23 @@ class PolluxCtrl(object):
         18May2017 last change Zareba
         """
 
-        if self.sPort != 0:
-            try:
-                if Wait:
-                    loop = 0
-                    while loop < 200:
-                        reply = self.get_status(nAxis)
-                        try:
-                            flag = int(reply[1])
-                        except Exception as e:
-                            flag = 1
-
-                        if flag == 1:
-                            loop += 1
-                            time.sleep(0.2)
-                            continue
-                        else:
-                            loop = 200
-
-                cmd = str(nAxis) + "  npos\r\n"
-                self.sPort.write(str.encode(cmd))
+        if self.transport is None:
+            return ["ERROR", "Serial port is not initialized"]
 
-                reply = self.sPort.readline().decode().strip("\r\n")
+        try:
+            if Wait:
+                self.wait_motion(nAxis)
 
-                reply = float(reply)
+            cmd = str(nAxis) + "  npos\r\n"
+            reply = self._query(cmd)
 
-                return ["OK", reply]
+            reply = float(reply)
+            self.positions[nAxis] = reply
 
-            except Exception as message:
-                return ["ERROR", message]
+            return ["OK", reply]
 
-        else:
-            return ["ERROR", "Serial port is not initialized"]
+        except Exception as message:
+            return ["ERROR", message]
 
     def get_motion(self, nAxis, Wait=0):
         """
@@ -289,33 +317,183 @@ class PolluxCtrl(object):
         04May16 last change MPL
         """
 
-        if self.sPort != 0:
+        if self.transport is None:
+            return ["ERROR", "Serial port is not initialized"]
+
+        try:
+            if Wait:
+                self.wait_motion(nAxis, timeout=20.0)
+
+            reply = self.get_status(nAxis)
+            try:
+                flag = int(reply[1])
+            except Exception as e:
+                flag = 1
+
+            return ["OK", flag]
+
+        except Exception as message:
+            return ["ERROR", message]
+
+    def get_positions(self, axes: list) -> dict:
+        """
+        Get positions of several axes with one batched query.
+        Returns dict of axis: position.
+        """
+
+        replies = self.send_batch([(f"{a}  npos", True) for a in axes])
+
+        positions = {}
+        for nAxis, reply in zip(axes, replies):
+            positions[nAxis] = float(reply)
+        self.positions.update(positions)
+
+        return positions
+
+    def moving_axes(self, axes: list) -> list:
+        """
+        Return the axes which are executing a command (status bit 0), with one
+        batched status query. An axis with no valid status is moving.
+        """
+
+        replies = self.send_batch([(f"{a}  nst", True) for a in axes])
+
+        moving = []
+        for nAxis, reply in zip(axes, replies):
             try:
-                loop = 0
-                while 1 and loop < 100:
-                    reply = self.get_status(nAxis)
-                    try:
-                        flag = int(reply[1])
-                    except Exception as e:
-                        flag = 1
-
-                    if Wait:
-                        if flag == 1:
-                            loop += 1
-                            time.sleep(0.2)
-                            continue
-                        else:
-                            return ["OK", flag]
-                    else:
-                        break
-
-                return ["OK", flag]
-
-            except Exception as message:
-                return ["ERROR", message]
+                flag = int(reply)
+            except Exception:
+                flag = 1
+            if flag & 1:
+                moving.append(nAxis)
+
+        return moving
+
+    def is_moving(self, nAxis) -> bool:
+        """
+        Return True if nAxis is executing a command (status bit 0).
+        """
+
+        return len(self.moving_axes([nAxis])) > 0
+
+    def get_motion_params(self, nAxis) -> tuple:
+        """
+        Return (velocity, acceleration) of nAxis, read once from the controller.
+        """
+
+        if nAxis not in self.motion_params:
+            velocity = float(self.get_velocity(nAxis)[1])
+            acceleration = float(self.get_acceleration(nAxis))
+            self.motion_params[nAxis] = (velocity, acceleration)
 
+        return self.motion_params[nAxis]
+
+    def estimate_move_time(self, nAxis, distance: float) -> float:
+        """
+        Return expected time in seconds to move nAxis by distance, from a
+        trapezoidal velocity profile. Returns 0 if velocity is unknown.
+        """
+
+        try:
+            velocity, acceleration = self.get_motion_params(nAxis)
+        except Exception:
+            return 0.0
+        if velocity <= 0 or acceleration <= 0:
+            return 0.0
+
+        distance = abs(distance)
+        if distance < velocity * velocity / acceleration:
+            # never reaches full velocity
+            return 2.0 * math.sqrt(distance / acceleration)
+
+        return distance / velocity + velocity / acceleration
+
+    def wait_motion(self, axes, timeout: float = None) -> bool:
+        """
+        Wait for motion of one or more axes to finish.
+        Sleeps for most of the expected move time, then polls status with an
+        increasing period.
+
+        Args:
+            axes: axis number or list of axis numbers.
+            timeout: maximum wait in seconds, default is motion_timeout plus expected time.
+        Returns:
+            True if motion finished, False on timeout.
+        """
+
+        if isinstance(axes, int):
+            axes = [axes]
+
+        t0 = time.monotonic()
+        expected = max([self.motion_end.get(a, t0) for a in axes]) - t0
+        expected = max(expected, 0.0)
+        if timeout is None:
+            timeout = self.motion_timeout + expected
+
+        if expected > 0:
+            time.sleep(self.settle_fraction * expected)
+
+        poll = self.min_poll
+        moving = list(axes)
+        while True:
+            moving = self.moving_axes(moving)
+            if len(moving) == 0:
+                return True
+            if time.monotonic() - t0 > timeout:
+                azcam.log(f"Pollux motion timeout on axes {moving}")
+                return False
+            time.sleep(poll)
+            poll = min(poll * 1.5, self.max_poll)
+
+    def _start_move(self, nAxis, distance: float):
+        """
+        Record the expected end time of a move.
+        """
+
+        if distance is None:
+            self.motion_end.pop(nAxis, None)
         else:
-            return ["ERROR", "Serial port is not initialized"]
+            estimate = self.estimate_move_time(nAxis, distance)
+            self.motion_end[nAxis] = time.monotonic() + estimate
+
+        return
+
+    def move_axes(self, positions: dict, relative: bool = False, wait: bool = True):
+        """
+        Move several axes at once with one batched write and optionally wait
+        for all to finish.
+
+        Args:
+            positions: dict of axis: position (or step if relative).
+            relative: True for relative moves.
+            wait: wait for motion of all axes to finish.
+        Returns:
+            True if motion finished (or not waiting), False on timeout.
+        """
+
+        if not relative:
+            unknown = [a for a in positions if a not in self.positions]
+            if len(unknown) > 0:
+                self.get_positions(unknown)
+
+        commands = []
+        for nAxis, value in positions.items():
+            value = float(value)
+            if relative:
+                commands.append(f"{value:f} {nAxis}  nr")
+                self._start_move(nAxis, value)
+                if nAxis in self.positions:
+                    self.positions[nAxis] += value
+            else:
+                commands.append(f"{value:f} {nAxis}  nm")
+                self._start_move(nAxis, value - self.positions[nAxis])
+                self.positions[nAxis] = value
+        self.send_batch(commands)
+
+        if wait:
+            return self.wait_motion(list(positions))
+
+        return True
 
     def get_status(self, nAxis):
         """
@@ -333,20 +511,17 @@ class PolluxCtrl(object):
         26Oct2015 last change Zareba
         """
 
-        if self.sPort != 0:
-            try:
-                cmd = str(nAxis) + "  getswst\r\n"
-                self.sPort.write(str.encode(cmd))
-
-                reply = self.sPort.readline().decode().strip("\r\n").strip()
+        if self.transport is None:
+            return ["ERROR", "Serial port is not initialized"]
 
-                return ["OK", reply]
+        try:
+            cmd = str(nAxis) + "  getswst\r\n"
+            reply = self._query(cmd).strip()
 
-            except Exception as message:
-                return ["ERROR", message]
+            return ["OK", reply]
 
-        else:
-            return ["ERROR", "Serial port is not initialized"]
+        except Exception as message:
+            return ["ERROR", message]
 
     def get_limits(self, nAxis):
         """
@@ -365,20 +540,17 @@ class PolluxCtrl(object):
         26Oct2015 last change Zareba
         """
 
-        if self.sPort != 0:
-            try:
-                cmd = str(nAxis) + "  gnv\r\n"
-                self.sPort.write(str.encode(cmd))
-
-                reply = self.sPort.readline().decode().strip("\r\n")
+        if self.transport is None:
+            return ["ERROR", "Serial port is not initialized"]
 
-                return ["OK", reply]
+        try:
+            cmd = str(nAxis) + "  gnv\r\n"
+            reply = self._query(cmd)
 
-            except Exception as message:
-                return ["ERROR", message]
+            return ["OK", reply]
 
-        else:
-            return ["ERROR", "Serial port is not initialized"]
+        except Exception as message:
+            return ["ERROR", message]
 
     def set_velocity(self, nAxis, value):
         """
@@ -387,6 +559,7 @@ class PolluxCtrl(object):
 
         cmd = str(format(value, "f")) + " " + str(nAxis) + "  snv"
         self.send_cmd(cmd, False)
+        self.motion_params.pop(nAxis, None)
 
         return
 
@@ -409,6 +582,7 @@ class PolluxCtrl(object):
 
         cmd = str(format(value, "f")) + " " + str(nAxis) + "  sna"
         self.send_cmd(cmd, False)
+        self.motion_params.pop(nAxis, None)
 
         return
 
@@ -420,6 +594,10 @@ class PolluxCtrl(object):
         cmd = str(format(pos, "f")) + " " + str(nAxis) + "  nm"
         self.send_cmd(cmd, False)
 
+        current = self.positions.get(nAxis)
+        self._start_move(nAxis, None if current is None else pos - current)
+        self.positions[nAxis] = pos
+
         return
 
     def move_relative(self, nAxis, step):
@@ -430,6 +608,10 @@ class PolluxCtrl(object):
         cmd = str(format(step, "f")) + " " + str(nAxis) + "  nr"
         self.send_cmd(cmd, False)
 
+        self._start_move(nAxis, step)
+        if nAxis in self.positions:
+            self.positions[nAxis] += step
+
         return
 
     def calibrate(self, nAxis):
@@ -442,6 +624,8 @@ class PolluxCtrl(object):
 
         cmd = str(nAxis) + "  ncal"
         self.send_cmd(cmd, False)
+        self._start_move(nAxis, None)
+        self.positions.pop(nAxis, None)
 
         self.get_motion(nAxis, True)
 
@@ -454,6 +638,8 @@ class PolluxCtrl(object):
 
         cmd = str(nAxis) + "  nrm"
         self.send_cmd(cmd, False)
+        self._start_move(nAxis, None)
+        self.positions.pop(nAxis, None)
 
         self.get_motion(nAxis, True)
 
@@ -466,6 +652,7 @@ class PolluxCtrl(object):
 
         cmd = str(0) + " " + str(nAxis) + "  setnpos"
         self.send_cmd(cmd, False)
+        self.positions[nAxis] = 0.0
 
         return
 
@@ -474,8 +661,7 @@ class PolluxCtrl(object):
         Go to home position for nAxis - equivalent to the absolute move to 0 position.
         """
 
-        cmd = str(0) + " " + str(nAxis) + "  nm"
-        self.send_cmd(cmd, False)
+        self.move_absolute(nAxis, 0)
 
         return
 
@@ -486,6 +672,8 @@ class PolluxCtrl(object):
 
         cmd = str(nAxis) + "  nreset\r\n"
         self.send_cmd(cmd, False)
+        self._start_move(nAxis, None)
+        self.positions.pop(nAxis, None)
 
         return
 
@@ -1,9 +1,8 @@
-import time
-
 import serial
 
 import azcam
 import azcam.exceptions
+from azcam_itl.instruments.serial_transport import SerialTransport
 
 
 class PressureController(object):
@@ -14,15 +13,14 @@ class PressureController(object):
     def __init__(self, port):
 
         self.ComPort = port
-        self.BaudRate = 9600
-        self.Parity = serial.PARITY_NONE
-        self.ByteSize = 8
-        self.StopBits = 1
-        self.timeout = 0
-        self.RtsCts = 0
-        self.XonXoff = 0
 
-        self.ser = 0
+        self.transport = SerialTransport(port, 9600, 8, serial.PARITY_NONE, 1)
+
+        # keep port open between commands, reopened after errors
+        self.persistent = True
+
+        # seconds to wait for a complete reply
+        self.transport.timeout = 1.0
 
     def initialize(self):
         """
@@ -40,21 +38,11 @@ class PressureController(object):
         Open serial port.
         """
 
-        if self.ser == 0 or not self.ser.isOpen():
-            try:
-                self.ser = serial.Serial(
-                    port=self.ComPort,
-                    baudrate=self.BaudRate,
-                    timeout=self.timeout,
-                    parity=self.Parity,
-                    stopbits=self.StopBits,
-                    bytesize=self.ByteSize,
-                    rtscts=self.RtsCts,
-                    xonxoff=self.XonXoff,
-                )
-            except Exception as message:
-                azcam.log(message)
-                azcam.exceptions.AzcamError("could not open pressure serial port")
+        try:
+            self.transport.open()
+        except Exception as message:
+            azcam.log(message)
+            azcam.log("could not open pressure serial port")
 
         return
 
@@ -63,63 +51,43 @@ class PressureController(object):
         Close serial port.
         """
 
-        try:
-            self.ser.close()
-        except Exception:
-            pass
+        self.transport.close()
 
         return
 
-    def read_port(self, number_bytes):
+    def transact(self, code: str) -> str:
         """
-        Read serial port.
+        Send a command like "PR1?" and return the reply frame up to the ";FF" terminator.
+        The port is reopened and the command sent again after an error.
         """
 
-        reply = ""
-        byte_count = 0
-        loop = 50
-        timeout = 1.0
-        loop_time = 0.0
+        reply = self.transport.transact(f"@253{code};FF", terminator=b";FF")
+        if not self.persistent:
+            self.close_port()
 
-        while loop_time < timeout:
+        return reply.decode(errors="replace")
 
-            # wait for bytes at port
-            for lcount in range(loop):
-                current_bytes = self.ser.in_waiting
-                if current_bytes == 0:
-                    time.sleep(0.01)
-                else:
-                    break
+    def query(self, code: str) -> str:
+        """
+        Send a command like "PR1?" and return the reply value.
+        Raises AzcamError if the controller does not acknowledge the command.
+        """
 
-            if current_bytes > 0:
-                reply1 = self.ser.read(current_bytes).decode()
-                byte_count += current_bytes
-                reply += reply1
+        # like @253ACK7.60E+2;FF or @253NAK160;FF
+        reply = self.transact(code)
+        i = reply.rfind("@253")
+        if reply[i + 4 : i + 7] != "ACK":
+            raise azcam.exceptions.AzcamError(f"MKS900 command error: {reply}")
 
-            if byte_count >= number_bytes:
-                break
-            else:
-                loop_time += 0.5
-
-        return reply
+        return reply[i + 7 : -3]
 
     def read_pressure(self, pressure_id: int = 1):
         """
         read pressure in Torr.
         """
 
-        self.close_port()
-        self.open_port()
-
-        self.ser.write(str.encode(f"@253PR{pressure_id}?;FF"))
-        reply = self.read_port(17)
-        if reply == "":
-            return -999
-
-        # reply = self.ser.read(17).decode()
-        reply = reply[7:14]
         try:
-            pressure = float(reply)
+            pressure = float(self.query(f"PR{pressure_id}?"))
         except Exception as message:
             # azcam.log("Could not read pressure:%s" % message)
             pressure = -999
@@ -131,14 +99,19 @@ class PressureController(object):
         Create and send a command.
         """
 
-        self.open_port()
+        if code.endswith(";FF"):
+            code = code[:-3]
 
-        command = f"@253{code}"
-        self.ser.write(str.encode(command))
+        try:
+            reply = self.transact(code)
+        except azcam.exceptions.AzcamError:
+            reply = ""
 
-        reply = self.read_port(17)
-        # reply = self.ser.read(17).decode()
+        return reply
 
-        self.close_port()
+    def get_metrics(self) -> dict:
+        """
+        Return session metrics, latencies in seconds from command to reply.
+        """
 
-        return reply
+        return self.transport.get_metrics()
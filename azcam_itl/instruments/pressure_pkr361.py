@@ -1,7 +1,9 @@
 import serial
 
 import azcam
+import azcam.exceptions
 import azcam.utils
+from azcam_itl.instruments.serial_transport import SerialTransport
 
 
 class PressureController(object):
@@ -14,15 +16,10 @@ class PressureController(object):
     def __init__(self, port="COM1"):
 
         self.ComPort = port
-        self.BaudRate = 600
-        self.Parity = serial.PARITY_NONE
-        self.ByteSize = 7
-        self.StopBits = 2
-        self.timeout = 2
-        self.RtsCts = 0
-        self.XonXoff = 0
 
-        self.ser = 0
+        self.transport = SerialTransport(port, 600, 7, serial.PARITY_NONE, 2)
+        self.transport.timeout = 2.0
+        self.transport.on_open = self._set_lines
 
     def initialize(self):
         """
@@ -40,25 +37,22 @@ class PressureController(object):
         Open serial port.
         """
 
-        if self.ser == 0 or not self.ser.isOpen():
-            try:
-                self.ser = serial.Serial(
-                    port=self.ComPort,
-                    baudrate=self.BaudRate,
-                    timeout=self.timeout,
-                    parity=self.Parity,
-                    stopbits=self.StopBits,
-                    bytesize=self.ByteSize,
-                    rtscts=self.RtsCts,
-                    xonxoff=self.XonXoff,
-                )
-
-                self.ser.setRTS(0)
-                self.ser.setDTR(1)
-
-            except Exception as message:
-                azcam.log(message)
-                return ["ERROR", "could not open pressure serial port"]
+        try:
+            self.transport.open()
+        except Exception as message:
+            azcam.log(message)
+            return ["ERROR", "could not open pressure serial port"]
+
+        return
+
+    @staticmethod
+    def _set_lines(ser):
+        """
+        Set control lines when port opens.
+        """
+
+        ser.setRTS(0)
+        ser.setDTR(1)
 
         return
 
@@ -67,10 +61,10 @@ class PressureController(object):
         read pressure in Torr.
         """
 
-        reply = self.open_port()
-
-        reply = self.ser.write(str.encode("D"))
-        reply = self.ser.read(14).decode()
+        try:
+            reply = self.transport.transact(b"D", length=14).decode()
+        except azcam.exceptions.AzcamError:
+            reply = ""
 
         try:
             tokens = azcam.utils.parse(reply)
@@ -87,9 +81,6 @@ class PressureController(object):
         Close serial port.
         """
 
-        try:
-            self.ser.close()
-        except Exception:
-            pass
+        self.transport.close()
 
         return
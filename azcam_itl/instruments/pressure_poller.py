@@ -0,0 +1,197 @@
+"""
+Pressure poller service.
+Reads each pressure gauge in its own background thread on its own schedule
+and keeps time-stamped readings in ring buffers, so scripts, header keywords
+and status requests read pressures without using serial ports.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+import azcam
+
+
+class PressurePoller(object):
+    """
+    Polls pressure gauges concurrently into ring buffers of (time, pressure).
+    Times are from time.time().
+    """
+
+    def __init__(self, size: int = 10000, max_age: float = 10.0):
+        """
+        Args:
+            size: number of readings kept for each gauge.
+            max_age: seconds after which the latest reading is stale.
+        """
+
+        self.size = size
+        self.max_age = max_age
+
+        self.gauges = {}  # pressure_id: [reader, period]
+        self.times = {}  # pressure_id: array of reading times
+        self.values = {}  # pressure_id: array of pressures
+        self.counts = {}  # pressure_id: total readings
+
+        self._lock = threading.Lock()
+        self._threads = {}  # pressure_id: polling thread
+        self._stops = {}  # pressure_id: event to stop polling thread
+
+    def add(self, pressure_id: int, reader, period: float = 1.0):
+        """
+        Add a gauge, or replace a gauge with the same ID.
+        If polling, the gauge is polled with the new reader from now on.
+
+        Args:
+            pressure_id: gauge ID, as in get_pressure(pressure_id).
+            reader: function returning pressure in Torr.
+            period: seconds between readings.
+        """
+
+        running = self.is_running()
+        self._stop_gauge(pressure_id)
+
+        with self._lock:
+            self.gauges[pressure_id] = [reader, period]
+            self.times[pressure_id] = np.zeros(self.size)
+            self.values[pressure_id] = np.zeros(self.size)
+            self.counts[pressure_id] = 0
+
+        if running:
+            self._start_gauge(pressure_id)
+
+        return
+
+    def start(self):
+        """
+        Start polling each gauge which is not running.
+        """
+
+        for pressure_id in list(self.gauges):
+            self._start_gauge(pressure_id)
+
+        return
+
+    def stop(self):
+        """
+        Stop polling.
+        """
+
+        for pressure_id in list(self._threads):
+            self._stop_gauge(pressure_id)
+
+        return
+
+    def _start_gauge(self, pressure_id: int):
+        """
+        Start the polling thread of a gauge if not running.
+        """
+
+        thread = self._threads.get(pressure_id)
+        if thread is not None and thread.is_alive():
+            return
+
+        reader, period = self.gauges[pressure_id]
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._run,
+            args=(pressure_id, reader, period, stop),
+            name=f"pressure_poller_{pressure_id}",
+            daemon=True,
+        )
+        self._stops[pressure_id] = stop
+        self._threads[pressure_id] = thread
+        thread.start()
+
+        return
+
+    def _stop_gauge(self, pressure_id: int):
+        """
+        Stop the polling thread of a gauge and wait for it to end.
+        """
+
+        thread = self._threads.pop(pressure_id, None)
+        stop = self._stops.pop(pressure_id, None)
+        if stop is not None:
+            stop.set()
+        if thread is not None:
+            thread.join()
+
+        return
+
+    def is_running(self) -> bool:
+        """
+        Return True if polling.
+        """
+
+        return any(thread.is_alive() for thread in self._threads.values())
+
+    def get_pressure(self, pressure_id: int = 0) -> float:
+        """
+        Return latest pressure for a gauge, -999 if none or stale.
+        """
+
+        with self._lock:
+            count = self.counts.get(pressure_id, 0)
+            if count == 0:
+                return -999
+            i = (count - 1) % self.size
+            t = self.times[pressure_id][i]
+            pressure = float(self.values[pressure_id][i])
+
+        if time.time() - t > self.max_age:
+            return -999
+
+        return pressure
+
+    def get_pressures(self, pressure_ids: list = None) -> list:
+        """
+        Return latest pressures for a list of gauges, default all.
+        """
+
+        if pressure_ids is None:
+            pressure_ids = list(self.gauges)
+
+        return [self.get_pressure(pressure_id) for pressure_id in pressure_ids]
+
+    def get_history(self, pressure_id: int = 0, t1: float = 0.0, t2: float = None):
+        """
+        Return arrays of (times, pressures) for a gauge between times t1 and t2.
+        """
+
+        if t2 is None:
+            t2 = time.time()
+
+        with self._lock:
+            count = self.counts.get(pressure_id, 0)
+            n = min(count, self.size)
+            index = (count - n + np.arange(n)) % self.size
+            times = self.times[pressure_id][index]
+            values = self.values[pressure_id][index]
+
+        selected = (times >= t1) & (times <= t2)
+
+        return times[selected], values[selected]
+
+    def _run(self, pressure_id, reader, period, stop):
+        """
+        Polling thread loop for one gauge.
+        """
+
+        while not stop.is_set():
+            t0 = time.monotonic()
+            try:
+                pressure = float(reader())
+            except Exception as e:
+                azcam.log(f"Pressure poller error on gauge {pressure_id}: {e}", level=2)
+                stop.wait(max(period, 1.0))
+                continue
+
+            with self._lock:
+                i = self.counts[pressure_id] % self.size
+                self.times[pressure_id][i] = time.time()
+                self.values[pressure_id][i] = pressure
+                self.counts[pressure_id] += 1
+
+            stop.wait(max(0.0, period - (time.monotonic() - t0)))
@@ -1,9 +1,13 @@
+import threading
 import time
 
+import numpy as np
 import serial
 
 import azcam
+import azcam.exceptions
 import azcam.utils
+from azcam_itl.instruments.serial_transport import SerialTransport
 
 
 class PressureController(object):
@@ -13,16 +17,26 @@ class PressureController(object):
 
     def __init__(self, port="COM1"):
         self.ComPort = port
-        # self.BaudRate = 9600
-        self.BaudRate = 115200
-        self.Parity = serial.PARITY_NONE
-        self.ByteSize = 8
-        self.StopBits = 1
-        self.timeout = 0  # 2.0
-        self.RtsCts = 0
-        self.XonXoff = 0
 
-        self.ser = 0
+        # self.transport = SerialTransport(port, 9600)
+        self.transport = SerialTransport(port, 115200, 8, serial.PARITY_NONE, 1)
+
+        # seconds to wait for a complete reply
+        self.transport.timeout = 1.0
+
+        # continuous output interval code for COM, 0=100 ms, 1=1 sec, 2=1 min
+        self.stream_interval = 1
+
+        # seconds after which the latest streamed reading is stale
+        self.stream_max_age = 5.0
+
+        # streamed readings ring buffer, times from time.time()
+        self.streaming = False
+        self.stream_size = 10000
+        self.stream_times = np.zeros(self.stream_size)
+        self.stream_values = np.zeros(self.stream_size)
+        self.stream_count = 0  # total readings received
+        self._stream_lock = threading.Lock()
 
     def initialize(self):
         """
@@ -40,21 +54,11 @@ class PressureController(object):
         Open serial port.
         """
 
-        if self.ser == 0 or not self.ser.isOpen():
-            try:
-                self.ser = serial.Serial(
-                    port=self.ComPort,
-                    baudrate=self.BaudRate,
-                    timeout=self.timeout,
-                    parity=self.Parity,
-                    stopbits=self.StopBits,
-                    bytesize=self.ByteSize,
-                    rtscts=self.RtsCts,
-                    xonxoff=self.XonXoff,
-                )
-            except Exception as message:
-                azcam.log(message)
-                azcam.log("could not open pressure serial port")
+        try:
+            self.transport.open()
+        except Exception as message:
+            azcam.log(message)
+            azcam.log("could not open pressure serial port")
 
         return
 
@@ -63,47 +67,14 @@ class PressureController(object):
         Close serial port.
         """
 
-        try:
-            self.ser.close()
-        except Exception as e:
-            pass
+        if self.streaming:
+            self.transport.stop_reader()
+            self.streaming = False
 
-        self.ser = 0
+        self.transport.close()
 
         return
 
-    def read_port(self, number_bytes):
-        """
-        Read serial port.
-        """
-
-        reply = ""
-        byte_count = 0
-        loop = 50
-        timeout = 1.0
-        loop_time = 0.0
-
-        while loop_time < timeout:
-            # wait for bytes at port
-            for lcount in range(loop):
-                current_bytes = self.ser.in_waiting
-                if current_bytes == 0:
-                    time.sleep(0.01)
-                else:
-                    break
-
-            if current_bytes > 0:
-                reply1 = self.ser.read(current_bytes).decode()
-                byte_count += current_bytes
-                reply += reply1
-
-            if byte_count >= number_bytes:
-                break
-            else:
-                loop_time += 0.5
-
-        return reply
-
     def clear(self, showdata=0):
         """
         Clear controller communications.
@@ -111,33 +82,28 @@ class PressureController(object):
 
         self.open_port()
 
-        self.ser.reset_input_buffer()
-
-        loop = 0
-        while 1:
-            if self.ser.in_waiting == 0:
-                break
-            reply = self.ser.read(1).decode()
-            if showdata:
-                print(loop, reply)
-            loop += 1
+        self.transport.clear()
 
         return
 
     def command(self, command):
         """
         Send command to controller and read reply.
+        Continuous output is stopped for the command and then restarted.
         """
 
-        self.open_port()
-
-        self.clear()
+        if self.streaming:
+            self.stop_stream()
+            try:
+                return self.command(command)
+            finally:
+                self.start_stream()
 
-        self.ser.write(str.encode(f"{command}\r\n"))
-        reply = self.read_port(3)
-        if reply == "":
+        try:
+            reply = self.transport.transact(f"{command}\r\n", terminator=b"\r\n")
+        except azcam.exceptions.AzcamError:
             return ""
-        # reply = self.ser.read(3).decode()  # ACK CR LF
+        reply = reply.decode(errors="replace")  # ACK CR LF
         if reply[0] == "\x15":
             print("NAK read from pressure controller")
             print(reply)
@@ -149,10 +115,11 @@ class PressureController(object):
             print(f"Bad reply from pressure controller: {reply}")
             pass
 
-        self.ser.write(str.encode("\05"))  # ENQ
-
-        # reply = self.ser.read_until().decode()[:-2]  # strip \r\n
-        reply = self.read_port(15)[:-2]  # strip \r\n
+        try:
+            reply = self.transport.transact(b"\x05", terminator=b"\r\n")  # ENQ
+        except azcam.exceptions.AzcamError:
+            return ""
+        reply = reply.decode(errors="replace")[:-2]  # strip \r\n
 
         return reply
 
@@ -195,12 +162,15 @@ class PressureController(object):
         self.command("TID")
         self.clear()
 
-        reply = self.ser.write(str.encode("COM,1\r\n"))
-        reply = self.ser.read(3).decode()  # ACK CR LF
+        self.transport.write("COM,1\r\n")
+        reply = self.transport.read(b"\r\n")  # ACK CR LF
 
         counter = 0
         while 1:
-            reply = self.ser.read_until().decode()
+            try:
+                reply = self.transport.read(b"\r\n", timeout=2.0).decode()
+            except azcam.exceptions.AzcamError:
+                reply = ""
             reply = reply[3:-2]
             try:
                 p = float(reply)
@@ -222,20 +192,110 @@ class PressureController(object):
         get error status.
         """
 
-        self.open_port()
-
-        reply = self.ser.write(str.encode("ERR\r\n"))
-        reply = self.ser.read(3).decode()  # ACK CR LF
-        reply = self.ser.write(str.encode("\05"))  # ENQ
-        reply = self.ser.read_until().decode()[:-2]  # strip CRLF
+        reply = self.command("ERR")
 
         return reply
 
+    def start_stream(self):
+        """
+        Put the gauge in continuous output and parse readings into the ring
+        buffer in a background thread, so read_pressure returns immediately.
+        """
+
+        if self.streaming:
+            return
+
+        reply = self.transport.transact(
+            f"COM,{self.stream_interval}\r\n", terminator=b"\r\n"
+        )
+        if not reply.startswith(b"\x06"):
+            raise azcam.exceptions.AzcamError(
+                f"could not start pressure stream: {reply}"
+            )
+
+        self.transport.start_reader(self._stream_frame, terminator=b"\r\n")
+        self.streaming = True
+
+        return
+
+    def stop_stream(self):
+        """
+        Stop continuous output.
+        """
+
+        if not self.streaming:
+            return
+
+        self.transport.stop_reader()
+        self.streaming = False
+
+        # any input stops continuous output, ETX also clears the gauge input buffer
+        self.transport.write(b"\x03")
+        time.sleep(0.1)
+        self.transport.clear()
+
+        return
+
+    def _stream_frame(self, frame: bytes):
+        """
+        Store one continuous output frame like "0,+7.6000E+02".
+        Readings with a non-zero status are skipped.
+        """
+
+        t = time.time()
+        fields = frame.decode(errors="replace").strip().split(",")
+        try:
+            status = int(fields[0])
+            pressure = float(fields[1])
+        except (ValueError, IndexError):
+            return
+        if status != 0:
+            return
+
+        with self._stream_lock:
+            i = self.stream_count % self.stream_size
+            self.stream_times[i] = t
+            self.stream_values[i] = pressure
+            self.stream_count += 1
+
+        return
+
+    def get_stream(self, t1: float = 0.0, t2: float = None):
+        """
+        Return arrays of (times, pressures) streamed between times t1 and t2,
+        from time.time().
+        """
+
+        if t2 is None:
+            t2 = time.time()
+
+        with self._stream_lock:
+            n = min(self.stream_count, self.stream_size)
+            index = (self.stream_count - n + np.arange(n)) % self.stream_size
+            times = self.stream_times[index]
+            values = self.stream_values[index]
+
+        selected = (times >= t1) & (times <= t2)
+
+        return times[selected], values[selected]
+
     def read_pressure(self, pressure_id=0):
         """
         read pressure in Torr.
+        When streaming, returns the latest reading, or -999.9 if it is stale.
         """
 
+        if self.streaming:
+            with self._stream_lock:
+                if self.stream_count == 0:
+                    return -999.9
+                i = (self.stream_count - 1) % self.stream_size
+                t = self.stream_times[i]
+                pressure = float(self.stream_values[i])
+            if time.time() - t > self.stream_max_age:
+                return -999.9
+            return pressure
+
         reply = self.command("PR1")
 
         try:
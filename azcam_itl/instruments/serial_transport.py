@@ -0,0 +1,416 @@
+"""
+Serial transport shared by instrument drivers.
+Reads have real deadlines and return complete frames, ended by a terminator
+or of a fixed length. A background reader thread can deliver frames from
+devices which send data continuously.
+"""
+
+import os
+import threading
+import time
+
+import serial
+
+import azcam
+import azcam.exceptions
+
+
+class SerialTransport(object):
+    """
+    Serial port with framed reads, reconnection and latency metrics.
+    Bytes read after a frame are kept for the next read.
+    """
+
+    def __init__(
+        self,
+        port: str,
+        baudrate: int = 9600,
+        bytesize: int = 8,
+        parity: str = serial.PARITY_NONE,
+        stopbits: int = 1,
+        rtscts: int = 0,
+        xonxoff: int = 0,
+    ):
+        self.port = port
+        self.baudrate = baudrate
+        self.bytesize = bytesize
+        self.parity = parity
+        self.stopbits = stopbits
+        self.rtscts = rtscts
+        self.xonxoff = xonxoff
+
+        # default seconds to wait for a complete frame
+        self.timeout = 1.0
+
+        # seconds a single port read may block, so deadlines and stop requests are checked
+        self.read_period = 0.05
+
+        # transact attempts, the port is reopened after a failed attempt
+        self.retries = 2
+
+        # called with the serial object after the port opens, like to set RTS/DTR
+        self.on_open = None
+
+        self.ser = None
+
+        # latency metrics
+        self.number_transactions = 0
+        self.number_errors = 0
+        self.number_connects = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+        self.lock = threading.RLock()
+
+        self._buffer = b""
+        self._reader = None
+        self._stop = threading.Event()
+
+    def open(self):
+        """
+        Open port if not open.
+        """
+
+        with self.lock:
+            if self.ser is not None and self.ser.is_open:
+                return
+
+            self.ser = serial.Serial(
+                port=self.port,
+                baudrate=self.baudrate,
+                bytesize=self.bytesize,
+                parity=self.parity,
+                stopbits=self.stopbits,
+                rtscts=self.rtscts,
+                xonxoff=self.xonxoff,
+                timeout=self.read_period,
+            )
+            self._buffer = b""
+            self.number_connects += 1
+
+            if self.on_open is not None:
+                self.on_open(self.ser)
+
+        return
+
+    def close(self):
+        """
+        Close port.
+        """
+
+        with self.lock:
+            if self.ser is not None:
+                try:
+                    self.ser.close()
+                except Exception:
+                    pass
+                self.ser = None
+            self._buffer = b""
+
+        return
+
+    def is_open(self) -> bool:
+        """
+        Return True if port is open.
+        """
+
+        return self.ser is not None and self.ser.is_open
+
+    def write(self, data):
+        """
+        Write bytes or a string to port, opening it if needed.
+        """
+
+        if isinstance(data, str):
+            data = data.encode()
+
+        with self.lock:
+            self.open()
+            self.ser.write(data)
+            self.ser.flush()
+
+        return
+
+    def clear(self):
+        """
+        Discard unread bytes.
+        """
+
+        with self.lock:
+            self._buffer = b""
+            if self.is_open():
+                self.ser.reset_input_buffer()
+                number_bytes = self.ser.in_waiting
+                if number_bytes > 0:
+                    self.ser.read(number_bytes)
+
+        return
+
+    def _fill(self):
+        """
+        Read available bytes into the buffer, blocking up to read_period.
+        """
+
+        data = self.ser.read(max(1, self.ser.in_waiting))
+        self._buffer += data
+
+        return len(data)
+
+    def _frame(self, terminator: bytes = None, length: int = None):
+        """
+        Remove and return a complete frame from the buffer, or None.
+        """
+
+        if terminator is not None:
+            if isinstance(terminator, bytes):
+                terminator = [terminator]
+            ends = [
+                self._buffer.find(t) + len(t) for t in terminator if t in self._buffer
+            ]
+            if len(ends) == 0:
+                return None
+            end = min(ends)
+        elif length is not None:
+            if len(self._buffer) < length:
+                return None
+            end = length
+        else:
+            if len(self._buffer) == 0:
+                return None
+            end = len(self._buffer)
+
+        frame, self._buffer = self._buffer[:end], self._buffer[end:]
+
+        return frame
+
+    def read(
+        self, terminator: bytes = None, length: int = None, timeout: float = None
+    ) -> bytes:
+        """
+        Read one frame, including its terminator.
+
+        Args:
+            terminator: bytes which end a frame, or a list of them, the first found ends the frame.
+            length: number of bytes in a frame, if no terminator.
+            timeout: seconds to wait for the complete frame, default is self.timeout.
+        Returns:
+            frame bytes. With neither terminator nor length, returns the bytes available.
+        Raises AzcamError on timeout.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+
+        with self.lock:
+            self.open()
+            while True:
+                frame = self._frame(terminator, length)
+                if frame is not None:
+                    return frame
+                if time.monotonic() >= deadline:
+                    raise azcam.exceptions.AzcamError(
+                        f"serial read timeout on {self.port}: {self._buffer}"
+                    )
+                self._fill()
+
+    def transact(
+        self,
+        command,
+        terminator: bytes = None,
+        length: int = None,
+        timeout: float = None,
+    ) -> bytes:
+        """
+        Clear input, write a command and read the reply frame.
+        After an error the port is reopened and the command sent again.
+        """
+
+        if isinstance(command, str):
+            command = command.encode()
+
+        with self.lock:
+            for attempt in range(self.retries):
+                t0 = time.perf_counter()
+                try:
+                    self.open()
+                    self.clear()
+                    self.ser.write(command)
+                    reply = self.read(terminator, length, timeout)
+                    break
+                except Exception as e:
+                    self.number_errors += 1
+                    self.close()
+                    if attempt == self.retries - 1:
+                        raise azcam.exceptions.AzcamError(
+                            f"serial error on {self.port}: {e}"
+                        )
+
+        latency = time.perf_counter() - t0
+        self.number_transactions += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+        return reply
+
+    def start_reader(self, callback, terminator: bytes = None, length: int = None):
+        """
+        Start a thread which reads frames continuously and calls callback(frame).
+        The port is reopened after errors. Do not use read or transact while running.
+        """
+
+        if self._reader is not None and self._reader.is_alive():
+            return
+
+        self._stop.clear()
+        self._reader = threading.Thread(
+            target=self._run_reader,
+            args=(callback, terminator, length),
+            name=f"serial_reader_{self.port}",
+            daemon=True,
+        )
+        self._reader.start()
+
+        return
+
+    def stop_reader(self):
+        """
+        Stop the reader thread.
+        """
+
+        self._stop.set()
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+
+        return
+
+    def _run_reader(self, callback, terminator, length):
+        """
+        Reader thread loop.
+        """
+
+        while not self._stop.is_set():
+            try:
+                with self.lock:
+                    self.open()
+                    self._fill()
+                    frames = []
+                    while True:
+                        frame = self._frame(terminator, length)
+                        if frame is None:
+                            break
+                        frames.append(frame)
+            except Exception as e:
+                self.number_errors += 1
+                azcam.log(f"serial reader error on {self.port}: {e}", level=2)
+                self.close()
+                self._stop.wait(1.0)
+                continue
+
+            for frame in frames:
+                try:
+                    callback(frame)
+                except Exception as e:
+                    azcam.log(f"serial reader callback error: {e}", level=2)
+
+    def get_metrics(self) -> dict:
+        """
+        Return transport metrics, latencies in seconds from command to reply.
+        """
+
+        if self.number_transactions:
+            mean = self.total_latency / self.number_transactions
+        else:
+            mean = 0.0
+
+        return {
+            "transactions": self.number_transactions,
+            "errors": self.number_errors,
+            "connects": self.number_connects,
+            "last_latency": self.last_latency,
+            "mean_latency": mean,
+            "max_latency": self.max_latency,
+        }
+
+
+class PtyStandin(object):
+    """
+    Local serial device stand-in on a pseudo terminal for testing drivers
+    without hardware (posix only).
+    respond(frame) is called for each received frame and returns reply bytes or None.
+    Usage: standin = PtyStandin(respond, [b";FF"]); standin.start();
+    transport = SerialTransport(standin.port)
+    """
+
+    def __init__(self, respond, terminators: list = (b"\r\n",)):
+        import pty
+        import tty
+
+        self.respond = respond
+        self.terminators = list(terminators)
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.received = []  # frames received
+
+        self._running = False
+
+    def start(self):
+        """
+        Start responding in a background thread.
+        """
+
+        self._running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+        return
+
+    def stop(self):
+        """
+        Stop responding and close the pseudo terminal.
+        """
+
+        self._running = False
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+        return
+
+    def write(self, data: bytes):
+        """
+        Send unsolicited data, like continuous output.
+        """
+
+        os.write(self.master, data)
+
+        return
+
+    def _run(self):
+        buffer = b""
+        while self._running:
+            try:
+                buffer += os.read(self.master, 256)
+            except OSError:
+                return
+
+            while True:
+                ends = [
+                    buffer.find(t) + len(t) for t in self.terminators if t in buffer
+                ]
+                if len(ends) == 0:
+                    break
+                end = min(ends)
+                frame, buffer = buffer[:end], buffer[end:]
+                self.received.append(frame)
+                reply = self.respond(frame)
+                if reply:
+                    os.write(self.master, reply)
@@ -2,6 +2,7 @@ import serial
 
 import azcam
 import azcam.exceptions
+from azcam_itl.instruments.serial_transport import SerialTransport
 
 
 class ShutterControllerClass(object):
@@ -14,15 +15,8 @@ class ShutterControllerClass(object):
     def __init__(self, port="COM1"):
 
         self.ComPort = port
-        self.BaudRate = 9600
-        self.Parity = serial.PARITY_NONE
-        self.ByteSize = 8
-        self.StopBits = 1
-        self.timeout = 10
-        self.RtsCts = 0
-        self.XonXoff = 0
 
-        self.ser = 0
+        self.transport = SerialTransport(port, 9600, 8, serial.PARITY_NONE, 1)
 
     def initialize(self):
         """
@@ -45,21 +39,11 @@ class ShutterControllerClass(object):
         Open serial port.
         """
 
-        if self.ser == 0 or not self.ser.isOpen():
-            try:
-                self.ser = serial.Serial(
-                    port=self.ComPort,
-                    baudrate=self.BaudRate,
-                    timeout=self.timeout,
-                    parity=self.Parity,
-                    stopbits=self.StopBits,
-                    bytesize=self.ByteSize,
-                    rtscts=self.RtsCts,
-                    xonxoff=self.XonXoff,
-                )
-            except Exception as message:
-                azcam.log(message)
-                raise azcam.exceptions.AzcamError("could not open shutter serial port")
+        try:
+            self.transport.open()
+        except Exception as message:
+            azcam.log(message)
+            raise azcam.exceptions.AzcamError("could not open shutter serial port")
 
         return
 
@@ -70,9 +54,7 @@ class ShutterControllerClass(object):
 
         self.open_port()
 
-        self.ser.write(str.encode(Command))
-
-        self.ser.flush()
+        self.transport.write(Command)
 
         return
 
@@ -81,10 +63,7 @@ class ShutterControllerClass(object):
         Close serial port.
         """
 
-        try:
-            self.ser.close()
-        except Exception:
-            pass
+        self.transport.close()
 
         return
 
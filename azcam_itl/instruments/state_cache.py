@@ -0,0 +1,167 @@
+"""
+Instrument state cache for fast header keyword reads.
+"""
+
+import threading
+import time
+
+import azcam
+
+
+class StateCache(object):
+    """
+    Cache of instrument state values like focus, filter and wavelength.
+    Values are set when the instrument commands a change and refreshed by a
+    background poller. Values older than max_age are read from hardware on demand.
+    Instrument methods which use the polled hardware should hold lock so that
+    poller reads do not interleave with commands.
+    """
+
+    def __init__(self, max_age: float = 10.0, poll_period: float = 2.0):
+        """
+        Args:
+            max_age: seconds after which a cached value is read again from hardware.
+            poll_period: seconds between background polls, 0 for no polling.
+        """
+
+        self.max_age = max_age
+        self.poll_period = poll_period
+
+        self.readers = {}  # key: function returning current hardware value
+        self.values = {}  # key: [value, time, version]
+
+        # held while hardware is used
+        self.lock = threading.RLock()
+
+        self._values_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def add(self, key: str, reader):
+        """
+        Add a cached value with its hardware reader function.
+        """
+
+        self.readers[key] = reader
+
+        return
+
+    def set(self, key: str, value):
+        """
+        Set a value, used when the instrument commands a change.
+        """
+
+        with self._values_lock:
+            version = self.values.get(key, [None, 0.0, 0])[2] + 1
+            self.values[key] = [value, time.monotonic(), version]
+
+        return
+
+    def invalidate(self, key: str = None):
+        """
+        Mark a value (or all values) unknown so the next get reads hardware.
+        Used when a commanded change has no known result, like a relative move.
+        """
+
+        with self._values_lock:
+            keys = list(self.values) if key is None else [key]
+            for k in keys:
+                if k in self.values:
+                    self.values[k][1] = -1.0e9
+                    self.values[k][2] += 1
+
+        return
+
+    def age(self, key: str) -> float:
+        """
+        Return age of a value in seconds, infinite if unknown.
+        """
+
+        with self._values_lock:
+            if key not in self.values:
+                return float("inf")
+            return time.monotonic() - self.values[key][1]
+
+    def get(self, key: str, max_age: float = None):
+        """
+        Return a value, reading hardware only if the cached value is too old.
+        """
+
+        if max_age is None:
+            max_age = self.max_age
+
+        if self.age(key) <= max_age:
+            return self.values[key][0]
+
+        return self.refresh(key)
+
+    def refresh(self, key: str, blocking: bool = True):
+        """
+        Read a value from hardware and cache it.
+        A value set while reading is kept as it is newer.
+        A reader returns None if the value cannot be read now, like while a
+        stage moves, and the cached value is kept.
+        """
+
+        with self._values_lock:
+            version = self.values.get(key, [None, 0.0, 0])[2]
+
+        if not self.lock.acquire(blocking):
+            return None
+        try:
+            value = self.readers[key]()
+        finally:
+            self.lock.release()
+
+        with self._values_lock:
+            current = self.values.get(key, [None, 0.0, 0])
+            if value is None:
+                value = current[0]
+            elif current[2] == version:
+                self.values[key] = [value, time.monotonic(), version]
+            else:
+                value = current[0]
+
+        return value
+
+    def start(self):
+        """
+        Start background polling if poll_period > 0.
+        """
+
+        if self.poll_period <= 0:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="state_cache", daemon=True
+        )
+        self._thread.start()
+
+        return
+
+    def stop(self):
+        """
+        Stop background polling.
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        return
+
+    def _run(self):
+        """
+        Polling thread loop. Skips a poll if the instrument is using the hardware.
+        """
+
+        while not self._stop.wait(self.poll_period):
+            for key in list(self.readers):
+                try:
+                    self.refresh(key, blocking=False)
+                except Exception as e:
+                    azcam.log(f"State poll error for {key}: {e}", level=2)
@@ -0,0 +1,237 @@
+"""
+Wavelength ordering for monochromator sweeps.
+Orders wavelengths to minimize grating changes, filter wheel changes and travel
+of the monochromator, and maps results back to the requested order.
+scheduled() runs an acquisition in scheduled order and renumbers its images
+in the requested order, sweep() runs it as a pipelined instrument sweep.
+"""
+
+import contextlib
+import os
+import re
+
+import azcam
+from astropy.io import fits as pyfits
+
+# MS257 grating transition wavelength (=CHNGPI D:395:A)
+GRATING_CHANGES = [395.0]
+
+
+def move_cost(
+    start: float,
+    wavelength: float,
+    grating_changes: list = GRATING_CHANGES,
+    filter_changes: list = (),
+) -> float:
+    """
+    Return approximate time (sec) to move the monochromator between wavelengths.
+    Crossing a grating or filter change costs much more than travel.
+    Use MS257.settle_time for a calibrated cost.
+    """
+
+    low, high = min(start, wavelength), max(start, wavelength)
+
+    cost = 0.002 * (high - low)
+    cost += 3.0 * len([w for w in grating_changes if low < w <= high])
+    cost += 2.0 * len([w for w in filter_changes if low < w <= high])
+
+    return cost
+
+
+def schedule(wavelengths: list, start: float = None, cost=move_cost) -> list:
+    """
+    Return the order in which to visit wavelengths, as indices into wavelengths.
+    On a line the best path from start is to sweep to one end and then to the
+    other, which crosses each grating and filter change at most twice. Both
+    directions are evaluated with cost.
+
+    Args:
+        wavelengths: requested wavelengths.
+        start: current wavelength, None to sweep from the shortest wavelength.
+        cost: function(start, wavelength) returning the time for a move.
+    Returns:
+        list of indices into wavelengths.
+    """
+
+    indices = sorted(range(len(wavelengths)), key=lambda i: float(wavelengths[i]))
+    if start is None or len(indices) == 0:
+        return indices
+
+    start = float(start)
+    below = [i for i in indices if float(wavelengths[i]) <= start]
+    above = [i for i in indices if float(wavelengths[i]) > start]
+
+    candidates = [
+        list(reversed(below)) + above,  # down first, then up
+        above + list(reversed(below)),  # up first, then down
+    ]
+
+    best = None
+    for order in candidates:
+        total = 0.0
+        current = start
+        for i in order:
+            total += cost(current, float(wavelengths[i]))
+            current = float(wavelengths[i])
+        if best is None or total < best[0]:
+            best = [total, order]
+
+    return best[1]
+
+
+def ordered(values: dict, start: float = None, cost=move_cost) -> dict:
+    """
+    Return a copy of a dict keyed by wavelength, like qe.exposure_times, in
+    scheduled order. Acquisition tools iterate these dicts in insertion order.
+    """
+
+    wavelengths = list(values)
+    order = schedule(wavelengths, start, cost)
+
+    return {wavelengths[i]: values[wavelengths[i]] for i in order}
+
+
+def restore(results: list, order: list) -> list:
+    """
+    Return results measured in scheduled order in the requested order.
+
+    Args:
+        results: results in the order visited.
+        order: indices returned by schedule().
+    Returns:
+        results in requested order.
+    """
+
+    restored = [None] * len(order)
+    for result, i in zip(results, order):
+        restored[i] = result
+
+    return restored
+
+
+def renumber(folder: str, root_name: str, order: list) -> bool:
+    """
+    Rename the wavelength images of a sequence acquired in scheduled order so
+    their sequence numbers follow the requested order, as when acquired
+    unscheduled. Images with IMAGETYP zero, bias or dark keep their names.
+
+    Args:
+        folder: folder of the sequence images.
+        root_name: sequence root name like "qe." for qe.0001.fits.
+        order: indices returned by schedule() used for the acquisition.
+    Returns:
+        True if the images were renumbered.
+    """
+
+    pattern = re.compile(rf"^{re.escape(root_name)}(\d+)\.fits$")
+    try:
+        names = [f for f in os.listdir(folder) if pattern.match(f)]
+    except OSError:
+        azcam.log(f"Images not renumbered, no folder {folder}")
+        return False
+    names.sort(key=lambda f: int(pattern.match(f).group(1)))
+
+    images = []
+    for name in names:
+        imagetype = pyfits.getheader(os.path.join(folder, name)).get("IMAGETYP", "")
+        if str(imagetype).lower() not in ["zero", "bias", "dark"]:
+            images.append(name)
+
+    if len(images) != len(order):
+        azcam.log(
+            f"Images not renumbered, found {len(images)} {root_name} images for {len(order)} wavelengths"
+        )
+        return False
+
+    # images[k] was taken k-th, requested position order[k] gets the k-th name in
+    # sequence, rename in two steps so no name is overwritten
+    restored = restore(images, order)
+    for name in images:
+        os.replace(os.path.join(folder, name), os.path.join(folder, name + ".tmp"))
+    for name, source in zip(images, restored):
+        os.replace(os.path.join(folder, source + ".tmp"), os.path.join(folder, name))
+
+    return True
+
+
+@contextlib.contextmanager
+def scheduled(tool, attribute: str, start: float = None, folder: str = None):
+    """
+    Context manager to acquire with a tool in order of fewest monochromator
+    moves. The tool dict attribute keyed by wavelength, like qe.exposure_times,
+    is replaced by its scheduled copy only during the acquisition. Afterwards
+    the images in folder are renumbered in the configured order, so analysis
+    and reports read them as when acquired unscheduled.
+
+    Usage example:
+      with wavelength_schedule.scheduled(qe, "exposure_times", 500.0, "qe") as wavelengths:
+          qe.acquire()
+
+    Args:
+        tool: acquisition tool.
+        attribute: name of the tool dict keyed by wavelength.
+        start: current wavelength, None to sweep from the shortest wavelength.
+        folder: folder of the acquired images, None to not renumber.
+    Returns:
+        wavelengths in scheduled order.
+    """
+
+    values = getattr(tool, attribute)
+    wavelengths = list(values)
+    order = schedule(wavelengths, start)
+
+    setattr(tool, attribute, {wavelengths[i]: values[wavelengths[i]] for i in order})
+    try:
+        yield [wavelengths[i] for i in order]
+    finally:
+        setattr(tool, attribute, values)
+
+    if folder is not None:
+        renumber(folder, tool.root_name, order)
+
+
+def _server_command(command: str):
+    """
+    Send a command to the server, logging but not raising errors.
+    """
+
+    try:
+        reply = azcam.db.tools["server"].command(command)
+    except Exception as e:
+        reply = f"ERROR {e}"
+    if isinstance(reply, str) and reply.startswith("ERROR"):
+        azcam.log(f"{command}: {reply}")
+
+    return reply
+
+
+@contextlib.contextmanager
+def sweep(wavelengths, flux_log: str = None):
+    """
+    Context manager to run an acquisition as a pipelined sweep of the server
+    instrument, see InstrumentQB.start_sweep(). The monochromator moves to the
+    next wavelength during readout. Optionally logs power meter flux of each
+    exposure to the server file flux_log, see InstrumentQB.start_flux_log().
+    Works with controller (shutter_strobe) and instrument shutters. Instruments
+    without sweeps are used normally.
+
+    Usage example:
+      with wavelength_schedule.sweep(qe.exposure_times):
+          qe.acquire()
+
+    Args:
+        wavelengths: wavelengths in acquisition order, or a dict keyed by wavelength.
+        flux_log: server filename for the flux log, None for no log.
+    """
+
+    wavelengths = " ".join(str(w) for w in wavelengths)
+    _server_command(f"instrument.start_sweep {wavelengths}")
+    if flux_log is not None:
+        _server_command(f"instrument.start_flux_log {flux_log}")
+
+    try:
+        yield
+    finally:
+        if flux_log is not None:
+            _server_command("instrument.stop_flux_log")
+        _server_command("instrument.stop_sweep")
@@ -2,11 +2,11 @@
 General purpose code for ITL.
 """
 
+import concurrent.futures
 import os
 import fnmatch
 import shutil
 import hashlib
-import tarfile
 import time
 
 import numpy
@@ -23,6 +23,77 @@ import azcam.utils
 import azcam.exceptions
 import azcam.image
 import azcam_console.console
+from azcam_itl import archiver
+
+
+def collect_files(
+    folder: str = None,
+    patterns: list = (),
+    dir_patterns: list = (),
+    exclude: list = (),
+) -> dict:
+    """
+    Walk a folder tree once and collect files and folders matching several patterns.
+    Matching folders are not searched further.
+
+    Args:
+        folder: root folder, default is current folder.
+        patterns: filename patterns like "qe.0004.fits" or "console_*.log".
+        dir_patterns: folder name patterns like "analysis*".
+        exclude: folder names relative to folder which are not searched.
+    Returns:
+        dict of pattern: sorted list of matching paths.
+    """
+
+    if folder is None:
+        folder = azcam.utils.curdir()
+
+    matches = {pattern: [] for pattern in list(patterns) + list(dir_patterns)}
+    excluded = {os.path.normpath(os.path.join(folder, f)) for f in exclude}
+
+    todo = [folder]
+    while todo:
+        current = todo.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                # like os.walk, symlinked folders are not searched
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.normpath(entry.path) in excluded:
+                        continue
+                    for pattern in dir_patterns:
+                        if fnmatch.fnmatch(entry.name, pattern):
+                            matches[pattern].append(entry.path)
+                            break
+                    else:
+                        todo.append(entry.path)
+                elif entry.is_dir():
+                    continue
+                else:
+                    for pattern in patterns:
+                        if fnmatch.fnmatch(entry.name, pattern):
+                            matches[pattern].append(entry.path)
+
+    for pattern in matches:
+        matches[pattern].sort()
+
+    return matches
+
+
+def copy_file_list(copies: list, number_threads: int = 8) -> list:
+    """
+    Copy files concurrently.
+
+    Args:
+        copies: list of (source, destination), destination may be a folder.
+        number_threads: number of copy threads.
+    Returns:
+        list of destination filenames.
+    """
+
+    with concurrent.futures.ThreadPoolExecutor(number_threads) as pool:
+        destinations = list(pool.map(lambda c: shutil.copy(*c), copies))
+
+    return destinations
 
 
 def cleanup_files(folder=None):
@@ -33,30 +104,18 @@ def cleanup_files(folder=None):
     if folder is None:
         folder = azcam.utils.curdir()
 
-    matches = []
-    for root, dirnames, filenames in os.walk(folder):
-        for dirname in fnmatch.filter(dirnames, "analysis*"):
-            matches.append(os.path.join(root, dirname))
+    # remove analysis folders, test and temp .FITS files and server/console .log files
+    patterns = ["test.fits", "TempDisplayFile.fits", "console_*.log", "server_*.log"]
+    matches = collect_files(folder, patterns, ["analysis*"])
 
-    for t in matches:
+    for t in matches["analysis*"]:
         azcam.log(f"Deleting folder {t}")
         shutil.rmtree(t)
 
-    # remove test and temp .FITS files and server/console .log files
-    matches = []
-    for root, dirnames, filenames in os.walk(folder):
-        for filename in fnmatch.filter(filenames, "test.fits"):
-            matches.append(os.path.join(root, filename))
-        for filename in fnmatch.filter(filenames, "TempDisplayFile.fits"):
-            matches.append(os.path.join(root, filename))
-        for filename in fnmatch.filter(filenames, "console_*.log"):
-            matches.append(os.path.join(root, filename))
-        for filename in fnmatch.filter(filenames, "server_*.log"):
-            matches.append(os.path.join(root, filename))
-
-    for t in matches:
-        azcam.log(f"Deleting file {t}")
-        os.remove(t)
+    for pattern in patterns:
+        for t in matches[pattern]:
+            azcam.log(f"Deleting file {t}")
+            os.remove(t)
 
     return
 
@@ -64,7 +123,8 @@ def cleanup_files(folder=None):
 def archive(foldername="", filetype="tar"):
     """
     Make a tarfile from a folder or file.
-    Type can be "tar", "tar.gz", or "zip".
+    Type can be "tar", "tar.gz" (compressed in parallel), or "zip".
+    A sha256 manifest of the archived files is also written.
     Return tarfile filename.
     """
 
@@ -77,27 +137,30 @@ def archive(foldername="", filetype="tar"):
         else:
             foldername = reply[0]
 
-    if filetype == "tar.gz":
-        filename = foldername + ".tar.gz"
-        tar = tarfile.open(filename, "w:gz")
-        tar.add(foldername)
-        tar.close()
+    if filetype == "zip":
+        # zip files have the folder contents at the top level
+        arcname = ""
+    else:
+        arcname = foldername
 
-    elif filetype == "tar":
-        filename = foldername + ".tar"
-        tar = tarfile.open(filename, "w:")
-        tar.add(foldername)
-        tar.close()
+    filename = archiver.Archiver().make_archive(
+        foldername, f"{foldername}.{filetype}", arcname, filetype
+    )
 
-    elif filetype == "zip":
-        filename = foldername
-        shutil.make_archive(filename, "zip", foldername)
-        filename = filename + ".zip"
+    return filename
 
-    else:
-        raise azcam.exceptions.AzcamError("unsupported archive file type")
 
-    return filename
+def file_checksum(filename: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Return sha256 checksum of a file, read in chunks.
+    """
+
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as afile:
+        for chunk in iter(lambda: afile.read(chunk_size), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
 
 
 def checksum(filename):
@@ -109,11 +172,7 @@ def checksum(filename):
     filechecksum = os.path.basename(filename) + ".sha256"
 
     # make checksum
-    hasher = hashlib.sha256()
-    with open(filename, "rb") as afile:
-        buf = afile.read()
-        hasher.update(buf)
-    hashstring = hasher.hexdigest()
+    hashstring = file_checksum(filename)
 
     with open(filechecksum, "w") as f:
         f.write(hashstring + "\n")
@@ -121,6 +180,75 @@ def checksum(filename):
     return filechecksum, hashstring
 
 
+def make_manifest(folder=None, filename=None, number_threads=None):
+    """
+    Make a sha256 manifest file of all files in a folder tree, hashed in parallel.
+    Lines are "checksum  name" as written by sha256sum, with names relative to the
+    manifest folder. Archive manifests written by archiver use the same format.
+    Default filename is the folder name with .manifest.
+    Return manifest filename.
+    """
+
+    if folder is None:
+        folder = azcam.utils.curdir()
+    folder = os.path.abspath(folder)
+    if filename is None:
+        filename = folder + ".manifest"
+    filename = os.path.abspath(filename)
+    manifest_folder = os.path.dirname(filename)
+
+    files = []
+    for root, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for f in sorted(filenames):
+            path = os.path.join(root, f)
+            if path != filename:
+                files.append(path)
+
+    with concurrent.futures.ThreadPoolExecutor(number_threads) as pool:
+        checksums = pool.map(file_checksum, files)
+        with open(filename, "w") as f:
+            for path, hashstring in zip(files, checksums):
+                name = os.path.relpath(path, manifest_folder).replace(os.sep, "/")
+                f.write(f"{hashstring}  {name}\n")
+
+    return filename
+
+
+def verify_manifest(filename, folder=None, number_threads=None):
+    """
+    Check the files listed in a sha256 manifest file.
+    Names are relative to folder, default is the manifest folder.
+    Return list of names which are missing or have a different checksum.
+    """
+
+    if folder is None:
+        folder = os.path.dirname(os.path.abspath(filename))
+
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                hashstring, name = line.rstrip("\n").split("  ", 1)
+                entries.append((hashstring, name))
+
+    def check(entry):
+        hashstring, name = entry
+        try:
+            return file_checksum(os.path.join(folder, name)) == hashstring
+        except OSError:
+            return False
+
+    with concurrent.futures.ThreadPoolExecutor(number_threads) as pool:
+        results = pool.map(check, entries)
+        failed = [name for (_, name), ok in zip(entries, results) if not ok]
+
+    for name in failed:
+        azcam.log(f"Checksum failed: {name}")
+
+    return failed
+
+
 def count_files(path=""):
     """
     Return the number of files in path (default is current folder).
@@ -194,7 +322,47 @@ def mailto(to, subject, text, attachments=None):
     return
 
 
-def imsnap(scale: float = 1.0, fits_file: str = "last", snap_file: str = None) -> None:
+def wait_for_file(filename: str, timeout: float = 0.5, poll: float = 0.005) -> bool:
+    """
+    Wait for a file to exist and for its size to stop changing.
+    Polls with os.stat using an increasing poll interval.
+
+    Args:
+        filename: file to wait for.
+        timeout: maximum time to wait in seconds.
+        poll: initial poll interval in seconds.
+    Returns:
+        True if the file is ready, False on timeout.
+    """
+
+    deadline = time.monotonic() + timeout
+    last_size = -1
+
+    while True:
+        try:
+            size = os.stat(filename).st_size
+        except OSError:
+            size = -1
+
+        if size > 0 and size == last_size:
+            return True
+        last_size = size
+
+        now = time.monotonic()
+        if now >= deadline:
+            return size > 0
+        time.sleep(min(poll, deadline - now))
+        poll = min(poll * 2, 0.1)
+
+
+def imsnap(
+    scale: float = 1.0,
+    fits_file: str = "last",
+    snap_file: str = None,
+    fast: bool = None,
+    interactive: bool = None,
+    timeout: float = 0.5,
+) -> None:
     """
     Converts FITS image to snapshot file with simple median scaling.
 
@@ -202,15 +370,26 @@ def imsnap(scale: float = 1.0, fits_file: str = "last", snap_file: str = None) -
         scale (float, optional): sdev scale factor above and below median.
         fits_file (str, optional): name of fits file. "last" means last exposure image.
         snap_file (str, optional): name of snapshot file to write. None means same name as fits_file.
+        fast (bool, optional): estimate scaling from a pixel subsample and scale in chunks.
+            None means use db.imsnap_fast.
+        interactive (bool, optional): display snapshot interactively.
+            None means use db.imsnap_interactive.
+        timeout (float, optional): seconds to wait for fits_file to be written.
     Globals:
         db.imsnap_interactive (bool): if defined as True then display snapshot interactively
         db.imsnap_resize (float): if defined down image size by this factor
+        db.imsnap_fast (bool): if defined as True then use fast scaling by default
 
     """
 
     if fits_file == "last":
         fits_file = azcam.db.parameters.get_par("lastfilename")
 
+    if fast is None:
+        fast = bool(azcam.db.get("imsnap_fast"))
+    if interactive is None:
+        interactive = bool(azcam.db.get("imsnap_interactive"))
+
     folder = os.path.dirname(fits_file)
     fname = os.path.basename(fits_file)
     if fname.endswith(".fits"):
@@ -225,18 +404,44 @@ def imsnap(scale: float = 1.0, fits_file: str = "last", snap_file: str = None) -
     if not os.path.isabs(snap_file):
         snap_file = os.path.normpath(os.path.join(folder, snap_file))
 
-    loop = 0
-    while loop < 50:
-        if not os.path.exists(fits_file):
-            time.sleep(0.01)
-            loop += 1
-        else:
-            break
+    wait_for_file(fits_file, timeout)
 
     im1 = azcam.image.Image(fits_file)
     im1.assemble(1)  # buffer float32 by default
 
-    data = im1.buffer
+    if fast:
+        data = imsnap_scale_fast(im1.buffer, scale)
+    else:
+        data = imsnap_scale(im1.buffer, scale)
+
+    # open-cv
+    resize = azcam.db.get("imsnap_resize")
+    if resize:
+        newsize = [int(x / float(resize)) for x in data.shape]
+        data = cv2.resize(data, (newsize[1], newsize[0]), interpolation=cv2.INTER_AREA)
+
+    data = cv2.flip(data, 0)
+
+    if interactive:
+        print("Press s to save image snap, c to continue, other close window")
+        cv2.imshow("image", data)
+        key = cv2.waitKey(0)
+        if chr(key) == "s":
+            cv2.imwrite(snap_file, data)
+            cv2.destroyAllWindows()
+        elif chr(key) == "c":
+            pass
+    else:
+        cv2.imwrite(snap_file, data)
+
+    return data
+
+
+def imsnap_scale(data, scale: float = 1.0):
+    """
+    Scale an image buffer to uint8 using the median and sdev of all pixels.
+    """
+
     median = numpy.median(data)
     std = data.std()
     z1 = median - std * scale
@@ -256,24 +461,50 @@ def imsnap(scale: float = 1.0, fits_file: str = "last", snap_file: str = None) -
     data = data * 255.0 / data.max()
     data = data.astype("uint8")
 
-    # open-cv
-    resize = azcam.db.get("imsnap_resize")
-    if resize:
-        newsize = [int(x / float(resize)) for x in data.shape]
-        data = cv2.resize(data, (newsize[1], newsize[0]), interpolation=cv2.INTER_AREA)
+    return data
 
-    data = cv2.flip(data, 0)
 
-    if azcam.db.get("imsnap_interactive"):
-        print("Press s to save image snap, c to continue, other close window")
-        cv2.imshow("image", data)
-        key = cv2.waitKey(0)
-        if chr(key) == "s":
-            cv2.imwrite(snap_file, data)
-            cv2.destroyAllWindows()
-        elif chr(key) == "c":
-            pass
-    else:
-        cv2.imwrite(snap_file, data)
+def imsnap_scale_fast(
+    data, scale: float = 1.0, sample_size: int = 250_000, chunk_rows: int = 256
+):
+    """
+    Scale an image buffer to uint8 using statistics from a strided pixel subsample.
+    Scaling is done in row chunks into a single uint8 output array so no full size
+    float temporaries are made.
 
-    return data
+    Args:
+        data: 2D image buffer.
+        scale: sdev scale factor above and below median.
+        sample_size: approximate number of pixels used to estimate median and sdev.
+        chunk_rows: number of rows scaled per chunk.
+    Returns:
+        uint8 array with same shape as data.
+    """
+
+    # strided subsample, same step in both axes
+    step = max(1, int(numpy.sqrt(data.size / float(sample_size))))
+    sample = data[::step, ::step]
+
+    median = numpy.median(sample)
+    std = sample.std()
+    z1 = median - std * scale
+    z2 = median + std * scale
+    z1 = max(0.0, z1)
+    z2 = min(z2, 2**16 - 1)
+
+    print(f"Image median scaling: [{z1:.0f}, {z2:.0f}] (fast)")
+
+    factor = 255.0 / max(z2 - z1, 1.0)
+
+    out = numpy.empty(data.shape, dtype="uint8")
+    buffer = numpy.empty((min(chunk_rows, data.shape[0]), data.shape[1]), "float32")
+
+    for row in range(0, data.shape[0], chunk_rows):
+        chunk = data[row : row + chunk_rows]
+        buf = buffer[: chunk.shape[0]]
+        numpy.subtract(chunk, z1, out=buf, casting="unsafe")
+        numpy.multiply(buf, factor, out=buf)
+        numpy.clip(buf, 0, 255, out=buf)
+        out[row : row + chunk_rows] = buf
+
+    return out
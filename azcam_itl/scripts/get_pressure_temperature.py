@@ -8,6 +8,7 @@ import sys
 import azcam
 import azcam.utils
 from azcam_console.plot import plt
+from azcam_itl.telemetry import TelemetryStore
 
 # import seaborn
 # seaborn.set_theme(style="ticks", font_scale=1.25)
@@ -41,10 +42,10 @@ def get_pressure_temperature(delay=1.0, start_offset=0):
 
     timestart = datetime.datetime.now()
 
-    data_txt_hdr = "Seconds\tPressures\tCamtemp\tDewtemp\tTime"
-    with open("Pressure_temperature.txt", "a+") as datafile:
-        datafile.write("# " + data_txt_hdr + "\n")
+    telemetry = TelemetryStore()
 
+    data_txt_hdr = "Seconds\tPressures\tCamtemp\tDewtemp\tTime"
+    try:
         loop = 1
         print(data_txt_hdr)
         while loop:
@@ -76,9 +77,15 @@ def get_pressure_temperature(delay=1.0, start_offset=0):
 
             azcam.plot.update()
 
-            s = f"{secs1:.0f}\t{p1:1.2e}\t{p2:1.2e}\t{camtemp:0.1f}\t{dewtemp:.1f}\t{timenow}"
-            datafile.write(s + "\n")
-            datafile.flush()
+            telemetry.record(
+                {
+                    "pressure0": p1,
+                    "pressure1": p2,
+                    "camtemp": camtemp,
+                    "dewtemp": dewtemp,
+                },
+                timenow.timestamp(),
+            )
 
             if 1:
                 plt.tight_layout()
@@ -87,6 +94,8 @@ def get_pressure_temperature(delay=1.0, start_offset=0):
                 break
 
             azcam.plot.delay(delay)
+    finally:
+        telemetry.close()
 
     return
 
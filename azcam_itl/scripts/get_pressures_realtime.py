@@ -5,6 +5,7 @@ from statistics import mean
 
 import azcam
 import azcam.utils
+from azcam_itl.telemetry import TelemetryStore
 
 import datetime as dt
 import matplotlib.pyplot as plt
@@ -45,13 +46,7 @@ class GetPressures(object):
         Initialize animation
         """
 
-        data_txt_hdr = "Seconds\tPressure\tTime"
-        self.datafile = open("Pressure.txt", "a+")
-        self.datafile.write("# " + data_txt_hdr + "\n")
-
-        data_txt_hdr = "Seconds\tPressure\tTime"
-        self.datafile = open("Pressure.txt", "a+")
-        self.datafile.write("# " + data_txt_hdr + "\n")
+        self.telemetry = TelemetryStore()
 
         self.timestart = datetime.datetime.now()
 
@@ -82,11 +77,10 @@ class GetPressures(object):
         self.ax.xaxis.set_major_locator(MaxNLocator(20))
 
         print(f"{secs1:.0f}\t\t{p:.2e}\t\t{s}")
-        s = f"{secs1:.0f}\t\t{p:1.2e}\t{timenow}"
-        self.datafile.write(s + "\n")
+        self.telemetry.record({"pressure0": p}, timenow.timestamp())
 
         if azcam.utils.check_keyboard() == "q":
-            self.datafile.close()
+            self.telemetry.close()
             self.ani.pause()
             print("Paused plotting script and wote data file")
 
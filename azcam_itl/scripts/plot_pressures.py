@@ -3,6 +3,7 @@ import time
 from statistics import mean
 import azcam
 import azcam.utils
+from azcam_itl.telemetry import TelemetryStore
 
 import datetime as dt
 import matplotlib.pyplot as plt
@@ -28,7 +29,8 @@ class PlotPressures(object):
         self.ys1 = []
         self.ys2 = []
 
-        self.datafilename = "pressure.txt"
+        # pressures are recorded as channels pressure0, pressure1, ...
+        self.telemetry = TelemetryStore()
         plt.interactive(1)
 
     def setup(self):
@@ -53,13 +55,6 @@ class PlotPressures(object):
 
         print("Press spacebar anytime to write out data file")
 
-        data_txt_hdr = "Seconds\tPressure\tTime"
-        self.datafile = open(self.datafilename, "a+")
-        self.datafile.write("# " + data_txt_hdr + "\n")
-
-        data_txt_hdr = "Seconds\tPressure\tTime"
-        self.datafile.write("# " + data_txt_hdr + "\n")
-
         self.timestart = datetime.datetime.now()
         self.lasttime = self.timestart
 
@@ -122,15 +117,12 @@ class PlotPressures(object):
 
         delta = (timenow - self.lasttime).total_seconds()
 
-        azcam.log(f"{secs1:.0f}\t\t{[f'{p:1.2e}' for p in pressures]}\t\t{s}")
-        s = f"{secs1:.0f}\t\t{[f'{p:1.2e}' for p in pressures]}\t\t{timenow}"
+        pstring = "\t".join([f"{p:1.2e}" for p in pressures])
+        azcam.log(f"{secs1:.0f}\t\t{pstring}\t\t{s}")
 
-        if not self.datafile.closed:
-            self.datafile.write(s + "\n")
-        else:
-            self.datafile = open(self.datafilename, "a+")
-            self.datafile.write(s + "\n")
-            print(f"reopened {self.datafilename=}")
+        self.telemetry.record(
+            {f"pressure{i}": p for i, p in enumerate(pressures)}, timenow.timestamp()
+        )
 
         azcam.plot.update()
 
@@ -148,7 +140,7 @@ class PlotPressures(object):
 
             self.update()
             if azcam.utils.check_keyboard() == " ":
-                self.datafile.close()
+                self.telemetry.flush()
                 print("Wrote data file")
             time.sleep(self.delay)
 
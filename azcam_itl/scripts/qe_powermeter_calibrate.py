@@ -9,12 +9,14 @@ import azcam
 import azcam.sockets
 
 
-def qe_powermeter_calibrate(wavelengths=None):
+def qe_powermeter_calibrate(wavelengths=None, shutter_delay=2.0):
     """
     Obtains values for multiple wavelengths by selecting wavelength and obtaining readings
     from power meter.
+    The monochromator waits for its own settle time in set_wavelength.
 
     :param wavelengths: list of wavelengths for each measurement
+    :param shutter_delay: seconds to wait after opening shutter before reading power
     :return: None
     """
 
@@ -40,13 +42,12 @@ def qe_powermeter_calibrate(wavelengths=None):
         instrument.set_shutter(0, 1)  # shutter_id 1 is arduino
 
         instrument.set_wavelength(wave)
-        time.sleep(3)
 
         flux_close = instrument.get_power(wave)
         flux_close = float(flux_close)
 
         instrument.set_shutter(1, 1)
-        time.sleep(2)
+        time.sleep(shutter_delay)
 
         flux_open = instrument.get_power(wave)
         flux_open = float(flux_open)
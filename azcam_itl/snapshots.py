@@ -0,0 +1,146 @@
+"""
+Background image snapshot service for ITL detchar sequences.
+"""
+
+import os
+import queue
+import threading
+
+import azcam
+from azcam_itl import itlutils
+
+
+class SnapshotWorker(object):
+    """
+    Writes imsnap PNG snapshots in background threads so that acquisition
+    sequences do not wait for image scaling and file writing.
+    Jobs are held in a bounded queue; use flush() at the end of a sequence.
+    """
+
+    def __init__(self, number_threads: int = 1, queue_size: int = 8):
+        self.number_threads = number_threads
+        self.queue_size = queue_size
+
+        # seconds to wait for a FITS file to be written
+        self.file_timeout = 30.0
+
+        self.jobs = queue.Queue(self.queue_size)
+        self.threads = []
+
+        self.number_written = 0
+        self.number_dropped = 0
+        self.number_errors = 0
+
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start worker threads if not already running.
+        """
+
+        with self._lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            for _ in range(self.number_threads - len(self.threads)):
+                thread = threading.Thread(
+                    target=self._run, name="imsnap_worker", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+        return
+
+    def submit(
+        self,
+        scale: float = 1.0,
+        fits_file: str = "last",
+        snap_file: str = None,
+        fast: bool = True,
+    ) -> bool:
+        """
+        Queue a snapshot job. Does not block.
+
+        Args:
+            scale: sdev scale factor above and below median.
+            fits_file: name of fits file. "last" means last exposure image.
+            snap_file: name of snapshot file to write. None means same name as fits_file.
+            fast: use fast subsampled scaling.
+        Returns:
+            True if the job was queued, False if the queue was full.
+        """
+
+        # resolve now as lastfilename changes with the next exposure
+        if fits_file == "last":
+            fits_file = azcam.db.parameters.get_par("lastfilename")
+        fits_file = os.path.abspath(fits_file)
+
+        self.start()
+
+        try:
+            self.jobs.put_nowait((scale, fits_file, snap_file, fast))
+        except queue.Full:
+            self.number_dropped += 1
+            azcam.log(f"Snapshot queue full, skipping {fits_file}")
+            return False
+
+        return True
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait for all queued snapshots to be written.
+
+        Args:
+            timeout: maximum time to wait in seconds, None waits forever.
+        Returns:
+            True if all jobs finished.
+        """
+
+        if timeout is None:
+            self.jobs.join()
+            return True
+
+        done = threading.Event()
+        waiter = threading.Thread(
+            target=lambda: (self.jobs.join(), done.set()), daemon=True
+        )
+        waiter.start()
+
+        return done.wait(timeout)
+
+    def stop(self):
+        """
+        Finish queued jobs and stop worker threads.
+        """
+
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        return
+
+    def _run(self):
+        """
+        Worker thread loop.
+        """
+
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+
+                scale, fits_file, snap_file, fast = job
+
+                if not itlutils.wait_for_file(fits_file, self.file_timeout):
+                    raise FileNotFoundError(f"image not written: {fits_file}")
+
+                itlutils.imsnap(scale, fits_file, snap_file, fast, interactive=False)
+                self.number_written += 1
+
+            except Exception as e:
+                self.number_errors += 1
+                azcam.log(f"Snapshot error: {e}")
+
+            finally:
+                self.jobs.task_done()
@@ -0,0 +1,393 @@
+"""
+Compact time-series store for vacuum and temperature telemetry.
+
+Each channel is stored as float64 (time, value) records, in one file per
+channel per UTC day. Mean/min/max rollups at coarser intervals are written as
+data arrive, so histories of whole cooldowns load quickly for plotting.
+Each writer (by default each store) has its own files, so several scripts
+may record the same channel at once. Queries merge the files of all writers.
+Missing readings (-999 and non-finite values) are not stored.
+
+Usage example:
+  store = TelemetryStore()
+  store.record({"pressure0": 1.2e-6, "camtemp": -100.1})
+  times, pressures = store.query("pressure0", t1=time.time() - 86400)
+  times, pressures = store.query("pressure0", resolution=3600)  # hourly means
+"""
+
+import glob
+import itertools
+import math
+import os
+import re
+import socket
+import threading
+import time
+
+import numpy as np
+
+import azcam
+
+# rollup intervals in seconds
+ROLLUPS = [60, 3600]
+
+# raw record is (time, value), rollup record is (time, mean, min, max, count)
+RAW_FIELDS = 2
+ROLLUP_FIELDS = 5
+
+# values returned by readers for no reading, not stored
+MISSING = (-999.0, -999.9)
+
+_channel_re = re.compile(r"^[A-Za-z0-9_]+$")
+
+# numbers default writer names of stores in this process
+_store_count = itertools.count()
+
+
+class TelemetryStore(object):
+    """
+    Store of timestamped float64 channels with daily rotation and rollups.
+    Times are from time.time(). Each writer must add records in time order.
+    """
+
+    def __init__(self, folder: str = None, rollups: list = ROLLUPS, writer: str = None):
+        """
+        Args:
+            folder: store folder, default is datafolder/telemetry.
+            rollups: rollup intervals in seconds.
+            writer: name in this store's file names, default is unique to this
+              store from host, process ID and a count.
+              Only one store at a time may use a writer name.
+        """
+
+        if folder is None:
+            folder = os.path.join(azcam.db.datafolder, "telemetry")
+        self.folder = folder
+        self.rollups = list(rollups)
+
+        if writer is None:
+            writer = f"{socket.gethostname()}_{os.getpid()}_{next(_store_count)}"
+        self.writer = re.sub(r"[^A-Za-z0-9_-]", "_", writer)
+
+        self._files = {}  # (day, channel): open raw file
+        self._buckets = {}  # (interval, channel): [start, sum, min, max, count]
+        self._lock = threading.Lock()
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def day(t: float) -> str:
+        """
+        Return UTC day folder name of a time, like "2024-06-01".
+        """
+
+        return time.strftime("%Y-%m-%d", time.gmtime(t))
+
+    def record(self, values: dict, t: float = None):
+        """
+        Add values for one time.
+        Missing readings, see MISSING, and non-finite values are skipped.
+
+        Args:
+            values: dict of channel: value.
+            t: time, default now.
+        """
+
+        if t is None:
+            t = time.time()
+        day = self.day(t)
+
+        with self._lock:
+            for channel, value in values.items():
+                if not _channel_re.match(channel):
+                    raise ValueError(f"invalid telemetry channel name: {channel}")
+                value = float(value)
+                if not math.isfinite(value) or value in MISSING:
+                    continue
+
+                f = self._raw_file(day, channel)
+                np.array([t, value], dtype="<f8").tofile(f)
+                f.flush()
+
+                for interval in self.rollups:
+                    self._rollup(interval, channel, t, value)
+
+        return
+
+    def flush(self):
+        """
+        Write partial rollup intervals.
+        Partial intervals are written again with later data, query uses the last.
+        """
+
+        with self._lock:
+            for (interval, channel), bucket in self._buckets.items():
+                self._write_bucket(interval, channel, bucket)
+
+        return
+
+    def close(self):
+        """
+        Flush and close files.
+        """
+
+        self.flush()
+
+        with self._lock:
+            self._buckets = {}
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+
+        return
+
+    def channels(self) -> list:
+        """
+        Return names of stored channels.
+        """
+
+        names = set()
+        for day in self._days():
+            for filename in os.listdir(os.path.join(self.folder, day)):
+                if filename.endswith(".f64"):
+                    names.add(filename[:-4].split("@")[0])
+
+        return sorted(names)
+
+    def query(
+        self,
+        channel: str,
+        t1: float = 0.0,
+        t2: float = None,
+        resolution: float = None,
+    ):
+        """
+        Return arrays of (times, values) of a channel between times t1 and t2.
+
+        Args:
+            channel: channel name.
+            t1: start time.
+            t2: end time, default now.
+            resolution: seconds, if given the means of the coarsest rollup
+              not longer than resolution are returned instead of raw data.
+        """
+
+        if t2 is None:
+            t2 = time.time()
+
+        if resolution is None:
+            intervals = []
+        else:
+            intervals = [i for i in self.rollups if i <= resolution]
+        if len(intervals) > 0:
+            data = self.query_rollup(channel, max(intervals), t1, t2)
+            return data[:, 0], data[:, 1]
+
+        data = [
+            self._read(filename, RAW_FIELDS)
+            for day in self._days(t1, t2)
+            for filename in self._files_of(os.path.join(self.folder, day), channel)
+        ]
+        data = self._select(data, RAW_FIELDS, t1, t2)
+
+        return data[:, 0], data[:, 1]
+
+    def query_rollup(
+        self, channel: str, interval: int, t1: float = 0.0, t2: float = None
+    ) -> np.ndarray:
+        """
+        Return rollup records of a channel between times t1 and t2.
+        Intervals recorded by several writers are combined.
+
+        Returns:
+            array of rows (interval start time, mean, min, max, count).
+        """
+
+        if t2 is None:
+            t2 = time.time()
+
+        own = self._rollup_file(interval, channel)
+        filenames = self._files_of(os.path.dirname(own), channel)
+        if own not in filenames:
+            filenames.append(own)  # data may be in memory only
+
+        records = []
+        for filename in filenames:
+            data = self._read(filename, ROLLUP_FIELDS)
+
+            # a partial interval may be written more than once, keep the last
+            if len(data) > 1:
+                last = np.append(data[1:, 0] != data[:-1, 0], True)
+                data = data[last]
+
+            if filename == own:
+                with self._lock:
+                    bucket = self._buckets.get((interval, channel))
+                    if bucket is not None:
+                        row = np.array([self._bucket_record(bucket)])
+                        data = np.concatenate([data[data[:, 0] < bucket[0]], row])
+            records.append(data)
+
+        data = self._combine(records)
+
+        return self._select([data], ROLLUP_FIELDS, t1 - interval, t2)
+
+    @staticmethod
+    def _combine(records: list) -> np.ndarray:
+        """
+        Combine rollup records of several writers with the same interval start.
+        """
+
+        records = [r for r in records if len(r) > 0]
+        if len(records) == 0:
+            return np.zeros((0, ROLLUP_FIELDS))
+        if len(records) == 1:
+            return records[0]
+
+        data = np.concatenate(records)
+        starts, index = np.unique(data[:, 0], return_inverse=True)
+        counts = np.bincount(index, weights=data[:, 4])
+        sums = np.bincount(index, weights=data[:, 1] * data[:, 4])
+        lows = np.full(len(starts), np.inf)
+        highs = np.full(len(starts), -np.inf)
+        np.minimum.at(lows, index, data[:, 2])
+        np.maximum.at(highs, index, data[:, 3])
+
+        return np.column_stack([starts, sums / counts, lows, highs, counts])
+
+    @staticmethod
+    def _files_of(folder: str, channel: str) -> list:
+        """
+        Return the files of a channel in a folder, of all writers.
+        """
+
+        return sorted(glob.glob(os.path.join(folder, f"{channel}@*.f64")))
+
+    def _days(self, t1: float = None, t2: float = None) -> list:
+        """
+        Return existing day folders between times t1 and t2.
+        """
+
+        days = sorted(
+            d
+            for d in os.listdir(self.folder)
+            if re.match(r"^\d{4}-\d{2}-\d{2}$", d)
+        )
+        if t1 is not None:
+            days = [d for d in days if d >= self.day(t1)]
+        if t2 is not None:
+            days = [d for d in days if d <= self.day(t2)]
+
+        return days
+
+    def _raw_file(self, day: str, channel: str):
+        """
+        Return open raw file, closing files of previous days.
+        """
+
+        f = self._files.get((day, channel))
+        if f is None:
+            for key in [k for k in self._files if k[1] == channel]:
+                self._files.pop(key).close()
+            os.makedirs(os.path.join(self.folder, day), exist_ok=True)
+            f = open(
+                os.path.join(self.folder, day, f"{channel}@{self.writer}.f64"), "ab"
+            )
+            self._files[(day, channel)] = f
+
+        return f
+
+    def _rollup(self, interval: int, channel: str, t: float, value: float):
+        """
+        Add a value to the current rollup interval, writing the previous one.
+        """
+
+        start = t - t % interval
+        bucket = self._buckets.get((interval, channel))
+        if bucket is None:
+            # continue a partial interval written before a restart
+            bucket = self._last_bucket(interval, channel)
+        if bucket is not None and bucket[0] != start:
+            if (interval, channel) in self._buckets:
+                self._write_bucket(interval, channel, bucket)
+            bucket = None
+        if bucket is None:
+            bucket = [start, 0.0, value, value, 0]
+        self._buckets[(interval, channel)] = bucket
+
+        bucket[1] += value
+        bucket[2] = min(bucket[2], value)
+        bucket[3] = max(bucket[3], value)
+        bucket[4] += 1
+
+        return
+
+    def _last_bucket(self, interval: int, channel: str):
+        """
+        Return the last rollup interval written by this writer, or None.
+        """
+
+        filename = self._rollup_file(interval, channel)
+        size = 8 * ROLLUP_FIELDS
+        if not os.path.exists(filename) or os.path.getsize(filename) < size:
+            return None
+
+        with open(filename, "rb") as f:
+            f.seek((os.path.getsize(filename) // size - 1) * size)
+            start, mean, low, high, count = np.fromfile(f, dtype="<f8", count=5)
+
+        return [start, mean * count, low, high, int(count)]
+
+    @staticmethod
+    def _bucket_record(bucket: list) -> list:
+        start, total, low, high, count = bucket
+
+        return [start, total / count, low, high, count]
+
+    def _rollup_file(self, interval: int, channel: str) -> str:
+        return os.path.join(
+            self.folder, f"rollup_{interval}", f"{channel}@{self.writer}.f64"
+        )
+
+    def _write_bucket(self, interval: int, channel: str, bucket: list):
+        filename = self._rollup_file(interval, channel)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "ab") as f:
+            np.array(self._bucket_record(bucket), dtype="<f8").tofile(f)
+
+        return
+
+    @staticmethod
+    def _read(filename: str, fields: int) -> np.ndarray:
+        """
+        Read records from a file, ignoring an incomplete last record.
+        """
+
+        if not os.path.exists(filename):
+            return np.zeros((0, fields))
+
+        count = os.path.getsize(filename) // 8
+        count -= count % fields
+        data = np.fromfile(filename, dtype="<f8", count=count)
+
+        return data.reshape(-1, fields)
+
+    @staticmethod
+    def _select(data: list, fields: int, t1: float, t2: float) -> np.ndarray:
+        """
+        Concatenate records, sort them by time and select times t1 to t2.
+        """
+
+        data = [d for d in data if len(d) > 0]
+        if len(data) == 0:
+            return np.zeros((0, fields))
+        data = np.concatenate(data)
+
+        # records of several writers interleave
+        if np.any(data[1:, 0] < data[:-1, 0]):
+            data = data[np.argsort(data[:, 0], kind="stable")]
+
+        i1 = np.searchsorted(data[:, 0], t1, side="left")
+        i2 = np.searchsorted(data[:, 0], t2, side="right")
+
+        return data[i1:i2]
@@ -0,0 +1,100 @@
+"""
+Tests of ArduinoLink using ArduinoStandin.
+"""
+
+import time
+
+import pytest
+
+import azcam.exceptions
+from azcam_itl.instruments.arduino_link import ArduinoLink, ArduinoStandin
+
+
+def wait_for(condition, timeout=2.0):
+    """
+    Wait until condition() is true, return its final value.
+    """
+
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+
+@pytest.fixture
+def standin():
+    standin = ArduinoStandin()
+    standin.start()
+    yield standin
+    standin.stop()
+
+
+@pytest.fixture
+def link(standin):
+    link = ArduinoLink(*standin.address)
+    link.timeout = 1.0
+    yield link
+    link.close()
+
+
+def test_send(standin, link):
+    link.send("CFFNFFFFF")
+
+    assert wait_for(lambda: standin.received == ["CFFNFFFFF"])
+    assert standin.mode == "C"
+    assert standin.ledstring == "FFNFFFFF"
+    assert link.get_metrics()["sent"] == 1
+
+
+def test_queued_commands_in_order(standin, link):
+    commands = [f"C{i:08d}" for i in range(50)]
+    for command in commands[:-1]:
+        link.send(command, wait=False)
+    link.send(commands[-1])
+
+    assert wait_for(lambda: len(standin.received) == len(commands))
+    assert standin.received == commands
+    assert standin.number_connections == 1
+
+    metrics = link.get_metrics()
+    assert metrics["sent"] == len(commands)
+    assert metrics["queued"] == 0
+    assert metrics["errors"] == 0
+
+
+def test_reconnect_after_drop(standin, link):
+    link.send("CNFFFFFFF")
+    assert wait_for(lambda: len(standin.received) == 1)
+
+    standin.drop()
+    time.sleep(0.1)
+
+    link.send("CFNFFFFFF")
+    link.send("SFFFFFFFF")
+
+    assert wait_for(lambda: len(standin.received) == 3)
+    assert standin.received == ["CNFFFFFFF", "CFNFFFFFF", "SFFFFFFFF"]
+    assert standin.number_connections == 2
+    assert link.get_metrics()["connects"] == 2
+    assert standin.mode == "S"
+
+
+def test_reconnect_after_idle(standin, link):
+    link.idle_timeout = 0.1
+    link.send("CNFFFFFFF")
+    time.sleep(0.2)
+    link.send("CFNFFFFFF")
+
+    assert wait_for(lambda: len(standin.received) == 2)
+    assert standin.number_connections == 2
+
+
+def test_send_error(standin, link):
+    standin.stop()
+    link.retries = 1
+
+    with pytest.raises(azcam.exceptions.AzcamError, match="CNFFFFFFF"):
+        link.send("CNFFFFFFF")
+
+    assert link.get_metrics()["errors"] == 1
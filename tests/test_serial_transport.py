@@ -0,0 +1,389 @@
+"""
+Tests of SerialTransport and the serial pressure drivers using PtyStandin.
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("serial")
+if os.name != "posix":
+    pytest.skip("PtyStandin requires a pseudo terminal", allow_module_level=True)
+
+import azcam.exceptions
+from azcam_itl.instruments import keithley_6482, pollux, pressure_mks900, pressure_vgc501
+from azcam_itl.instruments.pressure_poller import PressurePoller
+from azcam_itl.instruments.serial_transport import PtyStandin, SerialTransport
+
+
+def wait_for(condition, timeout=2.0):
+    """
+    Wait until condition() is true, return its final value.
+    """
+
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+
+@pytest.fixture
+def standin(request):
+    """
+    PtyStandin which replies with the respond function of the test, if any.
+    """
+
+    respond, terminators = getattr(request, "param", (lambda frame: None, [b"\r\n"]))
+    device = PtyStandin(respond, terminators)
+    device.start()
+    yield device
+    device.stop()
+
+
+@pytest.fixture
+def transport(standin):
+    transport = SerialTransport(standin.port)
+    transport.timeout = 0.5
+    transport.open()
+    yield transport
+    transport.stop_reader()
+    transport.close()
+
+
+def test_read_terminator_frames(standin, transport):
+    standin.write(b"abc\r\ndef\r\ngh")
+
+    assert transport.read(b"\r\n") == b"abc\r\n"
+    assert transport.read(b"\r\n") == b"def\r\n"
+
+    standin.write(b"i\r\n")
+    assert transport.read(b"\r\n") == b"ghi\r\n"
+
+
+def test_read_length_frames(standin, transport):
+    standin.write(b"0123456789")
+
+    assert transport.read(length=4) == b"0123"
+    assert transport.read(length=4) == b"4567"
+
+    # incomplete frame is kept for the next read
+    with pytest.raises(azcam.exceptions.AzcamError):
+        transport.read(length=4, timeout=0.2)
+    standin.write(b"ab")
+    assert transport.read(length=4) == b"89ab"
+
+
+def test_read_any_terminator(standin, transport):
+    standin.write(b"abc\rdef\nghi\r\n")
+
+    terminators = [b"\r", b"\n"]
+    assert transport.read(terminators) == b"abc\r"
+    assert transport.read(terminators) == b"def\n"
+    assert transport.read(terminators) == b"ghi\r"
+
+
+def test_read_timeout(standin, transport):
+    standin.write(b"partial")
+
+    t0 = time.monotonic()
+    with pytest.raises(azcam.exceptions.AzcamError, match="timeout"):
+        transport.read(b"\r\n", timeout=0.3)
+    elapsed = time.monotonic() - t0
+
+    assert 0.3 <= elapsed < 0.3 + 3 * transport.read_period
+
+
+@pytest.mark.parametrize(
+    "standin", [(lambda frame: b"PONG\r\n" if frame == b"PING\r\n" else None, [b"\r\n"])],
+    indirect=True,
+)
+def test_transact(standin, transport):
+    # stale input is discarded before the command is sent
+    standin.write(b"stale\r\n")
+    time.sleep(0.1)
+
+    assert transport.transact(b"PING\r\n", terminator=b"\r\n") == b"PONG\r\n"
+    assert transport.transact("PING\r\n", terminator=b"\r\n") == b"PONG\r\n"
+
+    metrics = transport.get_metrics()
+    assert metrics["transactions"] == 2
+    assert metrics["errors"] == 0
+    assert metrics["last_latency"] > 0.0
+
+
+def test_transact_retry(standin, transport):
+    # no reply to the first attempt
+    replies = [None, b"OK\r\n"]
+    standin.respond = lambda frame: replies.pop(0)
+    transport.timeout = 0.2
+
+    assert transport.transact(b"CMD\r\n", terminator=b"\r\n") == b"OK\r\n"
+    assert standin.received == [b"CMD\r\n", b"CMD\r\n"]
+
+    metrics = transport.get_metrics()
+    assert metrics["errors"] == 1
+    assert metrics["connects"] == 2
+
+
+def test_transact_fails_after_retries(standin, transport):
+    transport.timeout = 0.1
+    transport.retries = 3
+
+    with pytest.raises(azcam.exceptions.AzcamError, match="serial error"):
+        transport.transact(b"CMD\r\n", terminator=b"\r\n")
+
+    assert len(standin.received) == 3
+    assert transport.get_metrics()["errors"] == 3
+
+
+def test_start_reader(standin, transport):
+    frames = []
+    transport.start_reader(frames.append, terminator=b"\r\n")
+    time.sleep(0.1)
+
+    for i in range(5):
+        standin.write(f"frame{i}\r\n".encode())
+
+    assert wait_for(lambda: len(frames) == 5)
+    assert frames == [f"frame{i}\r\n".encode() for i in range(5)]
+
+    transport.stop_reader()
+    standin.write(b"late\r\n")
+    time.sleep(0.2)
+    assert len(frames) == 5
+
+
+def mks900(frame):
+    if frame == b"@253PR1?;FF":
+        return b"@253ACK7.60E+2;FF"
+    return b"@253NAK160;FF"
+
+
+@pytest.mark.parametrize("standin", [(mks900, [b";FF"])], indirect=True)
+def test_mks900(standin):
+    gauge = pressure_mks900.PressureController(standin.port)
+    gauge.initialize()
+
+    assert gauge.query("PR1?") == "7.60E+2"
+    assert gauge.read_pressure(1) == 760.0
+
+    with pytest.raises(azcam.exceptions.AzcamError, match="NAK160"):
+        gauge.query("PR2?")
+    assert gauge.read_pressure(2) == -999
+    assert gauge.command("XYZ;FF") == "@253NAK160;FF"
+
+    gauge.close_port()
+
+
+def keithley(frame):
+    # 28 byte reply ended by CR, the RS-232 default
+    if frame == b":MEAS:CURR:DC?\n":
+        return b"-1.234567E-09,+2.345678E-10\r"
+    return None
+
+
+@pytest.mark.parametrize("standin", [(keithley, [b"\n"])], indirect=True)
+def test_keithley_6482(standin):
+    diodes = keithley_6482.DiodeControllerClass(standin.port)
+    diodes.initialize()
+
+    t0 = time.monotonic()
+    assert diodes.read_diodes() == [-1.234567e-09, 2.345678e-10]
+    assert time.monotonic() - t0 < 1.0
+
+    # LF terminated replies also work
+    standin.respond = lambda frame: b"+1.000000E-09,+2.000000E-09\n"
+    assert diodes.read_diodes() == [1.0e-09, 2.0e-09]
+
+    assert standin.received[:2] == [b":SYST:AZER ON\n", b":SENS1:CURR:NPLC 10\n"]
+
+    diodes.close_port()
+
+
+class Pollux(object):
+    """
+    Pollux stand-in with two controllers, axes 1 and 2.
+    """
+
+    def __init__(self):
+        self.positions = {1: 0.0, 2: 5.0}
+        self.device = PtyStandin(self.respond, [b"\r\n"])
+
+    def respond(self, frame):
+        words = frame.decode().split()
+        axis = int(words[-2])
+        if axis not in self.positions:
+            return None
+
+        command = words[-1]
+        if command == "nidentify":
+            return f"Pollux {axis}\r\n".encode()
+        elif command == "npos":
+            return f"{self.positions[axis]:.6f}\r\n".encode()
+        elif command == "nst":
+            return b"0\r\n"
+        elif command in ["gnv", "gna"]:
+            return b"10.000000\r\n"
+        elif command == "nm":
+            self.positions[axis] = float(words[0])
+        elif command == "nr":
+            self.positions[axis] += float(words[0])
+
+        return None
+
+
+@pytest.fixture
+def pollux_standin():
+    device = Pollux()
+    device.device.start()
+    yield device
+    device.device.stop()
+
+
+def test_pollux(pollux_standin):
+    stage = pollux.PolluxCtrl()
+    stage.ComPort = pollux_standin.device.port
+    stage.Timeout = 0.2
+    stage.initialize()
+
+    assert stage.nAxis == 2
+    assert stage.nNames == ["Pollux 1", "Pollux 2"]
+
+    assert stage.get_pos(2) == ["OK", 5.0]
+    assert stage.send_cmd("1  nst") == "0"
+
+    stage.move_absolute(1, 2.5)
+    stage.move_relative(2, -1.0)
+    assert stage.get_positions([1, 2]) == {1: 2.5, 2: 4.0}
+
+    assert stage.move_axes({1: 1.0, 2: 3.0}, wait=True)
+    assert pollux_standin.positions == {1: 1.0, 2: 3.0}
+    assert stage.moving_axes([1, 2]) == []
+
+    # no controller on axis 3
+    with pytest.raises(azcam.exceptions.AzcamError, match="timeout"):
+        stage.send_batch([("1  npos", True), ("3  npos", True)])
+    assert stage.get_pos(3)[0] == "ERROR"
+
+    stage.close_port()
+    with pytest.raises(azcam.exceptions.AzcamError, match="not open"):
+        stage.send_cmd("1  npos")
+
+
+class VGC501(object):
+    """
+    VGC501 stand-in with continuous output.
+    """
+
+    def __init__(self):
+        self.streaming = False
+        self.commands = []
+        self.device = PtyStandin(self.respond, [b"\r\n", b"\x05", b"\x03"])
+        self._stop = threading.Event()
+
+    def respond(self, frame):
+        if frame == b"\x05":
+            if self.commands[-1] == "PR1":
+                return b"0,+7.6000E+02\r\n"
+            return b"VGC501\r\n"
+        if frame == b"\x03":
+            self.streaming = False
+            return None
+
+        command = frame.decode().strip()
+        self.commands.append(command)
+        if command.startswith("COM"):
+            self.streaming = True
+        elif command == "BAD":
+            return b"\x15\r\n"
+
+        return b"\x06\r\n"
+
+    def start(self):
+        self.device.start()
+        threading.Thread(target=self._stream, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self.device.stop()
+
+    def _stream(self):
+        while not self._stop.wait(0.02):
+            if self.streaming:
+                self.device.write(b"0,+1.5000E-06\r\n")
+
+
+@pytest.fixture
+def vgc501():
+    device = VGC501()
+    device.start()
+    yield device
+    device.stop()
+
+
+def test_vgc501_commands(vgc501):
+    gauge = pressure_vgc501.PressureController(vgc501.device.port)
+    gauge.initialize()
+
+    assert gauge.read_pressure() == 760.0
+    assert gauge.command("TID") == "VGC501"
+    assert gauge.command("BAD") == -999.9
+
+    gauge.close_port()
+
+
+def test_vgc501_stream(vgc501):
+    gauge = pressure_vgc501.PressureController(vgc501.device.port)
+    gauge.initialize()
+
+    gauge.start_stream()
+    assert gauge.streaming
+    assert wait_for(lambda: gauge.read_pressure() == 1.5e-6)
+
+    # commands stop continuous output and restart it
+    assert gauge.command("TID") == "VGC501"
+    assert gauge.streaming
+    assert vgc501.commands == ["COM,1", "TID", "COM,1"]
+    assert b"\x03" in vgc501.device.received
+
+    count = gauge.stream_count
+    assert wait_for(lambda: gauge.stream_count > count)
+    times, values = gauge.get_stream()
+    assert len(times) == gauge.stream_count
+    assert set(values) == {1.5e-6}
+
+    gauge.stop_stream()
+    assert not gauge.streaming
+    assert not vgc501.streaming
+    assert gauge.read_pressure() == 760.0
+
+    gauge.close_port()
+
+
+def test_vgc501_stream_poller(vgc501):
+    gauge = pressure_vgc501.PressureController(vgc501.device.port)
+    gauge.initialize()
+    gauge.start_stream()
+
+    # a gauge error frame is skipped
+    vgc501.device.write(b"5,+0.0000E+00\r\n")
+    assert wait_for(lambda: gauge.stream_count > 0)
+
+    poller = PressurePoller()
+    poller.add(1, gauge.read_pressure, 0.02)
+    poller.start()
+    try:
+        assert wait_for(lambda: poller.get_pressure(1) == 1.5e-6)
+        times, values = poller.get_history(1)
+        assert len(values) > 0
+        assert set(values) == {1.5e-6}
+    finally:
+        poller.stop()
+
+    # continuous output feeds read_pressure, no PR1 commands are sent
+    assert vgc501.commands == ["COM,1"]
+
+    gauge.close_port()